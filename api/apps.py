@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import reference, search, caching, images, instrumentation, authentication, listings, versions, changes
+        reference.connect_signals()
+        search.connect_signals()
+        caching.connect_signals()
+        images.connect_signals()
+        instrumentation.connect_signals()
+        authentication.connect_signals()
+        listings.connect_signals()
+        versions.connect_signals()
+        changes.connect_signals()
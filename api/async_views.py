@@ -0,0 +1,48 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import instrumentation
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# every thread keeps its own database connection, so this also bounds the connections per process
+read_executor = ThreadPoolExecutor(max_workers=settings.ASGI_READ_THREADS, thread_name_prefix='asgi-read')
+
+def threaded_view(view):
+    '''
+    Adapts a view for the ASGI application.
+
+    Under ASGI, Django runs every sync view on one shared thread, so a slow query
+    blocks all other requests. Reads don't need that guarantee: safe requests are run
+    (and rendered) on a pool of ASGI_READ_THREADS threads, so many of them can wait on the database
+    at the same time while the event loop keeps serving slow clients.
+    Writes keep Django's default single thread behaviour.
+
+    Django 4.0 has no async ORM yet, once it is upgraded the readers can await
+    the queries directly instead.
+    '''
+    def run(request, *args, **kwargs):
+        # pool threads aren't covered by the request_started/finished signals
+        close_old_connections()
+        try:
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                instrumentation.render(response)
+            return response
+        finally:
+            close_old_connections()
+
+    read = sync_to_async(run, thread_sensitive=False, executor=read_executor)
+    write = sync_to_async(view, thread_sensitive=True)
+
+    async def async_view(request, *args, **kwargs):
+        if request.method in SAFE_METHODS:
+            return await read(request, *args, **kwargs)
+        return await write(request, *args, **kwargs)
+
+    # like the DRF views it wraps; csrf_exempt itself can't wrap coroutines in Django 4.0
+    async_view.csrf_exempt = True
+    return async_view
@@ -0,0 +1,108 @@
+from typing import NamedTuple
+
+from django.conf import settings
+from django.contrib.auth.models import User as DjangoUser
+from django.core.cache import cache
+from django.db import router
+from django.db.models.signals import post_save, post_delete
+from django.utils.functional import cached_property
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .models import User
+
+# id of the api.models.User of the token's Django user
+PROFILE_CLAIM = 'profile_id'
+
+def tokens_for(django_user):
+    '''
+    Returns a refresh token carrying the claims ClaimsJWTAuthentication needs.
+    Access tokens made from it, now or through login/refresh/, copy them.
+    '''
+    refresh = RefreshToken.for_user(django_user)
+    refresh[PROFILE_CLAIM] = django_user.user.id
+    return refresh
+
+class ClaimsUser(TokenUser):
+    '''
+    The request user built from the access token alone. request.user.user is an
+    api.models.User that only knows its ids, its other fields are loaded on first access.
+    The staff flags come from the cached user status, not from the token, so they are
+    revoked as soon as the user is saved
+    '''
+    def __init__(self, token, status):
+        super().__init__(token)
+        self.status = status
+
+    @property
+    def is_staff(self):
+        return self.status.is_staff
+
+    @property
+    def is_superuser(self):
+        return self.status.is_superuser
+
+    @cached_property
+    def user(self):
+        return User.from_db(
+            router.db_for_read(User), ['id', 'django_user_id'], [self.token[PROFILE_CLAIM], self.id],
+        )
+
+    @cached_property
+    def django_user(self):
+        return DjangoUser.objects.get(pk=self.id)
+
+class UserStatus(NamedTuple):
+    is_active: bool
+    is_staff: bool
+    is_superuser: bool
+
+# the status of a Django user that doesn't exist anymore
+NO_USER = UserStatus(False, False, False)
+
+def status_cache_key(django_user_id):
+    return f'auth:status:{django_user_id}'
+
+def user_status(django_user_id):
+    '''
+    Whether the Django user still exists and is active, and whether it is staff or superuser,
+    cached for AUTH_STATUS_CACHE_TTL seconds and updated right away when the user is saved or deleted
+    '''
+    key = status_cache_key(django_user_id)
+    status = cache.get(key)
+    if status is None:
+        flags = DjangoUser.objects.filter(pk=django_user_id).values_list('is_active', 'is_staff', 'is_superuser').first()
+        status = UserStatus(*flags) if flags else NO_USER
+        cache.set(key, status, settings.AUTH_STATUS_CACHE_TTL)
+    return status
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    '''
+    JWTAuthentication without the per request user query. Tokens issued before the claims
+    were added still authenticate the usual way, by loading the user
+    '''
+    def get_user(self, validated_token):
+        if PROFILE_CLAIM not in validated_token:
+            return super().get_user(validated_token)
+        try:
+            django_user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise AuthenticationFailed('Token contained no recognizable user identification', code='user_not_found')
+        status = user_status(django_user_id)
+        if not status.is_active:
+            raise AuthenticationFailed('User is inactive', code='user_inactive')
+        return ClaimsUser(validated_token, status)
+
+def django_user_saved(sender, instance, **kwargs):
+    status = UserStatus(instance.is_active, instance.is_staff, instance.is_superuser)
+    cache.set(status_cache_key(instance.pk), status, settings.AUTH_STATUS_CACHE_TTL)
+
+def django_user_deleted(sender, instance, **kwargs):
+    cache.set(status_cache_key(instance.pk), NO_USER, settings.AUTH_STATUS_CACHE_TTL)
+
+def connect_signals():
+    post_save.connect(django_user_saved, sender=DjangoUser)
+    post_delete.connect(django_user_deleted, sender=DjangoUser)
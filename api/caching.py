@@ -0,0 +1,231 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.utils import timezone
+from rest_framework.exceptions import NotAcceptable
+
+from .models import City, Author, Genre
+from .replicas import replica_may_be_behind
+
+logger = logging.getLogger(__name__)
+
+# how often (in handled requests) each worker logs its cache statistics
+STATS_LOG_INTERVAL = 100
+
+class ResponseCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.bytes_saved = 0
+        # shared by the threads of a worker
+        self._lock = threading.Lock()
+
+    def record(self, outcome, saved=0):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.bytes_saved += saved
+            total = self.hits + self.misses + self.not_modified
+        if total % STATS_LOG_INTERVAL == 0:
+            logger.info(
+                'response cache: %d requests, hit ratio %.2f, %d not modified, %d bytes saved',
+                total, (self.hits + self.not_modified) / total, self.not_modified, self.bytes_saved,
+            )
+
+stats = ResponseCacheStats()
+
+def new_version():
+    # random, so data stored under an evicted version is never served again,
+    # and prefixed with the time of the change
+    return f'{time.time():.3f}-{uuid.uuid4().hex}'
+
+def changed_at(versions):
+    '''
+    When the last of the given partition versions was bumped
+    '''
+    return max(float(version.partition('-')[0]) for version in versions)
+
+def partition_versions(*partitions):
+    '''
+    The current version of each named cache partition, with a single cache round trip.
+    Keys of cached data include the versions of the partitions it depends on,
+    so bumping a version drops all of the partition's data at once
+    '''
+    keys = [f'version:{partition}' for partition in partitions]
+    versions = cache.get_many(keys)
+    missing = {key: new_version() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+def invalidate_partitions(*partitions):
+    cache.set_many({f'version:{partition}': new_version() for partition in partitions}, None)
+
+def response_partition(name):
+    return f'response:{name}'
+
+def invalidate_response(name):
+    # a new version, so a response rendered from the old rows is never stored under it
+    invalidate_partitions(response_partition(name))
+
+class CachedResponseMixin:
+    '''
+    Serves GET requests of a view from rendered bytes stored in the cache framework,
+    with strong ETag and Last-Modified headers. Conditional requests are answered
+    with 304 before authentication, so they never touch the database.
+    Responses are stored per negotiated renderer format, under the version of the view's
+    cache partition, which is bumped whenever a row of the underlying model changes.
+    A response read from a replica isn't stored while the replica may not have the change yet.
+    '''
+    cache_name = None
+    # the browsable api page depends on the logged in user, so only json is stored
+    cached_formats = ('json',)
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+        format = self.negotiated_format(request, *args, **kwargs)
+        if format not in self.cached_formats:
+            return super().dispatch(request, *args, **kwargs)
+
+        version, = partition_versions(response_partition(self.cache_name))
+        key = f'{response_partition(self.cache_name)}:{version}:{format}'
+        entry = cache.get(key)
+
+        if entry is None:
+            response = super().dispatch(request, *args, **kwargs)
+            if response.status_code != 200 or getattr(response.accepted_renderer, 'format', None) != format:
+                return response
+            response.render()
+            entry = {
+                'content': response.content,
+                'content_type': response['Content-Type'],
+                'etag': quote_etag(hashlib.sha1(response.content).hexdigest()),
+                'last_modified': int(timezone.now().timestamp()),
+            }
+            if not replica_may_be_behind(changed_at([version])):
+                cache.set(key, entry, settings.RESPONSE_CACHE_TIMEOUT)
+            stats.record('misses')
+        elif self.not_modified(request, entry):
+            stats.record('not_modified', len(entry['content']))
+            response = HttpResponseNotModified()
+            self.set_validators(response, entry)
+            return response
+        else:
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+            stats.record('hits')
+
+        self.set_validators(response, entry)
+        return response
+
+    def negotiated_format(self, request, *args, **kwargs):
+        '''
+        The format of the renderer the view will pick for the request, from its Accept header
+        or ?format=. None when no renderer is acceptable, the view answers that with 406
+        '''
+        self.format_kwarg = self.get_format_suffix(**kwargs)
+        try:
+            renderer, media_type = self.perform_content_negotiation(self.initialize_request(request, *args, **kwargs))
+        except NotAcceptable:
+            return None
+        return renderer.format
+
+    def not_modified(self, request, entry):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            return entry['etag'] in [etag.strip() for etag in if_none_match.split(',')] or if_none_match.strip() == '*'
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+        return if_modified_since is not None and entry['last_modified'] <= if_modified_since
+
+    def set_validators(self, response, entry):
+        response['ETag'] = entry['etag']
+        response['Last-Modified'] = http_date(entry['last_modified'])
+        response['Vary'] = 'Accept'
+
+def response_variant(request):
+    '''
+    What a response depends on besides its object: the query parameters (e.g. 'fields') and the Accept header
+    '''
+    variant = f'{request.get_full_path()}\n{request.META.get("HTTP_ACCEPT", "")}'
+    return hashlib.sha1(variant.encode()).hexdigest()[:16]
+
+class VersionedResponseMixin:
+    '''
+    Serves GET requests of a single object with an ETag made of the `version` column of versioned_model.
+    Conditional requests are answered with 304 after looking up that version alone, and the other
+    requests for an unchanged object get its rendered bytes from the cache, without serializing it again.
+    The view sets object_version on its response, the version of the rows it was built from,
+    so a response read from a replica that is behind is never stored under a newer version.
+    '''
+    versioned_model = None
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+
+        name = f'{self.versioned_model._meta.model_name}:{kwargs["pk"]}'
+        variant = response_variant(request)
+        # read before the view picks a replica, so it is always the latest version
+        version = self.versioned_model.objects.filter(pk=kwargs['pk']).values_list('version', flat=True).first()
+        if version is None:
+            # the view answers with 404
+            return super().dispatch(request, *args, **kwargs)
+
+        etag = quote_etag(f'{name}-{version}-{variant}')
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        if etag in [value.strip() for value in if_none_match.split(',')]:
+            stats.record('not_modified')
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        entry = cache.get(f'response:{name}:{version}:{variant}')
+        if entry is not None:
+            stats.record('hits')
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+        else:
+            response = super().dispatch(request, *args, **kwargs)
+            version = getattr(response, 'object_version', None)
+            if response.status_code != 200 or version is None:
+                return response
+            etag = quote_etag(f'{name}-{version}-{variant}')
+            # the browsable api page depends on the logged in user, so only json is stored
+            if getattr(response.accepted_renderer, 'format', None) == 'json':
+                response.render()
+                entry = {'content': response.content, 'content_type': response['Content-Type']}
+                cache.set(f'response:{name}:{version}:{variant}', entry, settings.RESPONSE_CACHE_TIMEOUT)
+            stats.record('misses')
+
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Accept',))
+        return response
+
+cached_models = {
+    City: 'cities',
+    Author: 'authors',
+    Genre: 'genres',
+}
+
+def model_changed(sender, **kwargs):
+    # once the change is visible, or a request in between could cache the old rows again
+    name = cached_models[sender]
+    transaction.on_commit(lambda: invalidate_response(name))
+
+def connect_signals():
+    '''
+    Saves and deletes through the API or the admin page drop the cached response
+    '''
+    for model in cached_models:
+        post_save.connect(model_changed, sender=model)
+        post_delete.connect(model_changed, sender=model)
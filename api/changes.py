@@ -0,0 +1,100 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, Max, Min, OuterRef
+from django.db.models.signals import post_delete
+from django.utils import timezone
+
+from .models import Book, ListingChange
+
+# The change feed of listings. Every write that lists, changes or removes a listing appends
+# a ListingChange, and clients that keep a copy of /books/ ask for the changes after the last
+# id (token) they have seen. Changes are appended once their transaction commits, so ids
+# follow the order in which they became visible; the few changes committing at the same time
+# are held back for CHANGE_FEED_SETTLE_SECONDS, before any later token is handed out.
+
+REMOVED = {
+    ListingChange.Kind.SOLD, ListingChange.Kind.EXCHANGED,
+    ListingChange.Kind.UNLISTED, ListingChange.Kind.DELETED,
+}
+
+class ChangesCompacted(Exception):
+    pass
+
+def record_changes(book_ids, kind):
+    '''
+    Appends a change of the given kind for each of the books once the current transaction commits.
+    book_ids can be a queryset, it is only evaluated then
+    '''
+    def append():
+        ListingChange.objects.bulk_create([ListingChange(book_id=book_id, kind=kind) for book_id in book_ids])
+    if isinstance(book_ids, (set, list, tuple)) and not book_ids:
+        return
+    transaction.on_commit(append)
+
+def settled():
+    return timezone.now() - timedelta(seconds=settings.CHANGE_FEED_SETTLE_SECONDS)
+
+def latest_token():
+    '''
+    The token of the last change clients can see now
+    '''
+    last = ListingChange.objects.filter(created_at__lte=settled()).order_by('-id').values_list('id', flat=True).first()
+    return last or 0
+
+def changes_since(since, limit=None):
+    '''
+    The latest change of every book changed after the since token, as (book_id, kind) pairs
+    in the order of the changes, the token to continue from, and whether there are more.
+    Raises ChangesCompacted when changes after the token have been removed by compact_changes
+    '''
+    limit = limit or settings.CHANGE_FEED_LIMIT
+    oldest = ListingChange.objects.aggregate(oldest=Min('id'))['oldest']
+    if oldest is not None and since + 1 < oldest:
+        raise ChangesCompacted
+    rows = list(ListingChange.objects.filter(id__gt=since).order_by('id').values_list('id', 'book_id', 'kind', 'created_at')[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    cutoff = settled()
+    for i, (change_id, book_id, kind, created_at) in enumerate(rows):
+        if created_at > cutoff:
+            # not settled yet, neither are the ones after it
+            rows = rows[:i]
+            more = False
+            break
+
+    latest = {}
+    for change_id, book_id, kind, created_at in rows:
+        latest.pop(book_id, None)
+        latest[book_id] = kind
+    return list(latest.items()), rows[-1][0] if rows else since, more
+
+def compact(retention_days, batch_size=10000):
+    '''
+    Removes changes older than retention_days, and changes superseded by a later change of the same book.
+    The oldest change is always kept, it tells which tokens are too old to continue from.
+    Returns how many of both were removed
+    '''
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    horizon = ListingChange.objects.filter(created_at__lt=cutoff).order_by('-id').values_list('id', flat=True).first()
+    expired = 0
+    if horizon is not None:
+        expired, _ = ListingChange.objects.filter(id__lt=horizon).delete()
+
+    bounds = ListingChange.objects.aggregate(oldest=Min('id'), newest=Max('id'))
+    superseded = 0
+    if bounds['oldest'] is not None:
+        for start in range(bounds['oldest'] + 1, bounds['newest'] + 1, batch_size):
+            later = ListingChange.objects.filter(book_id=OuterRef('book_id'), id__gt=OuterRef('id'))
+            deleted, _ = ListingChange.objects.filter(
+                id__gte=start, id__lt=start + batch_size,
+            ).filter(Exists(later)).delete()
+            superseded += deleted
+    return expired, superseded
+
+def book_deleted(sender, instance, **kwargs):
+    record_changes([instance.pk], ListingChange.Kind.DELETED)
+
+def connect_signals():
+    post_delete.connect(book_deleted, sender=Book)
@@ -0,0 +1,315 @@
+import asyncio
+import json
+import logging
+import secrets
+import threading
+import time
+from urllib.parse import parse_qs
+
+import psycopg2
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+from django.utils.module_loading import import_string
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from .authentication import ClaimsJWTAuthentication
+
+logger = logging.getLogger(__name__)
+
+# Push notifications of offers, replies to offers and sales, sent to the affected users as
+# Server-Sent Events from GET /events/ of the ASGI application (see bookujme/asgi.py).
+# Writes publish events through the broker named by EVENTS_BROKER once they commit, and the broker
+# hands them to the event streams of the user in this process. Each open stream is a coroutine,
+# a task waiting for the disconnect and a small queue, so idle connections cost a few KB each.
+
+HEARTBEAT = object()
+CLOSED = object()
+
+# set by bookujme/asgi.py in the processes that serve /events/
+serving_streams = False
+
+class Subscription:
+    __slots__ = ('user_id', 'queue', 'closed')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.queue = asyncio.Queue(settings.EVENTS_QUEUE_SIZE)
+        self.closed = False
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # the client doesn't keep up, its stream is closed and it has to resync
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        self.put(CLOSED)
+
+class LocalBroker:
+    '''
+    Delivers events to the streams of this process only. Enough when the ASGI application
+    runs in a single process that also serves the writes, e.g. one uvicorn worker.
+    Other brokers override publish() to reach the streams of other processes and nodes,
+    and hand what they receive to deliver() on the event loop.
+    '''
+    def __init__(self):
+        self.loop = None
+        self.subscriptions = {}
+        self.warned = False
+
+    def start(self, loop):
+        '''
+        Called on the event loop with the first subscription
+        '''
+        self.loop = loop
+        loop.call_later(settings.EVENTS_HEARTBEAT_SECONDS, self.heartbeat)
+
+    def subscribe(self, user_id):
+        if self.loop is None:
+            self.start(asyncio.get_running_loop())
+        subscription = Subscription(user_id)
+        self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.user_id]
+
+    def heartbeat(self):
+        # one timer for every stream of the process, instead of one per connection
+        for subscriptions in self.subscriptions.values():
+            for subscription in subscriptions:
+                subscription.put(HEARTBEAT)
+        self.loop.call_later(settings.EVENTS_HEARTBEAT_SECONDS, self.heartbeat)
+
+    def deliver(self, user_id, event):
+        '''
+        Runs on the event loop
+        '''
+        for subscription in self.subscriptions.get(user_id, ()):
+            subscription.put(event)
+
+    def publish(self, user_id, event):
+        '''
+        Called from any thread, e.g. the one a view runs on
+        '''
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.deliver, user_id, event)
+        elif not serving_streams and not self.warned:
+            self.warned = True
+            logger.warning(
+                'events are published with LocalBroker in a process that serves no event streams, '
+                'so they reach no one. Serve writes from the ASGI process, or use postgres and api.events.PostgresBroker'
+            )
+
+class PostgresBroker(LocalBroker):
+    '''
+    Sends events through postgres LISTEN/NOTIFY, so they reach the streams of every process
+    and node using the same database, including writes served by uwsgi. Every process
+    with open streams keeps one extra connection that listens
+    '''
+    channel = 'bookujme_events'
+
+    def start(self, loop):
+        super().start(loop)
+        self.listen_later(0)
+
+    def listen_later(self, delay):
+        self.loop.call_later(delay, lambda: self.loop.create_task(self.listen()))
+
+    def connect(self):
+        '''
+        Runs on a thread of the loop's executor, so a slow database doesn't stall the streams
+        '''
+        listener = psycopg2.connect(**connection.get_connection_params())
+        listener.autocommit = True
+        with listener.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.channel}')
+        return listener
+
+    async def listen(self):
+        try:
+            self.listener = await self.loop.run_in_executor(None, self.connect)
+        except psycopg2.Error:
+            logger.exception('could not listen for events, retrying in a few seconds')
+            self.listen_later(settings.EVENTS_HEARTBEAT_SECONDS)
+            return
+        self.loop.add_reader(self.listener.fileno(), self.receive)
+
+    def receive(self):
+        try:
+            self.listener.poll()
+        except psycopg2.Error:
+            logger.exception('lost the connection listening for events, reconnecting')
+            self.loop.remove_reader(self.listener.fileno())
+            self.listener.close()
+            self.listen_later(1)
+            return
+        while self.listener.notifies:
+            message = json.loads(self.listener.notifies.pop(0).payload)
+            self.deliver(message['user'], message['event'])
+
+    def publish(self, user_id, event):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, json.dumps({'user': user_id, 'event': event})])
+
+broker = None
+broker_lock = threading.Lock()
+
+def get_broker():
+    '''
+    The broker of this process, created on first use. The request threads of a uWSGI worker
+    may publish at once, the lock keeps them from creating a broker each
+    '''
+    global broker
+    with broker_lock:
+        if broker is None:
+            name = settings.EVENTS_BROKER
+            if name is None:
+                name = 'api.events.PostgresBroker' if connection.vendor == 'postgresql' else 'api.events.LocalBroker'
+            broker = import_string(name)()
+        return broker
+
+def publish(user_ids, name, **data):
+    '''
+    Sends the event to the given users (api.models.User ids) once the current transaction commits
+    '''
+    event = {'event': name, 'data': data}
+    def send():
+        # the write has committed already, a lost event must not fail its request
+        try:
+            for user_id in set(user_ids):
+                if user_id is not None:
+                    get_broker().publish(user_id, event)
+        except Exception:
+            logger.exception('could not publish the %s event', name)
+    transaction.on_commit(send)
+
+def ticket_key(ticket):
+    return f'events:ticket:{ticket}'
+
+def issue_ticket(user_id, expires):
+    '''
+    A ticket for opening one event stream of the user within EVENTS_TICKET_SECONDS, for browsers'
+    EventSource, which can't send an Authorization header. Unlike an access token in the URL,
+    a ticket that ends up in access logs can't be used anymore
+    '''
+    ticket = secrets.token_urlsafe(32)
+    cache.set(ticket_key(ticket), (user_id, expires), settings.EVENTS_TICKET_SECONDS)
+    return ticket
+
+def redeem_ticket(ticket):
+    '''
+    The user id and expiry the ticket was issued with, or None when it is unknown, expired or used
+    '''
+    key = ticket_key(ticket)
+    issued = cache.get(key)
+    # of concurrent redemptions, only the one that deletes the ticket gets it
+    if issued is None or not cache.delete(key):
+        return None
+    return issued
+
+def authenticate(raw_token):
+    '''
+    The id of the api.models.User the access token belongs to, and when the token expires,
+    or None for an invalid token
+    '''
+    authentication = ClaimsJWTAuthentication()
+    close_old_connections()
+    try:
+        token = authentication.get_validated_token(raw_token)
+        user = authentication.get_user(token)
+        return user.user.id, token['exp']
+    except (InvalidToken, AuthenticationFailed):
+        return None
+    finally:
+        close_old_connections()
+
+def bearer_token(scope):
+    for name, value in scope.get('headers', ()):
+        if name == b'authorization':
+            kind, _, token = value.decode('latin-1').partition(' ')
+            if kind.lower() == 'bearer':
+                return token.strip().encode()
+    return None
+
+def stream_ticket(scope):
+    tickets = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('ticket')
+    return tickets[0] if tickets else None
+
+async def send_error(send, status, message):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'access-control-allow-origin', b'*')],
+    })
+    await send({'type': 'http.response.body', 'body': json.dumps({'Error': message}).encode()})
+
+def encode(event):
+    return f'event: {event["event"]}\ndata: {json.dumps(event["data"])}\n\n'.encode()
+
+async def event_stream(scope, receive, send):
+    '''
+    ASGI application of GET /events/: a text/event-stream of the events of the user, authenticated
+    by an access token in the Authorization header or by a ticket from /events/ticket/ in ?ticket=.
+    The stream ends when the access token expires, clients reconnect with a fresh one
+    '''
+    if scope['method'] != 'GET':
+        return await send_error(send, 405, 'Only GET is allowed.')
+    raw_token = bearer_token(scope)
+    ticket = stream_ticket(scope)
+    if raw_token:
+        authenticated = await sync_to_async(authenticate)(raw_token)
+    elif ticket:
+        authenticated = await sync_to_async(redeem_ticket)(ticket)
+    else:
+        authenticated = None
+    if authenticated is None:
+        return await send_error(send, 401, 'You have to be logged in.')
+    user_id, expires = authenticated
+
+    broker = get_broker()
+    subscription = broker.subscribe(user_id)
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        subscription.close()
+
+    watcher = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                # nginx passes the events on right away
+                (b'x-accel-buffering', b'no'),
+                (b'access-control-allow-origin', b'*'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+        while True:
+            item = await subscription.queue.get()
+            if subscription.closed:
+                break
+            if time.time() >= expires:
+                await send({'type': 'http.response.body', 'body': b'event: expired\ndata: {}\n\n', 'more_body': True})
+                break
+            body = b': heartbeat\n\n' if item is HEARTBEAT else encode(item)
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    except OSError:
+        # the client went away while we were writing
+        pass
+    finally:
+        watcher.cancel()
+        broker.unsubscribe(subscription)
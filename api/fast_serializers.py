@@ -0,0 +1,262 @@
+from django.core.files.storage import default_storage
+from rest_framework import serializers
+
+from .models import Book, Image, Exchange
+from .selection import Selection, BOOK, SALE, EXCHANGE
+
+# Read-only serialization of the list endpoints straight from values() rows. The output is the same
+# as BookSerializer's, ListingSerializer's, SaleSerializer's and ExchangeSerializer's, without going
+# through DRF's fields for every attribute of every row. Scalar conversions reuse DRF's own fields,
+# so prices and dates are formatted exactly the same.
+# Only the columns, joins and queries of the fields in the selection (see api.selection) are loaded.
+
+price_field = serializers.DecimalField(10, 2)
+date_field = serializers.DateField()
+
+# the values() columns of every attribute a book is serialized from, on books and on their listings.
+# Listings carry their images, books load them with one more query
+BOOK_COLUMNS = {
+    'id': 'id', 'name': 'name', 'edition': 'edition', 'preservation_level': 'preservation_level',
+    'for_sale': 'for_sale', 'for_exchange': 'for_exchange', 'price': 'current_price', 'date_published': 'date_published',
+    'owner_id': 'original_owner_id', 'owner_first_name': 'original_owner__first_name',
+    'owner_last_name': 'original_owner__last_name', 'owner_email': 'original_owner__django_user__email',
+    'owner_city': 'original_owner__city__name',
+    'author_id': 'author_id', 'author_first_name': 'author__first_name', 'author_last_name': 'author__last_name',
+    'genre': 'genre__name',
+}
+
+LISTING_COLUMNS = {
+    'id': 'book_id', 'name': 'name', 'edition': 'edition', 'preservation_level': 'preservation_level',
+    'for_sale': 'for_sale', 'for_exchange': 'for_exchange', 'price': 'price', 'date_published': 'date_published',
+    'owner_id': 'owner_id', 'owner_first_name': 'owner_first_name', 'owner_last_name': 'owner_last_name',
+    'owner_email': 'owner_email', 'owner_city': 'owner_city',
+    'author_id': 'author_id', 'author_first_name': 'author_first_name', 'author_last_name': 'author_last_name',
+    'genre': 'genre', 'images': 'images',
+}
+
+# the attributes every field of a book needs, and those of relations shown as their id
+BOOK_ATTRIBUTES = {
+    'name': ('name',),
+    'original_owner': ('owner_id', 'owner_first_name', 'owner_last_name', 'owner_email', 'owner_city'),
+    'author': ('author_id', 'author_first_name', 'author_last_name'),
+    'genre': ('genre',),
+    'edition': ('edition',),
+    'preservation_level': ('preservation_level',),
+    'image_set': ('images',),
+    'images': ('images',),
+    'id': ('id',),
+    'for_sale': ('for_sale',),
+    'price': ('price',),
+    'for_exchange': ('for_exchange',),
+}
+COLLAPSED_ATTRIBUTES = {'original_owner': ('owner_id',), 'author': ('author_id',)}
+
+USER_VALUES = ('{}_id', '{}__first_name', '{}__last_name', '{}__django_user__email', '{}__city__name')
+
+def price(value):
+    return None if value is None else price_field.to_representation(value)
+
+def date(value):
+    return None if value is None else date_field.to_representation(value)
+
+def file_url(name, request=None):
+    # the same as ImageSerializer's image fields
+    if not name:
+        return None
+    url = default_storage.url(name)
+    return request.build_absolute_uri(url) if request is not None else url
+
+def image_dict(image, request=None):
+    return {
+        'id': image['id'],
+        'image': file_url(image['image'], request),
+        'thumbnail': file_url(image['thumbnail'], request),
+        'webp': file_url(image['webp'], request),
+        'avif': file_url(image['avif'], request),
+        'book': image['book'],
+    }
+
+def column(key):
+    return lambda row: row[key]
+
+def book_columns(selection, columns):
+    '''
+    The values() columns of the fields in the selection, plus the id and the ordering of the pagination
+    '''
+    attributes = {'id', 'date_published'}
+    for name in selection.included():
+        if name in COLLAPSED_ATTRIBUTES and not selection.expands(name):
+            attributes.update(COLLAPSED_ATTRIBUTES[name])
+        else:
+            attributes.update(BOOK_ATTRIBUTES[name])
+    return [value for attribute, value in columns.items() if attribute in attributes]
+
+def book_fields(selection, columns, images_of, request=None):
+    '''
+    (name, getter) pairs of the book fields in the selection, in BookSerializer's order.
+    The getters read values() rows with the given columns
+    '''
+    c = columns
+    getters = {
+        'name': column(c['name']),
+        'genre': column(c['genre']),
+        'edition': column(c['edition']),
+        'preservation_level': column(c['preservation_level']),
+        'image_set': lambda row: [image['id'] for image in images_of(row)],
+        'images': lambda row: [image_dict(image, request) for image in images_of(row)],
+        'id': column(c['id']),
+        'for_sale': column(c['for_sale']),
+        'price': lambda row: price(row[c['price']]),
+        'for_exchange': column(c['for_exchange']),
+    }
+    if selection.expands('original_owner'):
+        getters['original_owner'] = lambda row: {
+            'id': row[c['owner_id']],
+            'first_name': row[c['owner_first_name']],
+            'last_name': row[c['owner_last_name']],
+            'email': row[c['owner_email']],
+            'city': row[c['owner_city']],
+        }
+    else:
+        getters['original_owner'] = column(c['owner_id'])
+    if selection.expands('author'):
+        getters['author'] = lambda row: {
+            'first_name': row[c['author_first_name']],
+            'last_name': row[c['author_last_name']],
+            'id': row[c['author_id']],
+        }
+    else:
+        getters['author'] = column(c['author_id'])
+    return [(name, getters[name]) for name in selection.included()]
+
+def book_values(queryset=None, selection=None, *extra):
+    '''
+    The rows serialize_books needs for the selection, with the extra columns (e.g. a search rank)
+    '''
+    if queryset is None:
+        queryset = Book.objects.all()
+    return queryset.values(*book_columns(selection or Selection(BOOK), BOOK_COLUMNS), *extra)
+
+def serialize_books(rows, request=None, selection=None):
+    '''
+    Serializes book_values rows like BookSerializer, with one more query for all of their images
+    when the selection includes them
+    '''
+    selection = selection or Selection(BOOK)
+    images = {}
+    if rows and (selection.includes('images') or selection.includes('image_set')):
+        queryset = Image.objects.filter(book_id__in=[row['id'] for row in rows]).order_by('id')
+        values = ('id', 'image', 'thumbnail', 'webp', 'avif', 'book') if selection.includes('images') else ('id', 'book')
+        for image in queryset.values(*values):
+            images.setdefault(image['book'], []).append(image)
+    fields = book_fields(selection, BOOK_COLUMNS, lambda row: images.get(row['id'], ()), request)
+    return [{name: get(row) for name, get in fields} for row in rows]
+
+def listing_values(queryset, selection=None):
+    return queryset.values(*book_columns(selection or Selection(BOOK), LISTING_COLUMNS))
+
+def serialize_listings(rows, request=None, selection=None):
+    '''
+    Serializes listing_values rows like ListingSerializer, without any query
+    '''
+    fields = book_fields(selection or Selection(BOOK), LISTING_COLUMNS, lambda row: row['images'], request)
+    return [{name: get(row) for name, get in fields} for row in rows]
+
+def books_by_id(ids, request=None, selection=None):
+    ids = {book_id for book_id in ids if book_id is not None}
+    if not ids:
+        return {}
+    rows = list(book_values(Book.objects.filter(pk__in=ids), selection))
+    return {row['id']: book for row, book in zip(rows, serialize_books(rows, request, selection))}
+
+def user_dict(row, prefix):
+    if row[f'{prefix}_id'] is None:
+        return None
+    return {
+        'id': row[f'{prefix}_id'],
+        'first_name': row[f'{prefix}__first_name'],
+        'last_name': row[f'{prefix}__last_name'],
+        'email': row[f'{prefix}__django_user__email'],
+        'city': row[f'{prefix}__city__name'],
+    }
+
+def serialize_sales(queryset, request=None, selection=None):
+    '''
+    Serializes sales like SaleSerializer, in at most three queries: the sales with their buyers,
+    their books, and the images
+    '''
+    selection = selection or Selection(SALE)
+    values = []
+    getters = {}
+    books = {}
+    if selection.includes('book'):
+        values.append('book_id')
+        getters['book'] = (lambda row: books[row['book_id']]) if selection.expands('book') else column('book_id')
+    if selection.includes('buyer'):
+        if selection.expands('buyer'):
+            values.extend(value.format('buyer') for value in USER_VALUES)
+            getters['buyer'] = lambda row: user_dict(row, 'buyer')
+        else:
+            values.append('buyer_id')
+            getters['buyer'] = column('buyer_id')
+    if selection.includes('status'):
+        values.append('status__name')
+        getters['status'] = lambda row: {'name': row['status__name']}
+    for name in ('date_published', 'date_sold'):
+        if selection.includes(name):
+            values.append(name)
+            getters[name] = lambda row, name=name: date(row[name])
+    if selection.includes('price'):
+        values.append('price')
+        getters['price'] = lambda row: price(row['price'])
+
+    rows = list(queryset.values(*values))
+    if selection.includes('book') and selection.expands('book'):
+        books = books_by_id([row['book_id'] for row in rows], request, selection.nested('book'))
+    fields = [(name, getters[name]) for name in selection.included()]
+    return [{name: get(row) for name, get in fields} for row in rows]
+
+def serialize_exchanges(queryset, request=None, selection=None):
+    '''
+    Serializes exchanges like ExchangeSerializer, in at most three queries: the exchanges,
+    both of their books, and the images
+    '''
+    selection = selection or Selection(EXCHANGE)
+    values = []
+    getters = {}
+    books = {}
+    expanded = []
+    for name in ('id', 'version'):
+        if selection.includes(name):
+            values.append(name)
+            getters[name] = column(name)
+    for name in ('book_offered', 'book_returned'):
+        if selection.includes(name):
+            values.append(f'{name}_id')
+            if selection.expands(name):
+                expanded.append(name)
+                getters[name] = lambda row, name=name, key=f'{name}_id': books[name].get(row[key])
+            else:
+                getters[name] = column(f'{name}_id')
+    if selection.includes('status'):
+        values.append('state')
+        getters['status'] = lambda row: {'name': Exchange.State(row['state']).label}
+    for name in ('date_published', 'date_exchanged'):
+        if selection.includes(name):
+            values.append(name)
+            getters[name] = lambda row, name=name: date(row[name])
+
+    rows = list(queryset.values(*values))
+    if len(expanded) == 2 and selection.nested('book_offered') == selection.nested('book_returned'):
+        # both books with the same fields, in one go
+        shared = books_by_id(
+            [row[f'{name}_id'] for row in rows for name in expanded], request, selection.nested('book_offered'),
+        )
+        books = {name: shared for name in expanded}
+    else:
+        books = {
+            name: books_by_id([row[f'{name}_id'] for row in rows], request, selection.nested(name))
+            for name in expanded
+        }
+    fields = [(name, getters[name]) for name in selection.included()]
+    return [{name: get(row) for name, get in fields} for row in rows]
@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+
+from .models import Book, Image
+from .listings import refresh_listing_images
+from .jobs import task, enqueue
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_DIR = 'derivatives'
+
+def avif_supported():
+    from PIL import Image as PILImage
+    PILImage.init()
+    return 'AVIF' in PILImage.SAVE
+
+def derivative_names(name):
+    '''
+    Storage names of the derivatives of an uploaded image, by Image field
+    '''
+    stem = os.path.splitext(name)[0]
+    names = {
+        'thumbnail': f'{DERIVATIVE_DIR}/{stem}_thumb.webp',
+        'webp': f'{DERIVATIVE_DIR}/{stem}.webp',
+    }
+    if avif_supported():
+        names['avif'] = f'{DERIVATIVE_DIR}/{stem}.avif'
+    return names
+
+def render_derivatives(source, targets, thumbnail_size, quality):
+    '''
+    Writes a fixed size thumbnail and full size WebP/AVIF versions of the source image.
+    Runs in a worker process, so it only touches files and never the database.
+    '''
+    from PIL import Image as PILImage, ImageOps
+
+    with PILImage.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+        for path in targets.values():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        ImageOps.fit(image, thumbnail_size).save(targets['thumbnail'], 'WEBP', quality=quality)
+        image.save(targets['webp'], 'WEBP', quality=quality)
+        if 'avif' in targets:
+            image.save(targets['avif'], 'AVIF', quality=quality)
+    return os.path.getsize(source)
+
+class DerivativePool:
+    '''
+    A bounded pool of processes that render image derivatives, so uWSGI workers never
+    block on Pillow. When more than IMAGE_DERIVATIVE_QUEUE_SIZE images are waiting, or rendering
+    fails, the image is left to a background job (render_image).
+    The processes are started on first use in each uWSGI worker, after it was forked.
+    '''
+    def __init__(self):
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = None
+
+    def executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # a pool inherited through fork() has no processes of its own
+                self._executor = ProcessPoolExecutor(max_workers=settings.IMAGE_DERIVATIVE_WORKERS)
+                self._slots = threading.BoundedSemaphore(settings.IMAGE_DERIVATIVE_QUEUE_SIZE)
+                self._pid = os.getpid()
+            return self._executor, self._slots
+
+    def reset(self, executor):
+        '''
+        Drops an executor that can't take work anymore, the next submit starts a new one
+        '''
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def submit(self, image):
+        executor, slots = self.executor()
+        if not slots.acquire(blocking=False):
+            logger.warning('image derivative queue is full, leaving image %d to a job', image.pk)
+            enqueue_render(image)
+            return None
+        names = derivative_names(image.image.name)
+        targets = {field: default_storage.path(name) for field, name in names.items()}
+        try:
+            future = executor.submit(
+                render_derivatives, image.image.path, targets,
+                settings.IMAGE_THUMBNAIL_SIZE, settings.IMAGE_DERIVATIVE_QUALITY,
+            )
+        except Exception:
+            # e.g. BrokenProcessPool once a process died, a new pool is started for the next image
+            slots.release()
+            logger.exception('could not render derivatives of image %d, leaving it to a job', image.pk)
+            self.reset(executor)
+            enqueue_render(image)
+            return None
+        future.add_done_callback(lambda future: self.done(future, slots, image, names))
+        return future
+
+    def done(self, future, slots, image, names):
+        slots.release()
+        try:
+            future.result()
+            store_derivatives(image.pk, image.book_id, names)
+        except Exception:
+            logger.exception('could not render derivatives of image %d, leaving it to a job', image.pk)
+            enqueue_render(image)
+        finally:
+            # callbacks run on the pool's own thread, which shouldn't hold a connection open
+            connection.close()
+
+pool = DerivativePool()
+
+def store_derivatives(pk, book_id, names):
+    Image.objects.filter(pk=pk).update(**names)
+    Book.objects.filter(pk=book_id).touch()
+    refresh_listing_images([book_id])
+
+@task
+def render_image(image_id, name):
+    '''
+    Renders the derivatives of an image in the job worker, unless the image has been replaced since
+    '''
+    image = Image.objects.filter(pk=image_id, image=name).only('id', 'image', 'book').first()
+    if image is None:
+        return
+    names = derivative_names(name)
+    targets = {field: default_storage.path(target) for field, target in names.items()}
+    render_derivatives(image.image.path, targets, settings.IMAGE_THUMBNAIL_SIZE, settings.IMAGE_DERIVATIVE_QUALITY)
+    store_derivatives(image.pk, image.book_id, names)
+
+def enqueue_render(image):
+    name = image.image.name
+    enqueue(render_image, key=f'render_image:{image.pk}:{name}', image_id=image.pk, name=name)
+
+def image_saved(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'image' not in update_fields:
+        return
+    if instance.image:
+        transaction.on_commit(lambda: pool.submit(instance))
+
+def connect_signals():
+    post_save.connect(image_saved, sender=Image)
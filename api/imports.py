@@ -0,0 +1,221 @@
+import csv
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+
+from .models import Author, Genre, Book, Sale, Exchange
+from .reference import statuses, authors as author_cache, genres as genre_cache
+from .caching import invalidate_response
+from .search import refresh_search_documents
+from .listings import refresh_listings
+
+# columns of a CSV import, JSON imports use the same keys
+COLUMNS = ['name', 'author', 'genre', 'edition', 'preservation_level', 'for_sale', 'price', 'for_exchange']
+
+# lookups of names are split into chunks so the IN lists stay within database limits
+LOOKUP_CHUNK_SIZE = 500
+
+class ImportTooLarge(Exception):
+    pass
+
+def read_csv(lines):
+    '''
+    Yields the rows of a CSV import as dicts, the first line naming the columns
+    '''
+    for row in csv.DictReader(lines):
+        yield {key.strip(): value for key, value in row.items() if key is not None}
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in ('true', '1', 'yes')
+
+def reference(value):
+    '''
+    An author or genre is either given by id, or by name
+    '''
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value, None
+    value = str(value or '').strip()
+    if value.isdigit():
+        return int(value), None
+    return None, value
+
+def clean_row(row):
+    '''
+    Validates one imported row, and returns the cleaned values and a dict of errors by field
+    '''
+    if not isinstance(row, dict):
+        return None, {'row': 'Every row has to be an object.'}
+    errors = {}
+    cleaned = {}
+
+    name = str(row.get('name') or '').strip()
+    if not name or len(name) > 100:
+        errors['name'] = 'A name of at most 100 characters is required.'
+    cleaned['name'] = name
+
+    author_id, author_name = reference(row.get('author'))
+    if author_name is not None:
+        first_name, _, last_name = author_name.rpartition(' ')
+        if not first_name or len(first_name) > 50 or len(last_name) > 50:
+            errors['author'] = 'Provide the id of an author, or their first and last name.'
+        cleaned['author'] = (first_name.strip(), last_name)
+    else:
+        cleaned['author'] = author_id
+
+    genre_id, genre_name = reference(row.get('genre'))
+    if genre_name is not None and (not genre_name or len(genre_name) > 50):
+        errors['genre'] = 'Provide the id or the name of a genre.'
+    cleaned['genre'] = genre_id if genre_name is None else genre_name
+
+    edition = str(row.get('edition') or '').strip()
+    if not edition or len(edition) > 4:
+        errors['edition'] = 'An edition of at most 4 characters is required.'
+    cleaned['edition'] = edition
+
+    try:
+        cleaned['preservation_level'] = int(row.get('preservation_level'))
+    except (TypeError, ValueError):
+        errors['preservation_level'] = 'The preservation level has to be a number.'
+
+    cleaned['for_sale'] = parse_bool(row.get('for_sale'))
+    cleaned['for_exchange'] = parse_bool(row.get('for_exchange'))
+    cleaned['price'] = None
+    if cleaned['for_sale']:
+        try:
+            cleaned['price'] = Decimal(str(row.get('price'))).quantize(Decimal('0.01'))
+            if cleaned['price'] < 0 or cleaned['price'] >= 10 ** 8:
+                raise InvalidOperation()
+        except (InvalidOperation, ValueError):
+            errors['price'] = 'Books for sale need a valid price.'
+    return cleaned, errors
+
+def chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def resolve_authors(rows, errors):
+    '''
+    Replaces author ids and names of the rows by existing authors' ids, creating the missing ones.
+    Returns whether any author was created
+    '''
+    ids = {row['author'] for row in rows.values() if isinstance(row['author'], int)}
+    names = {row['author'] for row in rows.values() if isinstance(row['author'], tuple)}
+
+    existing_ids = set()
+    for chunk in chunks(ids, LOOKUP_CHUNK_SIZE):
+        existing_ids.update(Author.objects.filter(id__in=chunk).values_list('id', flat=True))
+    found = {}
+    for chunk in chunks(names, LOOKUP_CHUNK_SIZE):
+        candidates = Author.objects.filter(
+            first_name__in={first for first, last in chunk}, last_name__in={last for first, last in chunk},
+        ).values('first_name', 'last_name').annotate(id=Min('id'))
+        for author in candidates:
+            found[author['first_name'], author['last_name']] = author['id']
+
+    missing = [Author(first_name=first, last_name=last) for first, last in names if (first, last) not in found]
+    for author in Author.objects.bulk_create(missing, batch_size=settings.BOOK_IMPORT_BATCH_SIZE):
+        found[author.first_name, author.last_name] = author.id
+
+    for index, row in list(rows.items()):
+        if isinstance(row['author'], tuple):
+            row['author'] = found[row['author']]
+        elif row['author'] not in existing_ids:
+            errors.setdefault(index, {})['author'] = f'There is no author with id {row["author"]}.'
+            del rows[index]
+    return bool(missing)
+
+def resolve_genres(rows, errors):
+    '''
+    Like resolve_authors, for genres
+    '''
+    ids = {row['genre'] for row in rows.values() if isinstance(row['genre'], int)}
+    names = {row['genre'] for row in rows.values() if isinstance(row['genre'], str)}
+
+    existing_ids = set()
+    for chunk in chunks(ids, LOOKUP_CHUNK_SIZE):
+        existing_ids.update(Genre.objects.filter(id__in=chunk).values_list('id', flat=True))
+    found = {}
+    for chunk in chunks(names, LOOKUP_CHUNK_SIZE):
+        for genre in Genre.objects.filter(name__in=chunk).values('name').annotate(id=Min('id')):
+            found[genre['name']] = genre['id']
+
+    missing = [Genre(name=name) for name in names if name not in found]
+    for genre in Genre.objects.bulk_create(missing, batch_size=settings.BOOK_IMPORT_BATCH_SIZE):
+        found[genre.name] = genre.id
+
+    for index, row in list(rows.items()):
+        if isinstance(row['genre'], str):
+            row['genre'] = found[row['genre']]
+        elif row['genre'] not in existing_ids:
+            errors.setdefault(index, {})['genre'] = f'There is no genre with id {row["genre"]}.'
+            del rows[index]
+    return bool(missing)
+
+def import_books(rows, owner, batch_size=None):
+    '''
+    Imports an iterable of rows (dicts with the COLUMNS keys) as books of the given user,
+    listed for sale and/or exchange. Invalid rows are skipped and reported by their index.
+    Authors and genres are looked up in batches and created when missing, and the rows
+    are inserted with bulk_create in chunks of BOOK_IMPORT_BATCH_SIZE, all in one transaction.
+    '''
+    batch_size = batch_size or settings.BOOK_IMPORT_BATCH_SIZE
+    cleaned_rows = {}
+    errors = {}
+    for index, row in enumerate(rows):
+        if index >= settings.BOOK_IMPORT_MAX_ROWS:
+            raise ImportTooLarge(f'At most {settings.BOOK_IMPORT_MAX_ROWS} books can be imported at once.')
+        cleaned, row_errors = clean_row(row)
+        if row_errors:
+            errors[index] = row_errors
+        else:
+            cleaned_rows[index] = cleaned
+
+    available = statuses.get(name='AVAILABLE')
+    created = []
+    with transaction.atomic():
+        authors_created = resolve_authors(cleaned_rows, errors)
+        genres_created = resolve_genres(cleaned_rows, errors)
+
+        for chunk in chunks(cleaned_rows.values(), batch_size):
+            # bulk_create skips Book.save, so the derived columns are set here
+            books = Book.objects.bulk_create([
+                Book(
+                    name=row['name'],
+                    original_owner=owner,
+                    author_id=row['author'],
+                    genre_id=row['genre'],
+                    edition=row['edition'],
+                    preservation_level=row['preservation_level'],
+                    for_sale=row['for_sale'],
+                    current_price=row['price'],
+                    for_exchange=row['for_exchange'],
+                )
+                for row in chunk
+            ])
+            Sale.objects.bulk_create([
+                Sale(book=book, status=available, price=row['price'])
+                for book, row in zip(books, chunk) if row['for_sale']
+            ])
+            Exchange.objects.bulk_create([
+                Exchange(book_offered=book)
+                for book, row in zip(books, chunk) if row['for_exchange']
+            ])
+            imported = Book.objects.filter(pk__in=[book.pk for book in books])
+            refresh_search_documents(imported)
+            refresh_listings(imported)
+            created.extend(books)
+
+    # bulk_create sends no signals, so the caches of authors and genres are cleared here
+    if authors_created:
+        author_cache.invalidate()
+        invalidate_response('authors')
+    if genres_created:
+        genre_cache.invalidate()
+        invalidate_response('genres')
+
+    return created, [{'row': index, 'errors': row_errors} for index, row_errors in sorted(errors.items())]
@@ -0,0 +1,117 @@
+import contextvars
+import json
+import logging
+import random
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.utils import timezone
+
+logger = logging.getLogger('api.requests')
+
+# metrics of the request being served, copied into the threads that run its view
+current = contextvars.ContextVar('request_metrics', default=None)
+
+class RequestMetrics:
+    '''
+    Counters of one request. Query count, database and serialization time are always kept,
+    the SQL itself only for sampled requests
+    '''
+    __slots__ = ('started', 'sampled', 'queries', 'db_time', 'render_time', 'render_started', 'sql')
+
+    def __init__(self, sampled):
+        self.started = time.perf_counter()
+        self.sampled = sampled
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.render_started = None
+        self.sql = [] if sampled else None
+
+    def start_render(self):
+        self.render_started = time.perf_counter()
+
+    def end_render(self):
+        if self.render_started is not None:
+            self.render_time += time.perf_counter() - self.render_started
+            self.render_started = None
+
+def start_request():
+    metrics = RequestMetrics(random.random() < settings.INSTRUMENTATION_SAMPLE_RATE)
+    return metrics, current.set(metrics)
+
+def record_query(execute, sql, params, many, context):
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.queries += 1
+        metrics.db_time += elapsed
+        if metrics.sql is not None:
+            metrics.sql.append((sql, elapsed))
+
+def install(connection, **kwargs):
+    # connection_created is sent again on every reconnect of the same wrapper
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+def render(response):
+    '''
+    Renders a DRF response, counting the time as serialization
+    '''
+    metrics = current.get()
+    if metrics is not None:
+        metrics.start_render()
+    response.render()
+    if metrics is not None:
+        metrics.end_render()
+
+def server_timing(metrics, total):
+    return (
+        f'db;dur={metrics.db_time * 1000:.1f};desc="{metrics.queries} queries", '
+        f'serialize;dur={metrics.render_time * 1000:.1f}, '
+        f'total;dur={total * 1000:.1f}'
+    )
+
+def log_request(request, response, metrics, total):
+    '''
+    Writes a JSON line for sampled requests and for requests over the query or latency budget
+    '''
+    over_queries = metrics.queries > settings.INSTRUMENTATION_QUERY_BUDGET
+    over_latency = total * 1000 > settings.INSTRUMENTATION_LATENCY_BUDGET
+    if not (metrics.sampled or over_queries or over_latency):
+        return
+    match = getattr(request, 'resolver_match', None)
+    record = {
+        'time': timezone.now().isoformat(),
+        'method': request.method,
+        'path': request.path,
+        'route': match.route if match else None,
+        'status': response.status_code,
+        'total_ms': round(total * 1000, 2),
+        'db_ms': round(metrics.db_time * 1000, 2),
+        'serialize_ms': round(metrics.render_time * 1000, 2),
+        'queries': metrics.queries,
+        'over_query_budget': over_queries,
+        'over_latency_budget': over_latency,
+        'sampled': metrics.sampled,
+    }
+    if metrics.sql is not None:
+        slowest = sorted(metrics.sql, key=lambda query: query[1], reverse=True)[:5]
+        record['slowest_queries'] = [{'sql': sql[:500], 'ms': round(elapsed * 1000, 2)} for sql, elapsed in slowest]
+        # the same statement run many times in one request is usually a missing select/prefetch_related
+        record['repeated_queries'] = [
+            {'sql': sql[:500], 'count': count}
+            for sql, count in Counter(sql for sql, elapsed in metrics.sql).most_common(3) if count > 1
+        ]
+    level = logging.WARNING if over_queries or over_latency else logging.INFO
+    logger.log(level, json.dumps(record))
+
+def connect_signals():
+    connection_created.connect(install)
@@ -0,0 +1,187 @@
+import logging
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Max, Min, Q, Sum
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# A durable queue of background work, kept in the Job table of the default database.
+# Code enqueues a run of a task, and manage.py run_jobs claims due jobs one at a time with
+# SELECT ... FOR UPDATE SKIP LOCKED, so any number of worker threads and processes share the
+# queue without waiting on each other. Failed jobs are retried with an exponential backoff
+# up to JOB_MAX_ATTEMPTS times. A job is run at least once, tasks have to be idempotent.
+
+tasks = {}
+
+def task_name(function):
+    return f'{function.__module__}.{function.__name__}'
+
+def task(function):
+    '''
+    Registers the function as a task that jobs can run, with their arguments as keyword arguments
+    '''
+    tasks[task_name(function)] = function
+    return function
+
+def enqueue(function, key=None, delay=None, **arguments):
+    '''
+    Queues a run of the task with the given (JSON) arguments, after `delay` seconds. The job is written
+    in the current transaction, so workers only see it once the transaction commits and a rollback
+    drops it too. Nothing is queued while a job with the same key is kept (JOB_RETENTION_DAYS)
+    '''
+    name = task_name(function)
+    if tasks.get(name) is not function:
+        raise ValueError(f'{name} is not registered as a task')
+    now = timezone.now()
+    Job.objects.bulk_create([Job(
+        task=name, arguments=arguments, key=key, created_at=now,
+        run_at=now + timedelta(seconds=delay or 0),
+    )], ignore_conflicts=True)
+
+def claim():
+    '''
+    Claims the next due job: a queued one, or a running one whose worker's lease ran out.
+    Returns None when no job is due
+    '''
+    due = Q(state__in=(Job.State.QUEUED, Job.State.RUNNING))
+    while True:
+        now = timezone.now()
+        with transaction.atomic():
+            row = Job.objects.select_for_update(skip_locked=True).filter(due, run_at__lte=now).order_by('run_at').values_list(
+                'pk', 'task', 'arguments', 'attempts',
+            ).first()
+            if row is None:
+                return None
+            pk, name, arguments, attempts = row
+            # backends without row locks (SQLite) may hand the same job to two workers,
+            # only the one whose UPDATE still matches it gets it
+            claimed = Job.objects.filter(due, pk=pk, run_at__lte=now).update(
+                state=Job.State.RUNNING, attempts=attempts + 1, started_at=now,
+                run_at=now + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+            )
+        if claimed:
+            return Job(pk=pk, task=name, arguments=arguments, attempts=attempts + 1, started_at=now)
+
+def backoff(attempts):
+    return min(settings.JOB_RETRY_DELAY_SECONDS * 2 ** (attempts - 1), settings.JOB_RETRY_MAX_DELAY_SECONDS)
+
+def run(job):
+    '''
+    Runs a claimed job and records how it went. When the job was claimed again by another worker
+    in the meantime (its lease ran out), the result of this run is dropped
+    '''
+    ours = Job.objects.filter(pk=job.pk, attempts=job.attempts, state=Job.State.RUNNING)
+    function = tasks.get(job.task)
+    if function is None:
+        logger.error('job %d has an unknown task %s', job.pk, job.task)
+        ours.update(state=Job.State.FAILED, finished_at=timezone.now(), error=f'Unknown task {job.task}')
+        return False
+    try:
+        function(**job.arguments)
+    except Exception:
+        error = traceback.format_exc()
+        now = timezone.now()
+        if job.attempts >= settings.JOB_MAX_ATTEMPTS:
+            logger.exception('job %d (%s) failed for good after %d attempts', job.pk, job.task, job.attempts)
+            ours.update(state=Job.State.FAILED, finished_at=now, error=error)
+        else:
+            delay = backoff(job.attempts)
+            logger.warning('job %d (%s) failed, retrying in %ds', job.pk, job.task, delay, exc_info=True)
+            ours.update(state=Job.State.QUEUED, run_at=now + timedelta(seconds=delay), error=error)
+        return False
+    ours.update(state=Job.State.DONE, finished_at=timezone.now(), error='')
+    return True
+
+def work(stopping, poll=None, burst=False):
+    '''
+    The loop of a worker thread: runs due jobs until `stopping` (a threading.Event) is set,
+    or until none is due when `burst` is set
+    '''
+    poll = poll or settings.JOB_POLL_SECONDS
+    try:
+        while not stopping.is_set():
+            close_old_connections()
+            try:
+                job = claim()
+                if job is not None:
+                    run(job)
+                    continue
+            except DatabaseError:
+                logger.exception('could not run jobs, trying again in %ss', poll)
+            else:
+                if burst:
+                    return
+            stopping.wait(poll)
+    finally:
+        connection.close()
+
+def purge(retention_days=None, batch_size=10000):
+    '''
+    Removes jobs that finished more than JOB_RETENTION_DAYS ago, with their keys. Returns how many
+    '''
+    cutoff = timezone.now() - timedelta(days=retention_days or settings.JOB_RETENTION_DAYS)
+    finished = Job.objects.filter(state__in=(Job.State.DONE, Job.State.FAILED), finished_at__lt=cutoff)
+    removed = 0
+    while True:
+        ids = list(finished.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return removed
+        removed += Job.objects.filter(pk__in=ids).delete()[0]
+
+def milliseconds(duration):
+    return None if duration is None else round(duration.total_seconds() * 1000, 1)
+
+def job_stats(window=None):
+    '''
+    Per task: the jobs waiting and running now, and of the jobs that finished in the last `window`
+    seconds (JOB_STATS_WINDOW_SECONDS) how many were done and failed, how many retries they took,
+    and their latency from being queued to finishing
+    '''
+    now = timezone.now()
+    window = window or settings.JOB_STATS_WINDOW_SECONDS
+    due = Q(run_at__lte=now)
+    queued = {}
+    oldest = None
+    for row in Job.objects.filter(state__in=(Job.State.QUEUED, Job.State.RUNNING)).values('task').annotate(
+        due=Count('pk', filter=due),
+        scheduled=Count('pk', filter=Q(state=Job.State.QUEUED, run_at__gt=now)),
+        running=Count('pk', filter=Q(state=Job.State.RUNNING, run_at__gt=now)),
+        oldest_due=Min('run_at', filter=due),
+    ).order_by('task'):
+        queued[row['task']] = {'due': row['due'], 'scheduled': row['scheduled'], 'running': row['running']}
+        if row['oldest_due'] is not None:
+            oldest = row['oldest_due'] if oldest is None else min(oldest, row['oldest_due'])
+
+    latency = ExpressionWrapper(F('finished_at') - F('created_at'), output_field=DurationField())
+    run_time = ExpressionWrapper(F('finished_at') - F('started_at'), output_field=DurationField())
+    finished = {}
+    for row in Job.objects.filter(finished_at__gte=now - timedelta(seconds=window)).values('task').annotate(
+        done=Count('pk', filter=Q(state=Job.State.DONE)),
+        failed=Count('pk', filter=Q(state=Job.State.FAILED)),
+        retries=Sum(F('attempts') - 1),
+        latency_avg=Avg(latency),
+        latency_max=Max(latency),
+        run_avg=Avg(run_time),
+    ).order_by('task'):
+        finished[row['task']] = {
+            'done': row['done'],
+            'failed': row['failed'],
+            'retries': row['retries'],
+            'latency_avg_ms': milliseconds(row['latency_avg']),
+            'latency_max_ms': milliseconds(row['latency_max']),
+            'run_avg_ms': milliseconds(row['run_avg']),
+        }
+
+    return {
+        'queued': queued,
+        # how far behind the workers are
+        'oldest_due_seconds': None if oldest is None else round((now - oldest).total_seconds(), 1),
+        'window_seconds': window,
+        'finished': finished,
+    }
@@ -0,0 +1,248 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth.models import User as DjangoUser
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Prefetch, Q, prefetch_related_objects
+from django.db.models.signals import post_save, post_delete
+
+from .models import Book, Listing, ListingChange, Image, User, City, Author, Genre, deleting_books
+from .caching import partition_versions, invalidate_partitions, changed_at
+from .changes import record_changes
+
+# the fields of a listing compared by the consistency check, see listing_drift
+LISTING_FIELDS = [field.attname for field in Listing._meta.concrete_fields]
+
+def book_listing(queryset=None):
+    '''
+    Loads books together with everything BookSerializer needs, so that any number
+    of books is serialized using a fixed number of queries:
+    one for the books and their related rows, and one for their images.
+    Availability and price are kept on the book itself.
+    '''
+    if queryset is None:
+        queryset = Book.objects.all()
+    return queryset.select_related(
+        'original_owner__django_user',
+        'original_owner__city',
+        'author',
+        'genre',
+    ).prefetch_related(
+        'image_set',
+    )
+
+def available_books(queryset=None):
+    '''
+    Every book that is currently available for sale or exchange, each one listed once
+    '''
+    if queryset is None:
+        queryset = book_listing()
+    return queryset.filter(Q(for_sale=True) | Q(for_exchange=True))
+
+def book_prefetch(lookup):
+    '''
+    Prefetches books referenced by a foreign key (e.g. from sales or exchanges)
+    through the listing queryset
+    '''
+    return Prefetch(lookup, queryset=book_listing())
+
+def image_entries(images):
+    return [
+        {
+            'id': image.id,
+            'image': image.image.name,
+            'thumbnail': image.thumbnail.name,
+            'webp': image.webp.name,
+            'avif': image.avif.name,
+            'book': image.book_id,
+        }
+        for image in sorted(images, key=lambda image: image.id)
+    ]
+
+def listing_for(book):
+    '''
+    The listing of a book loaded through book_listing
+    '''
+    owner = book.original_owner
+    return Listing(
+        book_id=book.id,
+        name=book.name,
+        owner_id=owner.id,
+        owner_first_name=owner.first_name,
+        owner_last_name=owner.last_name,
+        owner_email=owner.django_user.email,
+        owner_city=owner.city.name,
+        city_id=owner.city_id,
+        author_id=book.author_id,
+        author_first_name=book.author.first_name,
+        author_last_name=book.author.last_name,
+        genre=book.genre.name,
+        edition=book.edition,
+        preservation_level=book.preservation_level,
+        date_published=book.date_published,
+        for_sale=book.for_sale,
+        for_exchange=book.for_exchange,
+        price=book.current_price,
+        images=image_entries(book.image_set.all()),
+    )
+
+def refresh_listings(books, removed=None):
+    '''
+    Rebuilds the listings of the given books (a queryset): the rows of books that are no longer
+    available are removed, and the available ones are written again from the books and their
+    related rows. Takes three to five queries however many books there are.
+    The changes go to the change feed, books that are no longer listed as the `removed` kind
+    (e.g. sold), unlisted by default.
+    '''
+    with transaction.atomic(savepoint=False):
+        previous = set(Listing.objects.filter(book__in=books.values('pk')).values_list('book_id', flat=True))
+        Listing.objects.filter(book__in=books.values('pk')).delete()
+        loaded = list(book_listing(Book.objects.filter(pk__in=books.values('pk'))).prefetch_related(None))
+        listed = [book for book in loaded if book.for_sale or book.for_exchange]
+        prefetch_related_objects(listed, 'image_set')
+        invalidate_listing_cache({book.original_owner.city_id for book in loaded})
+        listed_ids = {book.id for book in listed}
+        record_changes(listed_ids - previous, ListingChange.Kind.CREATED)
+        record_changes(listed_ids & previous, ListingChange.Kind.UPDATED)
+        record_changes(previous - listed_ids, removed or ListingChange.Kind.UNLISTED)
+        return Listing.objects.bulk_create([listing_for(book) for book in listed])
+
+def refresh_listing_images(book_ids):
+    '''
+    Rewrites only the images of the listings of the given books,
+    after an image was added, removed or got its derivatives
+    '''
+    listed = dict(Listing.objects.filter(book_id__in=book_ids).values_list('book_id', 'city_id'))
+    if not listed:
+        return
+    images = {}
+    for image in Image.objects.filter(book_id__in=listed):
+        images.setdefault(image.book_id, []).append(image)
+    Listing.objects.bulk_update(
+        [Listing(book_id=book_id, images=image_entries(images.get(book_id, []))) for book_id in listed],
+        ['images'], batch_size=500,
+    )
+    invalidate_listing_cache(set(listed.values()))
+    record_changes(list(listed), ListingChange.Kind.UPDATED)
+
+def listing_drift(book_ids):
+    '''
+    Compares the stored listings of the given books with the ones rebuilt from the books,
+    and returns the ids of books whose listing is missing, left over or out of date
+    '''
+    expected = {book.id: listing_for(book) for book in available_books().filter(pk__in=book_ids)}
+    stored = {listing.book_id: listing for listing in Listing.objects.filter(book_id__in=book_ids)}
+    drifted = []
+    for book_id in sorted(set(expected) | set(stored)):
+        if book_id not in expected or book_id not in stored:
+            drifted.append(book_id)
+        elif any(getattr(expected[book_id], name) != getattr(stored[book_id], name) for name in LISTING_FIELDS):
+            drifted.append(book_id)
+    return drifted
+
+def invalidate_listing_cache(city_ids=None):
+    '''
+    Drops the cached listing pages of the given cities and of all cities together,
+    or of every city when no cities are given, once the current transaction commits
+    '''
+    if city_ids is None:
+        partitions = ['listings']
+    elif city_ids:
+        partitions = ['listings:all'] + [f'listings:city:{city_id}' for city_id in city_ids]
+    else:
+        return
+    transaction.on_commit(lambda: invalidate_partitions(*partitions))
+
+def listing_page_key(request, city_id):
+    '''
+    Cache key of a page of listings of a city, or of all cities when city_id is None,
+    and the time the page last changed. Each city is its own partition,
+    so a write in one city leaves the pages of the others cached
+    '''
+    partition = 'listings:all' if city_id is None else f'listings:city:{city_id}'
+    versions = partition_versions('listings', partition)
+    url = hashlib.sha1(request.build_absolute_uri().encode()).hexdigest()
+    return f'response:{partition}:{":".join(versions)}:{url}', changed_at(versions)
+
+def user_city_key(user_id):
+    return f'listings:user-city:{user_id}'
+
+def user_city_id(user):
+    '''
+    The city of an api.models.User. Users built from token claims don't have it loaded,
+    it is then read from the cache and updated whenever the user is saved
+    '''
+    if 'city_id' not in user.get_deferred_fields():
+        return user.city_id
+    key = user_city_key(user.pk)
+    city_id = cache.get(key)
+    if city_id is None:
+        city_id = User.objects.filter(pk=user.pk).values_list('city_id', flat=True).first()
+        cache.set(key, city_id, settings.RESPONSE_CACHE_TIMEOUT)
+    return city_id
+
+def book_saved(sender, instance, created, **kwargs):
+    # a new book is only listed once it gets a sale or an exchange
+    if created and not (instance.for_sale or instance.for_exchange):
+        return
+    refresh_listings(Book.objects.filter(pk=instance.pk))
+
+def profile_saved(sender, instance, created, **kwargs):
+    cache.set(user_city_key(instance.pk), instance.city_id, settings.RESPONSE_CACHE_TIMEOUT)
+    if created:
+        return
+    # the cities the user's books are listed in before the update, in case the user moved
+    city_ids = set(Listing.objects.filter(owner_id=instance.pk).values_list('city_id', flat=True).distinct())
+    if city_ids:
+        Listing.objects.filter(owner_id=instance.pk).update(
+            owner_first_name=instance.first_name,
+            owner_last_name=instance.last_name,
+            owner_city=instance.city.name,
+            city_id=instance.city_id,
+        )
+        invalidate_listing_cache(city_ids | {instance.city_id})
+        record_changes(Listing.objects.filter(owner_id=instance.pk).values_list('book_id', flat=True), ListingChange.Kind.UPDATED)
+
+def django_user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and 'email' not in update_fields):
+        return
+    profile = User.objects.filter(django_user=instance).values_list('pk', 'city_id').first()
+    if profile and Listing.objects.filter(owner_id=profile[0]).update(owner_email=instance.email):
+        invalidate_listing_cache({profile[1]})
+        record_changes(Listing.objects.filter(owner_id=profile[0]).values_list('book_id', flat=True), ListingChange.Kind.UPDATED)
+
+def city_saved(sender, instance, created, **kwargs):
+    if not created and Listing.objects.filter(city_id=instance.pk).update(owner_city=instance.name):
+        invalidate_listing_cache({instance.pk})
+        record_changes(Listing.objects.filter(city_id=instance.pk).values_list('book_id', flat=True), ListingChange.Kind.UPDATED)
+
+def author_saved(sender, instance, created, **kwargs):
+    if created:
+        return
+    updated = Listing.objects.filter(author_id=instance.pk).update(
+        author_first_name=instance.first_name,
+        author_last_name=instance.last_name,
+    )
+    if updated:
+        invalidate_listing_cache()
+        record_changes(Listing.objects.filter(author_id=instance.pk).values_list('book_id', flat=True), ListingChange.Kind.UPDATED)
+
+def genre_saved(sender, instance, created, **kwargs):
+    if not created and Listing.objects.filter(book__genre=instance).update(genre=instance.name):
+        invalidate_listing_cache()
+        record_changes(Listing.objects.filter(book__genre=instance).values_list('book_id', flat=True), ListingChange.Kind.UPDATED)
+
+def image_changed(sender, instance, **kwargs):
+    if instance.book_id not in deleting_books.ids:
+        refresh_listing_images([instance.book_id])
+
+def connect_signals():
+    post_save.connect(book_saved, sender=Book)
+    post_save.connect(profile_saved, sender=User)
+    post_save.connect(django_user_saved, sender=DjangoUser)
+    post_save.connect(city_saved, sender=City)
+    post_save.connect(author_saved, sender=Author)
+    post_save.connect(genre_saved, sender=Genre)
+    post_save.connect(image_changed, sender=Image)
+    post_delete.connect(image_changed, sender=Image)
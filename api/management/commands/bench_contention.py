@@ -0,0 +1,103 @@
+import json
+import logging
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+
+from api.authentication import tokens_for
+from api.models import User, Book, Sale
+from api.reference import statuses
+from .bench_http import percentile
+
+class Command(BaseCommand):
+    help = '''Sends many simultaneous buy requests for one freshly listed book, in threads of this
+process, and checks that exactly one of them wins and the others get 409 Conflict. Repeats for
+--rounds listings and reports the latency of winners and losers. The listings are deleted afterwards.
+Meant for postgres, SQLite serializes every write anyway.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=50, help='Simultaneous requests per listing')
+        parser.add_argument('--rounds', type=int, default=10)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        # every loser would be logged as a 409 warning
+        logging.getLogger('django.request').setLevel(logging.ERROR)
+        seller = User.objects.filter(book__isnull=False).first()
+        buyers = list(
+            User.objects.exclude(pk=seller.pk).filter(book__isnull=False).select_related('django_user')
+            .distinct()[:options['buyers']]
+        ) if seller else []
+        if len(buyers) < options['buyers']:
+            raise CommandError(f'{options["buyers"] + 1} users with books are needed, fill the database with manage.py seed_data first')
+        tokens = {buyer.pk: 'Bearer ' + str(tokens_for(buyer.django_user).access_token) for buyer in buyers}
+        template = Book.objects.filter(original_owner=seller).first()
+
+        rounds = []
+        listings = []
+        try:
+            for _ in range(options['rounds']):
+                book = Book.objects.create(
+                    name='Contention benchmark', original_owner=seller, author_id=template.author_id,
+                    genre_id=template.genre_id, edition='1', preservation_level=3,
+                )
+                listings.append(book.pk)
+                Sale(book=book, status=statuses.get(name='AVAILABLE'), price=100).save()
+                rounds.append(self.run_round(book.pk, buyers, tokens))
+        finally:
+            Book.objects.filter(pk__in=listings).delete()
+
+        winners = [len(outcome['winners']) for outcome in rounds]
+        won = [latency for outcome in rounds for latency in outcome['winners']]
+        lost = [latency for outcome in rounds for latency in outcome['losers']]
+        other = {}
+        for outcome in rounds:
+            for code, count in outcome['other'].items():
+                other[code] = other.get(code, 0) + count
+        result = {
+            'buyers': options['buyers'],
+            'rounds': options['rounds'],
+            'winners_per_round': winners,
+            'winner_p50_ms': round(percentile(won, 0.50) * 1000, 1) if won else None,
+            'loser_p50_ms': round(percentile(lost, 0.50) * 1000, 1) if lost else None,
+            'loser_p99_ms': round(percentile(lost, 0.99) * 1000, 1) if lost else None,
+            'unexpected_status_codes': other,
+        }
+        self.stdout.write(json.dumps(result, indent=2))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(result, f, indent=2)
+        if any(count != 1 for count in winners) or other:
+            raise CommandError('Every listing must have exactly one winner and only conflicts otherwise')
+
+    def run_round(self, book_id, buyers, tokens):
+        barrier = threading.Barrier(len(buyers))
+        outcome = {'winners': [], 'losers': [], 'other': {}}
+        lock = threading.Lock()
+
+        def attempt(buyer):
+            client = Client(HTTP_HOST='127.0.0.1', raise_request_exception=False)
+            try:
+                barrier.wait()
+                started = time.perf_counter()
+                response = client.get(f'/books/{book_id}/buy/', HTTP_AUTHORIZATION=tokens[buyer.pk])
+                elapsed = time.perf_counter() - started
+                with lock:
+                    if response.status_code == 200:
+                        outcome['winners'].append(elapsed)
+                    elif response.status_code == 409:
+                        outcome['losers'].append(elapsed)
+                    else:
+                        outcome['other'][response.status_code] = outcome['other'].get(response.status_code, 0) + 1
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=attempt, args=(buyer,)) for buyer in buyers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcome
@@ -0,0 +1,151 @@
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Connection:
+    '''
+    A minimal keep-alive HTTP/1.1 client, so thousands of connections fit in one process
+    '''
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def get(self, path):
+        return await self.request('GET', path)
+
+    async def request(self, method, path, body=None):
+        '''
+        Sends a request, with an optional JSON body, and returns its status and body size
+        '''
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        head = f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nAccept: application/json\r\nConnection: keep-alive\r\n'
+        if body is not None:
+            body = json.dumps(body).encode()
+            head += f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n'
+        self.writer.write(head.encode() + b'\r\n' + (body or b''))
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            headers['connection'] = 'close'
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        return status, len(body)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+async def run_level(url, paths, concurrency, duration):
+    '''
+    Keeps `concurrency` connections busy for `duration` seconds and collects per request latencies
+    '''
+    parts = urlsplit(url)
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def client(number):
+        nonlocal errors
+        connection = Connection(parts.hostname, parts.port or 80)
+        i = number
+        while time.monotonic() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            started = time.monotonic()
+            try:
+                status, size = await connection.get(path)
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+                errors += 1
+                connection.close()
+                await asyncio.sleep(0.05)
+                continue
+            if status >= 400:
+                errors += 1
+            else:
+                latencies.append(time.monotonic() - started)
+        connection.close()
+
+    started = time.monotonic()
+    await asyncio.gather(*(client(number) for number in range(concurrency)))
+    elapsed = time.monotonic() - started
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+    }
+
+class Command(BaseCommand):
+    help = '''Compares requests/sec and p99 latency of running deployments, e.g. the WSGI (uwsgi.ini)
+and the ASGI (gunicorn-asgi.conf.py) one, at increasing numbers of concurrent connections:
+
+    uwsgi --http 127.0.0.1:8000 --http-keepalive --module bookujme.wsgi --processes 8 --enable-threads
+    gunicorn -k uvicorn.workers.UvicornWorker -w 4 -b 127.0.0.1:8001 bookujme.asgi:application
+    python manage.py bench_http --target wsgi=http://127.0.0.1:8000 --target asgi=http://127.0.0.1:8001'''
+
+    def create_parser(self, *args, **kwargs):
+        parser = super().create_parser(*args, **kwargs)
+        parser.formatter_class = argparse.RawDescriptionHelpFormatter
+        return parser
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', required=True, help='name=url of a running deployment')
+        parser.add_argument('--path', action='append', help='Paths to request, in turn (default: the read-only endpoints)')
+        parser.add_argument('--concurrency', default='100,250,500,1000', help='Comma separated numbers of connections')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per concurrency level')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        targets = []
+        for target in options['target']:
+            name, sep, url = target.partition('=')
+            if not sep:
+                raise CommandError(f'Targets look like name=url, got {target}')
+            targets.append((name, url.rstrip('/')))
+        paths = options['path'] or ['/books/', '/cities/', '/genres/', '/authors/']
+        levels = [int(level) for level in options['concurrency'].split(',')]
+
+        results = {}
+        self.stdout.write(f'{"target":<10}{"conns":>7}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"errors":>8}')
+        for name, url in targets:
+            results[name] = []
+            for level in levels:
+                result = asyncio.run(run_level(url, paths, level, options['duration']))
+                results[name].append(result)
+                self.stdout.write(
+                    f'{name:<10}{level:>7}{result["requests_per_second"]:>10}'
+                    f'{str(result["p50_ms"]):>10}{str(result["p99_ms"]):>10}{result["errors"]:>8}'
+                )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'paths': paths, 'duration': options['duration'], 'results': results}, f, indent=2)
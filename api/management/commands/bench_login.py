@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand
+
+from .bench_http import Connection, percentile
+
+async def run_level(url, credentials, logins, browsers, duration):
+    '''
+    Keeps `logins` connections logging in and `browsers` connections reading /books/ for `duration` seconds
+    '''
+    parts = urlsplit(url)
+    login_latencies = []
+    books_latencies = []
+    busy = errors = 0
+    deadline = time.monotonic() + duration
+
+    async def client(send, latencies):
+        nonlocal busy, errors
+        connection = Connection(parts.hostname, parts.port or 80)
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            try:
+                status, size = await send(connection)
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+                errors += 1
+                connection.close()
+                await asyncio.sleep(0.05)
+                continue
+            if status == 503:
+                busy += 1
+            elif status >= 400:
+                errors += 1
+            else:
+                latencies.append(time.monotonic() - started)
+        connection.close()
+
+    def login(connection):
+        return connection.request('POST', '/login/', credentials)
+
+    def books(connection):
+        return connection.get('/books/')
+
+    started = time.monotonic()
+    await asyncio.gather(
+        *(client(login, login_latencies) for _ in range(logins)),
+        *(client(books, books_latencies) for _ in range(browsers)),
+    )
+    elapsed = time.monotonic() - started
+    return {
+        'login_concurrency': logins,
+        'logins_per_second': round(len(login_latencies) / elapsed, 1),
+        'login_p99_ms': round(percentile(login_latencies, 0.99) * 1000, 1) if login_latencies else None,
+        'logins_refused': busy,
+        'books_per_second': round(len(books_latencies) / elapsed, 1),
+        'books_p50_ms': round(percentile(books_latencies, 0.50) * 1000, 1) if books_latencies else None,
+        'books_p99_ms': round(percentile(books_latencies, 0.99) * 1000, 1) if books_latencies else None,
+        'errors': errors,
+    }
+
+class Command(BaseCommand):
+    help = '''Measures login throughput of a running deployment, and how /books/ latency holds up
+while increasing numbers of clients log in at the same time. Run it against the same server
+before and after changing the PASSWORD_* settings, e.g.
+
+    python manage.py bench_login --target http://127.0.0.1:8000 --email seed.0@bookuj.me --password bookujme'''
+
+    def create_parser(self, *args, **kwargs):
+        parser = super().create_parser(*args, **kwargs)
+        parser.formatter_class = argparse.RawDescriptionHelpFormatter
+        return parser
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', required=True, help='url of a running deployment')
+        parser.add_argument('--email', required=True)
+        parser.add_argument('--password', required=True)
+        parser.add_argument('--logins', default='0,8,32,128', help='Comma separated numbers of clients logging in')
+        parser.add_argument('--browsers', type=int, default=16, help='Clients reading /books/ meanwhile')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per level')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        url = options['target'].rstrip('/')
+        credentials = {'email': options['email'], 'password': options['password']}
+        levels = [int(level) for level in options['logins'].split(',')]
+
+        results = []
+        self.stdout.write(
+            f'{"logins":>7}{"login/s":>9}{"login p99":>11}{"refused":>9}{"books/s":>9}{"books p50":>11}{"books p99":>11}{"errors":>8}'
+        )
+        for level in levels:
+            result = asyncio.run(run_level(url, credentials, level, options['browsers'], options['duration']))
+            results.append(result)
+            self.stdout.write(
+                f'{level:>7}{result["logins_per_second"]:>9}{str(result["login_p99_ms"]):>11}{result["logins_refused"]:>9}'
+                f'{result["books_per_second"]:>9}{str(result["books_p50_ms"]):>11}{str(result["books_p99_ms"]):>11}{result["errors"]:>8}'
+            )
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'browsers': options['browsers'], 'duration': options['duration'], 'results': results}, f, indent=2)
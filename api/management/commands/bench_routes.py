@@ -0,0 +1,353 @@
+import io
+import json
+import tempfile
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api.authentication import tokens_for
+from api.caching import invalidate_partitions, response_partition
+from api.models import User, Book, Exchange, Listing, ListingChange
+from api.urls import urlpatterns
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def count(captured):
+    '''
+    The statements of a request. The transaction every request runs in here turns the views' own
+    BEGIN and COMMIT, which aren't logged, into savepoints, so those are left out
+    '''
+    return sum(1 for query in captured if not query['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')))
+
+def png_bytes():
+    from PIL import Image as PILImage
+    buffer = io.BytesIO()
+    PILImage.new('RGB', (1200, 900), (200, 120, 40)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+class Command(BaseCommand):
+    help = '''Benchmarks every route in api/urls.py against the current (seeded) database, in process.
+Records p50/p95/p99 latency, SQL query count and response size per route, optionally writes them as JSON,
+and fails when a route makes more queries than its budget or answers with another status than expected.
+Work that runs once a request commits is counted too. Writes are rolled back after every request.'''
+
+    # (route, method) -> the status the scenario answers with, and the most queries it may make.
+    # The budgets are what each request has to do, not what it happened to do when measured:
+    # statements the view and its after-commit work need, with savepoints left out (see run_scenario)
+    budgets = {
+        # one page of users with their Django user and city
+        ('users/', 'GET'): (200, 1),
+        # email taken?, then the Django user and the profile
+        ('users/', 'POST'): (201, 3),
+        ('users/<int:pk>/', 'GET'): (200, 1),
+        # the user, its update, the listings' owner columns (their cities, the update) and the books' versions,
+        # and after commit the changes of the listings
+        ('users/<int:pk>/', 'PUT'): (202, 7),
+        # the Django user, and its new hash when the hasher changed
+        ('login/', 'POST'): (200, 1),
+        ('login/refresh/', 'POST'): (200, 0),
+        # rendered once per partition version, which the scenarios bump, then served from the cache
+        ('cities/', 'GET'): (200, 1),
+        ('authors/', 'GET'): (200, 1),
+        ('genres/', 'GET'): (200, 1),
+        # a page of the user's city, read from the listings when it isn't cached
+        ('books/', 'GET'): (200, 1),
+        # the book, its job, sale and exchange, its availability, its listing (existing rows, delete, book,
+        # images, insert), the book and images of the response, and after commit its change
+        ('books/', 'POST'): (201, 13),
+        # the page, and the images of its books
+        ('books/search/', 'GET'): (200, 2),
+        # the oldest token, the changes, and the listings of the changed books
+        ('books/changes/', 'GET'): (200, 3),
+        ('books/my/', 'GET'): (200, 2),
+        # authors by name, the new ones, genres by id, the books in two batches, their sales, exchanges and
+        # search documents, their listings (existing rows, delete, books, images, two batches), and the changes
+        ('books/import/', 'POST'): (201, 15),
+        # the version, then the book and its images when it isn't cached for that version yet.
+        # Only the first request of the scenario renders it, the measured ones are cached
+        ('books/<int:pk>/', 'GET'): (200, 3),
+        # the book, its update and search job, its listing, the response, and its change
+        ('books/<int:pk>/', 'PUT'): (200, 11),
+        # the book and what cascades from it (images, offers both ways, sales), the deletes, and its change
+        ('books/<int:pk>/', 'DELETE'): (204, 10),
+        # the owner, the image, the listing's images (listing, images, update), the version, and the change.
+        # Derivatives are left to a job here, see handle
+        ('books/<int:pk>/images/', 'POST'): (201, 8),
+        # the owner, the lock, the sale, withdrawing the book (sales, exchanges, pending offers),
+        # its availability, its listing (existing row, delete, book), and its change
+        ('books/<int:pk>/buy/', 'GET'): (200, 11),
+        # both owners, the lock, conflicting offers, the offer, the availability, the listing, and its change
+        ('books/<int:pk>/exchange/', 'POST'): (200, 11),
+        # the owner, the offer, the locks, the offers, accepting, withdrawing both books (sales, exchanges,
+        # pending offers, declining them), their availability, their listings, and their changes
+        ('books/<int:pk>/exchange-reply/', 'POST'): (200, 14),
+        # the sales with their buyers, their books, and the books' images
+        ('sales/my/', 'GET'): (200, 3),
+        # the exchanges, both of their books together, and the images
+        ('exchanges/my/', 'GET'): (200, 3),
+        # like exchange-reply without the owner, plus the offers to decline and declining them
+        ('exchanges/reply/', 'POST'): (200, 15),
+        ('events/ticket/', 'POST'): (201, 0),
+        ('stats/reference-cache/', 'GET'): (200, 0),
+        # jobs waiting, and jobs finished in the window
+        ('stats/jobs/', 'GET'): (200, 2),
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50, help='Requests per route')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+
+    def handle(self, *args, **options):
+        routes = {str(pattern.pattern) for pattern in urlpatterns}
+        missing = routes - {route for route, method in self.budgets}
+        if missing:
+            raise CommandError(f'No benchmark scenario for {", ".join(sorted(missing))}')
+
+        self.prepare()
+        results = {}
+        # uploads leave their derivatives to a job, which is rolled back with the request, instead of
+        # rendering them in the process pool, whose callbacks would write outside the transaction
+        with override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_DERIVATIVE_QUEUE_SIZE=0):
+            for route, method in self.budgets:
+                results[f'{method} {route}'] = self.run_scenario(route, method, options['iterations'])
+
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)['results']
+        self.report(results, baseline)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump({'iterations': options['iterations'], 'results': results}, f, indent=2)
+
+        failures = [name for name, result in results.items() if result['over_budget'] or result['unexpected_status']]
+        if failures:
+            raise CommandError(f'Over the query budget or answering with another status: {", ".join(failures)}')
+
+    def prepare(self):
+        '''
+        Picks the users and books the scenarios act on
+        '''
+        listed = Book.objects.filter(for_exchange=True).order_by('-date_published')
+        self.own_book = listed.first()
+        if self.own_book is None:
+            raise CommandError('There are no listed books, fill the database with manage.py seed_data first')
+        self.user = self.own_book.original_owner
+        self.other = User.objects.exclude(pk=self.user.pk).annotate(books=Count('book')).filter(books__gt=0).first()
+        if self.other is None:
+            raise CommandError('At least two users with books are needed, fill the database with manage.py seed_data first')
+        self.other_book = Book.objects.filter(original_owner=self.other).first()
+        self.sale_book = Book.objects.filter(for_sale=True).exclude(original_owner=self.other).first()
+        self.exchange_book = Book.objects.filter(for_exchange=True).exclude(original_owner=self.other).first()
+        self.search_term = self.own_book.name.split()[0]
+        self.image = png_bytes()
+
+    def token(self, user):
+        return f'Bearer {tokens_for(user.django_user).access_token}'
+
+    def request(self, route, method):
+        '''
+        Returns the setup to run inside the transaction, and the request to time
+        '''
+        user, other = self.user, self.other
+        setup = None
+        headers = {}
+        kwargs = {}
+        if route == 'users/':
+            path = '/users/'
+            kwargs = {'data': {'first_name': 'Bench', 'last_name': 'Mark', 'password': 'bookujme-bench',
+                               'email': 'bench@bookuj.me', 'city': user.city.name}, 'content_type': 'application/json'}
+        elif route == 'users/<int:pk>/':
+            path = f'/users/{user.pk}/'
+            headers['HTTP_AUTHORIZATION'] = self.token(user)
+            kwargs = {'data': {'first_name': 'Bench'}, 'content_type': 'application/json'}
+        elif route == 'login/':
+            path = '/login/'
+
+            def set_password():
+                user.django_user.password = make_password('bookujme-bench')
+                user.django_user.save(update_fields=['password'])
+            setup = set_password
+            kwargs = {'data': {'email': user.django_user.email, 'password': 'bookujme-bench'}, 'content_type': 'application/json'}
+        elif route == 'login/refresh/':
+            path = '/login/refresh/'
+            kwargs = {'data': {'refresh': str(tokens_for(user.django_user))}, 'content_type': 'application/json'}
+        elif route in ('cities/', 'authors/', 'genres/', 'books/'):
+            path = f'/{route}'
+            if method == 'POST':
+                headers['HTTP_AUTHORIZATION'] = self.token(user)
+                kwargs = {'data': {
+                    'name': 'Bench book', 'author': self.own_book.author_id, 'genre': self.own_book.genre_id, 'edition': '1',
+                    'preservation_level': 3, 'for_sale': 'true', 'price': '500', 'for_exchange': 'true',
+                }}
+            else:
+                if route == 'books/':
+                    # listings of the user's own city
+                    headers['HTTP_AUTHORIZATION'] = self.token(user)
+                partition = 'listings' if route == 'books/' else response_partition(route.strip('/'))
+
+                def drop_cached():
+                    # measures the request that renders the page, later ones are served from the cache
+                    invalidate_partitions(partition)
+                setup = drop_cached
+        elif route == 'books/search/':
+            path = f'/books/search/?q={self.search_term}'
+        elif route == 'books/changes/':
+            # a client that is 20 changes behind
+            since = ListingChange.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            path = f'/books/changes/?since={since}'
+
+            def add_changes():
+                settled = timezone.now() - timedelta(minutes=1)
+                ListingChange.objects.bulk_create([
+                    ListingChange(book_id=book_id, kind=ListingChange.Kind.UPDATED, created_at=settled)
+                    for book_id in Listing.objects.values_list('book_id', flat=True)[:20]
+                ])
+            setup = add_changes
+        elif route in ('books/my/', 'sales/my/', 'exchanges/my/'):
+            path = f'/{route}'
+            headers['HTTP_AUTHORIZATION'] = self.token(user)
+        elif route == 'books/import/':
+            path = '/books/import/'
+            headers['HTTP_AUTHORIZATION'] = self.token(user)
+            rows = [
+                {'name': f'Bench book {i}', 'author': f'Bench Author{i % 10}', 'genre': self.own_book.genre_id, 'edition': '1',
+                 'preservation_level': 3, 'for_sale': i % 2 == 0, 'price': '500', 'for_exchange': i % 3 == 0}
+                for i in range(100)
+            ]
+            kwargs = {'data': rows, 'content_type': 'application/json'}
+        elif route == 'books/<int:pk>/':
+            path = f'/books/{self.own_book.pk}/'
+            headers['HTTP_AUTHORIZATION'] = self.token(user)
+            kwargs = {'data': {'name': 'Bench book'}, 'content_type': 'application/json'} if method == 'PUT' else {}
+        elif route == 'books/<int:pk>/images/':
+            path = f'/books/{self.own_book.pk}/images/'
+            headers['HTTP_AUTHORIZATION'] = self.token(user)
+            kwargs = {'data': self.image, 'content_type': 'image/png'}
+        elif route == 'books/<int:pk>/buy/':
+            path = f'/books/{self.sale_book.pk}/buy/'
+            headers['HTTP_AUTHORIZATION'] = self.token(other)
+        elif route == 'books/<int:pk>/exchange/':
+            path = f'/books/{self.exchange_book.pk}/exchange/'
+            headers['HTTP_AUTHORIZATION'] = self.token(other)
+            kwargs = {'data': {'book_id': self.other_book.pk}, 'content_type': 'application/json'}
+        elif route == 'books/<int:pk>/exchange-reply/':
+            path = f'/books/{self.own_book.pk}/exchange-reply/'
+            headers['HTTP_AUTHORIZATION'] = self.token(user)
+
+            def offer_one():
+                Exchange.objects.filter(book_offered=self.own_book, state=Exchange.State.PENDING).delete()
+                offer = Exchange.objects.create(
+                    book_offered=self.own_book, book_returned=self.other_book, state=Exchange.State.PENDING,
+                )
+                kwargs['data']['exchange_id'] = offer.pk
+            setup = offer_one
+            kwargs = {'data': {'reply': 'accept'}, 'content_type': 'application/json'}
+        elif route == 'exchanges/reply/':
+            path = '/exchanges/reply/'
+            headers['HTTP_AUTHORIZATION'] = self.token(user)
+            # accepts a new offer and declines every other offer for the user's books
+            offers = list(Exchange.objects.filter(
+                book_offered__original_owner=user, state=Exchange.State.PENDING,
+            ).values_list('pk', flat=True))
+
+            def offer_more():
+                offer = Exchange.objects.create(
+                    book_offered=self.own_book, book_returned=self.other_book, state=Exchange.State.PENDING,
+                )
+                kwargs['data']['accept'] = [offer.pk]
+            setup = offer_more
+            kwargs = {'data': {'decline': offers}, 'content_type': 'application/json'}
+        elif route == 'events/ticket/':
+            path = '/events/ticket/'
+            headers['HTTP_AUTHORIZATION'] = self.token(user)
+        elif route in ('stats/reference-cache/', 'stats/jobs/'):
+            path = f'/{route}'
+            headers['HTTP_AUTHORIZATION'] = self.token(user)
+
+            def make_staff():
+                user.django_user.is_staff = True
+                user.django_user.save(update_fields=['is_staff'])
+            setup = make_staff
+        else:
+            raise CommandError(f'No benchmark scenario for {route}')
+        return setup, path, {**kwargs, **headers}
+
+    def send(self, client, setup, method, path, kwargs):
+        '''
+        Makes one request in a transaction that is rolled back, and returns the response, its latency,
+        and the statements it made in total and after committing
+        '''
+        with transaction.atomic():
+            if setup is not None:
+                setup()
+            pending = len(connection.run_on_commit)
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = getattr(client, method.lower())(path, **kwargs)
+                latency = time.perf_counter() - started
+            # what runs once the request commits, e.g. cache invalidation and events,
+            # is run here and rolled back with the rest
+            with CaptureQueriesContext(connection) as after_commit:
+                while len(connection.run_on_commit) > pending:
+                    connection.run_on_commit.pop(pending)[1]()
+            transaction.set_rollback(True)
+        return response, latency, count(captured) + count(after_commit), count(after_commit)
+
+    def run_scenario(self, route, method, iterations):
+        client = Client(HTTP_HOST='127.0.0.1', raise_request_exception=False)
+        setup, path, kwargs = self.request(route, method)
+        # a first request fills the caches of the process (reference data, user status), like in a running worker
+        self.send(client, setup, method, path, kwargs)
+        latencies = []
+        queries = []
+        commit_queries = []
+        sizes = []
+        codes = {}
+        for _ in range(iterations):
+            response, latency, statements, after_commit = self.send(client, setup, method, path, kwargs)
+            latencies.append(latency)
+            queries.append(statements)
+            commit_queries.append(after_commit)
+            sizes.append(len(response.content))
+            codes[response.status_code] = codes.get(response.status_code, 0) + 1
+
+        status, budget = self.budgets[route, method]
+        return {
+            'path': path,
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'queries': max(queries),
+            'after_commit_queries': max(commit_queries),
+            'query_budget': budget,
+            'over_budget': max(queries) > budget,
+            'bytes': max(sizes),
+            'status_codes': {str(code): times for code, times in codes.items()},
+            'unexpected_status': sum(times for code, times in codes.items() if code != status),
+        }
+
+    def report(self, results, baseline):
+        self.stdout.write(f'{"route":<40}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}{"queries":>9}{"commit":>8}{"bytes":>10}  status')
+        for name, result in results.items():
+            line = (
+                f'{name:<40}{result["p50_ms"]:>9}{result["p95_ms"]:>9}{result["p99_ms"]:>9}'
+                f'{result["queries"]:>6}/{result["query_budget"]:<2}{result["after_commit_queries"]:>8}{result["bytes"]:>10}  '
+                f'{",".join(result["status_codes"])}'
+            )
+            if name in baseline:
+                before = baseline[name]
+                line += f'  (p99 {before["p99_ms"]} -> {result["p99_ms"]} ms, queries {before["queries"]} -> {result["queries"]})'
+            style = self.style.ERROR if result['over_budget'] or result['unexpected_status'] else (lambda text: text)
+            self.stdout.write(style(line))
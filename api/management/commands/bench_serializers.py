@@ -0,0 +1,104 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+
+from api import fast_serializers
+from api.listings import book_listing, book_prefetch
+from api.models import Book, Listing, Sale, Exchange
+from api.renderers import FastJSONRenderer
+from api.serializers import BookSerializer, ListingSerializer, SaleSerializer, ExchangeSerializer
+
+class Command(BaseCommand):
+    help = '''Compares the DRF serializers and JSONRenderer with the fast path (api.fast_serializers and
+FastJSONRenderer) on the same rows of the current (seeded) database. Reports the best time of loading
+and serializing, and of rendering, out of --repeat runs, and fails when the two don't produce the same bytes.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        books = Book.objects.order_by('-date_published', '-id')[:rows]
+        listings = Listing.objects.order_by('-date_published', '-book_id')[:rows]
+        sales = Sale.objects.order_by('id')[:rows]
+        exchanges = Exchange.objects.order_by('id')[:rows]
+
+        cases = {
+            'books': (
+                lambda: BookSerializer(book_listing(books), many=True).data,
+                lambda: fast_serializers.serialize_books(list(fast_serializers.book_values(books))),
+            ),
+            'listings': (
+                lambda: ListingSerializer(listings.all(), many=True).data,
+                lambda: fast_serializers.serialize_listings(fast_serializers.listing_values(listings)),
+            ),
+            'sales': (
+                lambda: SaleSerializer(
+                    sales.select_related('status', 'buyer__django_user', 'buyer__city').prefetch_related(book_prefetch('book')),
+                    many=True,
+                ).data,
+                lambda: fast_serializers.serialize_sales(sales),
+            ),
+            'exchanges': (
+                lambda: ExchangeSerializer(
+                    exchanges.prefetch_related(book_prefetch('book_offered'), book_prefetch('book_returned')),
+                    many=True,
+                ).data,
+                lambda: fast_serializers.serialize_exchanges(exchanges),
+            ),
+        }
+
+        results = {}
+        mismatched = []
+        self.stdout.write(f'{"case":<12}{"rows":>8}{"serialize ms":>26}{"render ms":>24}{"total speedup":>16}{"queries":>10}')
+        for name, (drf, fast) in cases.items():
+            drf_result = self.measure(drf, JSONRenderer(), options['repeat'])
+            fast_result = self.measure(fast, FastJSONRenderer(), options['repeat'])
+            if drf_result.pop('content') != fast_result.pop('content'):
+                mismatched.append(name)
+            speedup = (drf_result['serialize_ms'] + drf_result['render_ms']) / max(fast_result['serialize_ms'] + fast_result['render_ms'], 1e-6)
+            results[name] = {'drf': drf_result, 'fast': fast_result, 'speedup': round(speedup, 1)}
+            self.stdout.write(
+                f'{name:<12}{drf_result["rows"]:>8}'
+                f'{drf_result["serialize_ms"]:>13} -> {fast_result["serialize_ms"]:<9}'
+                f'{drf_result["render_ms"]:>11} -> {fast_result["render_ms"]:<9}'
+                f'{speedup:>15.1f}x'
+                f'{drf_result["queries"]:>5} -> {fast_result["queries"]}'
+            )
+            if drf_result['rows'] < rows:
+                self.stdout.write(f'  only {drf_result["rows"]} {name} exist, fill the database with manage.py seed_data for more')
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if mismatched:
+            raise CommandError(f'The fast path produced different JSON for: {", ".join(mismatched)}')
+
+    def measure(self, serialize, renderer, repeat):
+        '''
+        Best times of loading and serializing (queries included), and of rendering
+        '''
+        serialize_times = []
+        render_times = []
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.perf_counter()
+                data = serialize()
+                serialized = time.perf_counter()
+            content = renderer.render(data)
+            render_times.append(time.perf_counter() - serialized)
+            serialize_times.append(serialized - started)
+        return {
+            'rows': len(data),
+            'serialize_ms': round(min(serialize_times) * 1000, 1),
+            'render_ms': round(min(render_times) * 1000, 1),
+            'queries': len(queries),
+            'bytes': len(content),
+            'content': content,
+        }
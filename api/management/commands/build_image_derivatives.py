@@ -0,0 +1,65 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from api.images import derivative_names, render_derivatives
+from api.listings import refresh_listing_images
+from api.models import Book, Image
+
+class Command(BaseCommand):
+    help = 'Renders thumbnails and WebP/AVIF versions of book images in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Render every image, not only the ones without derivatives')
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+    def handle(self, *args, **options):
+        images = Image.objects.exclude(image='').order_by('id')
+        if not options['all']:
+            images = images.filter(thumbnail='')
+
+        jobs = {}
+        for image in images.only('id', 'image', 'book').iterator():
+            names = derivative_names(image.image.name)
+            targets = {field: default_storage.path(name) for field, name in names.items()}
+            jobs[image.pk] = (image.image.path, targets, names, image.book_id)
+        self.stdout.write(f'Rendering derivatives of {len(jobs)} images with {options["workers"]} workers')
+
+        started = time.monotonic()
+        done = failed = total_bytes = 0
+        books = set()
+        with ProcessPoolExecutor(max_workers=options['workers']) as executor:
+            futures = {
+                executor.submit(
+                    render_derivatives, source, targets,
+                    settings.IMAGE_THUMBNAIL_SIZE, settings.IMAGE_DERIVATIVE_QUALITY,
+                ): pk
+                for pk, (source, targets, names, book_id) in jobs.items()
+            }
+            for future in as_completed(futures):
+                pk = futures[future]
+                try:
+                    total_bytes += future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'Image {pk} failed: {e}')
+                    continue
+                Image.objects.filter(pk=pk).update(**jobs[pk][2])
+                books.add(jobs[pk][3])
+                done += 1
+
+        # the updates above send no signals, the books and listings get the new derivatives here
+        books = sorted(books)
+        for start in range(0, len(books), 500):
+            Book.objects.filter(pk__in=books[start:start + 500]).touch()
+            refresh_listing_images(books[start:start + 500])
+
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered {done} images ({failed} failed) in {elapsed:.1f}s: '
+            f'{done / elapsed:.1f} images/s, {total_bytes / elapsed / 1024 / 1024:.1f} MB/s of originals'
+        ))
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.changes import compact
+
+class Command(BaseCommand):
+    help = '''Compacts the change feed of listings: removes changes older than the retention period,
+and every change followed by a later change of the same book. Meant to run daily, e.g. from cron.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.CHANGE_FEED_RETENTION_DAYS,
+            help='Keep changes of this many days (CHANGE_FEED_RETENTION_DAYS by default)',
+        )
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        expired, superseded = compact(options['days'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Removed {expired} expired and {superseded} superseded changes'))
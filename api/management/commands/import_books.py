@@ -0,0 +1,45 @@
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.imports import import_books, read_csv, ImportTooLarge
+from api.models import User
+
+class Command(BaseCommand):
+    help = '''Imports books of a user from a JSON array or a CSV file, like books/import/ does.
+CSV files name their columns on the first line: name, author, genre, edition, preservation_level, for_sale, price, for_exchange'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSON or CSV file, - reads CSV from standard input')
+        parser.add_argument('--owner', required=True, help='Email of the user the books belong to')
+        parser.add_argument('--batch-size', type=int, help='Rows per INSERT (default: BOOK_IMPORT_BATCH_SIZE)')
+
+    def handle(self, *args, **options):
+        owner = User.objects.filter(django_user__email=options['owner']).first()
+        if owner is None:
+            raise CommandError(f'There is no user with email {options["owner"]}')
+
+        path = options['path']
+        source = sys.stdin if path == '-' else open(path, encoding='utf-8-sig', newline='')
+        started = time.monotonic()
+        try:
+            if path.endswith('.json'):
+                rows = json.load(source)
+                if not isinstance(rows, list):
+                    raise CommandError('The JSON file has to hold an array of books')
+            else:
+                rows = read_csv(source)
+            books, errors = import_books(rows, owner, options['batch_size'])
+        except ImportTooLarge as e:
+            raise CommandError(str(e))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        for error in errors:
+            self.stderr.write(f'Row {error["row"]}: ' + ', '.join(f'{field}: {message}' for field, message in error['errors'].items()))
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {len(books)} books ({len(errors)} rows skipped) in {time.monotonic() - started:.1f}s'
+        ))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import Book
+
+class Command(BaseCommand):
+    help = 'Reports books whose for_sale, for_exchange or current_price drifted from their sales and exchanges, and rebuilds them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report drift, without fixing it')
+        parser.add_argument('--all', action='store_true', help='Rebuild every book, not only the drifted ones')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        drifted = list(Book.objects.availability_drift().values_list('id', flat=True))
+        for book_id in drifted[:20]:
+            self.stdout.write(f'Book {book_id} has drifted')
+        if len(drifted) > 20:
+            self.stdout.write(f'... and {len(drifted) - 20} more')
+        self.stdout.write(f'{len(drifted)} drifted books found')
+
+        if options['check']:
+            if drifted:
+                # non-zero exit status, so the check can be used from cron or CI
+                raise SystemExit(1)
+            return
+
+        if options['all']:
+            ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+        else:
+            ids = drifted
+        batch_size = options['batch_size']
+        updated = 0
+        for start in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                updated += Book.objects.filter(id__in=ids[start:start + batch_size]).refresh_availability()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt availability of {updated} books'))
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.listings import listing_drift, refresh_listings
+from api.models import Book
+
+class Command(BaseCommand):
+    help = 'Reports books whose listing is missing, left over or out of date, and rebuilds them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report drift, without fixing it')
+        parser.add_argument('--all', action='store_true', help='Rebuild every listing, not only the drifted ones')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        ids = list(Book.objects.order_by('id').values_list('id', flat=True))
+
+        drifted = []
+        for start in range(0, len(ids), batch_size):
+            drifted.extend(listing_drift(ids[start:start + batch_size]))
+        for book_id in drifted[:20]:
+            self.stdout.write(f'Listing of book {book_id} has drifted')
+        if len(drifted) > 20:
+            self.stdout.write(f'... and {len(drifted) - 20} more')
+        self.stdout.write(f'{len(drifted)} drifted listings found')
+
+        if options['check']:
+            if drifted:
+                # non-zero exit status, so the check can be used from cron or CI
+                raise SystemExit(1)
+            return
+
+        if not options['all']:
+            ids = drifted
+        listed = 0
+        for start in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                listed += len(refresh_listings(Book.objects.filter(id__in=ids[start:start + batch_size])))
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt listings of {len(ids)} books, {listed} of them are listed'))
@@ -0,0 +1,43 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.jobs import job_stats, purge, work
+
+class Command(BaseCommand):
+    help = '''Runs background jobs (api/jobs.py) on --concurrency threads until it gets SIGINT or SIGTERM,
+letting the jobs that are running finish. Run as many processes as needed, e.g. one per CPU for
+CPU bound tasks. Finished jobs older than JOB_RETENTION_DAYS are removed once an hour.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.JOB_WORKER_CONCURRENCY,
+            help='Worker threads (JOB_WORKER_CONCURRENCY by default)',
+        )
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is due')
+
+    def handle(self, *args, **options):
+        stopping = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: stopping.set())
+
+        threads = [
+            threading.Thread(target=work, args=(stopping,), kwargs={'burst': options['burst']}, name=f'jobs-{i}')
+            for i in range(options['concurrency'])
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f'Running jobs on {len(threads)} threads')
+
+        purge()
+        if not options['burst']:
+            while not stopping.wait(3600):
+                purge()
+        for thread in threads:
+            thread.join()
+
+        queued = job_stats()['queued']
+        due = sum(counts['due'] for counts in queued.values())
+        self.stdout.write(self.style.SUCCESS(f'Stopped, {due} jobs are due'))
@@ -0,0 +1,146 @@
+import io
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User as DjangoUser
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from api.models import User, City, Genre, Author, Book, Image, Status, Sale, Exchange
+from api.search import refresh_search_documents
+
+CITIES = ['Beograd', 'Novi Sad', 'Niš', 'Kragujevac', 'Subotica', 'Zrenjanin', 'Pančevo', 'Čačak', 'Kraljevo', 'Smederevo']
+GENRES = ['Roman', 'Drama', 'Poezija', 'Fantastika', 'Istorija', 'Biografija', 'Udžbenik', 'Krimi', 'Esej', 'Strip']
+FIRST_NAMES = ['Ivo', 'Meša', 'Danilo', 'Branislav', 'Isidora', 'Desanka', 'Miloš', 'Jovan', 'Borislav', 'Svetlana']
+LAST_NAMES = ['Andrić', 'Selimović', 'Kiš', 'Nušić', 'Sekulić', 'Maksimović', 'Crnjanski', 'Dučić', 'Pekić', 'Velmar-Janković']
+WORDS = ['na', 'drini', 'ćuprija', 'derviš', 'smrt', 'seobe', 'prokleta', 'avlija', 'grobnica', 'knjiga', 'leto', 'kuća', 'pesme', 'hronika', 'vreme']
+STATUSES = ['AVAILABLE', 'PENDING', 'UNAVAILABLE', 'ACCEPTED', 'DECLINED']
+
+class Command(BaseCommand):
+    help = 'Fills the database with a realistic generated dataset, for benchmarks. Not meant for production databases.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--books', type=int, default=200000)
+        parser.add_argument('--authors', type=int, default=2000)
+        parser.add_argument('--images-per-book', type=int, default=2)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator, so datasets can be reproduced')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        statuses = {name: Status.objects.get_or_create(name=name)[0] for name in STATUSES}
+        cities = [City.objects.get_or_create(name=name)[0] for name in CITIES]
+        genres = [Genre.objects.get_or_create(name=name)[0] for name in GENRES]
+        authors = Author.objects.bulk_create([
+            Author(first_name=self.random.choice(FIRST_NAMES), last_name=self.random.choice(LAST_NAMES))
+            for _ in range(options['authors'])
+        ], batch_size=self.batch_size)
+
+        users = self.create_users(options['users'], cities)
+        self.stdout.write(f'Created {len(users)} users')
+        books = self.create_books(options['books'], users, authors, genres)
+        self.stdout.write(f'Created {len(books)} books')
+        self.create_listings(books, users, statuses)
+        self.stdout.write('Created sales and exchanges')
+        self.create_images(books, options['images_per_book'])
+        self.stdout.write('Created images')
+
+        # bulk_create skips save() and signals, so the derived columns are rebuilt afterwards
+        for start in range(0, len(books), self.batch_size):
+            ids = [book.id for book in books[start:start + self.batch_size]]
+            with transaction.atomic():
+                Book.objects.filter(id__in=ids).refresh_availability()
+                refresh_search_documents(Book.objects.filter(id__in=ids))
+        self.stdout.write(self.style.SUCCESS('Seeded the database'))
+
+    def create_users(self, count, cities):
+        # hashing is the slow part of creating users, so they all share one password
+        password = make_password('bookujme')
+        run = timezone.now().strftime('%Y%m%d%H%M%S')
+        django_users = DjangoUser.objects.bulk_create([
+            DjangoUser(username=f'seed{run}.{i}@bookuj.me', email=f'seed{run}.{i}@bookuj.me', password=password)
+            for i in range(count)
+        ], batch_size=self.batch_size)
+        return User.objects.bulk_create([
+            User(
+                first_name=self.random.choice(FIRST_NAMES),
+                last_name=self.random.choice(LAST_NAMES),
+                django_user=django_user,
+                city=self.random.choice(cities),
+            )
+            for django_user in django_users
+        ], batch_size=self.batch_size)
+
+    def create_books(self, count, users, authors, genres):
+        now = timezone.now()
+        return Book.objects.bulk_create([
+            Book(
+                name=' '.join(self.random.sample(WORDS, self.random.randint(1, 4))).capitalize(),
+                original_owner=self.random.choice(users),
+                author=self.random.choice(authors),
+                genre=self.random.choice(genres),
+                edition=str(self.random.randint(1, 20)),
+                preservation_level=self.random.randint(1, 5),
+                date_published=now - timedelta(seconds=self.random.randint(0, 365 * 24 * 3600)),
+            )
+            for _ in range(count)
+        ], batch_size=self.batch_size)
+
+    def create_listings(self, books, users, statuses):
+        '''
+        Most books are listed, some for both sale and exchange,
+        part of the listings have offers, and some have already been sold or exchanged
+        '''
+        sales = []
+        exchanges = []
+        for book in books:
+            roll = self.random.random()
+            if roll < 0.6:
+                sold = self.random.random() < 0.2
+                sales.append(Sale(
+                    book=book,
+                    buyer=self.random.choice(users) if sold else None,
+                    status=statuses['UNAVAILABLE' if sold else 'AVAILABLE'],
+                    price=Decimal(self.random.randint(100, 5000)),
+                ))
+            if 0.4 < roll < 0.9:
+                # an open listing with a few pending or declined offers, or one closed by an accepted offer
+                closed = self.random.random() < 0.15
+                exchanges.append(Exchange(
+                    book_offered=book,
+                    state=Exchange.State.CLOSED if closed else Exchange.State.AVAILABLE,
+                ))
+                offers = [Exchange.State.ACCEPTED] if closed else self.random.choices(
+                    [Exchange.State.PENDING, Exchange.State.DECLINED], [80, 20], k=self.random.randint(0, 3),
+                )
+                for state in offers:
+                    exchanges.append(Exchange(book_offered=book, book_returned=self.random.choice(books), state=state))
+        Sale.objects.bulk_create(sales, batch_size=self.batch_size)
+        Exchange.objects.bulk_create(exchanges, batch_size=self.batch_size)
+
+    def create_images(self, books, per_book):
+        '''
+        Every image row points at one of a few generated photos, to keep the dataset small on disk
+        '''
+        from PIL import Image as PILImage
+
+        photos = []
+        for i in range(10):
+            buffer = io.BytesIO()
+            color = tuple(self.random.randint(0, 255) for _ in range(3))
+            PILImage.new('RGB', (1200, 1600), color).save(buffer, 'JPEG', quality=85)
+            photos.append(default_storage.save(f'seed/photo{i}.jpg', ContentFile(buffer.getvalue())))
+
+        Image.objects.bulk_create([
+            Image(book=book, image=self.random.choice(photos))
+            for book in books
+            for _ in range(self.random.randint(0, per_book))
+        ], batch_size=self.batch_size)
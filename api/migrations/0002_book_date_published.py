@@ -0,0 +1,46 @@
+# Generated by Django 4.0.2 on 2026-10-18 08:21
+
+from django.db import migrations, models
+import django.utils.timezone
+from datetime import datetime, time
+
+
+def backfill_date_published(apps, schema_editor):
+    '''
+    Existing books get the date of their first sale or exchange listing
+    '''
+    Book = apps.get_model('api', 'Book')
+    Sale = apps.get_model('api', 'Sale')
+    Exchange = apps.get_model('api', 'Exchange')
+    published = {}
+    for book_id, day in Sale.objects.values_list('book_id', 'date_published'):
+        published[book_id] = min(day, published.get(book_id, day))
+    for book_id, day in Exchange.objects.values_list('book_offered_id', 'date_published'):
+        published[book_id] = min(day, published.get(book_id, day))
+    Book.objects.bulk_update(
+        [
+            Book(id=book_id, date_published=datetime.combine(day, time.min, tzinfo=django.utils.timezone.utc))
+            for book_id, day in published.items()
+        ],
+        ['date_published'], batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='date_published',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill_date_published, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['date_published', 'id'], name='book_published_idx'),
+        ),
+    ]
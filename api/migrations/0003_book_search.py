@@ -0,0 +1,71 @@
+# Generated by Django 4.0.2 on 2026-10-18 08:24
+
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+from django.db.models import CharField, OuterRef, Subquery, Value
+from django.db.models.functions import Concat
+
+
+def create_search_indexes(apps, schema_editor):
+    '''
+    Full text and trigram indexes only exist on postgres,
+    other databases fall back to substring matching
+    '''
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute('CREATE INDEX book_search_vector_idx ON api_book USING gin (search_vector)')
+    schema_editor.execute('CREATE INDEX book_search_document_trgm_idx ON api_book USING gin (search_document gin_trgm_ops)')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS book_search_vector_idx')
+    schema_editor.execute('DROP INDEX IF EXISTS book_search_document_trgm_idx')
+
+
+def backfill_search_documents(apps, schema_editor):
+    Book = apps.get_model('api', 'Book')
+    Author = apps.get_model('api', 'Author')
+    Genre = apps.get_model('api', 'Genre')
+    author = Subquery(
+        Author.objects.filter(pk=OuterRef('author')).values(
+            name=Concat('first_name', Value(' '), 'last_name', output_field=CharField())
+        )[:1],
+        output_field=CharField(),
+    )
+    genre = Subquery(Genre.objects.filter(pk=OuterRef('genre')).values('name')[:1], output_field=CharField())
+    fields = {
+        'search_document': Concat('name', Value(' '), author, Value(' '), genre, output_field=CharField()),
+    }
+    if schema_editor.connection.vendor == 'postgresql':
+        fields['search_vector'] = (
+            SearchVector('name', weight='A', config='simple')
+            + SearchVector(author, weight='B', config='simple')
+            + SearchVector(genre, weight='C', config='simple')
+        )
+    Book.objects.update(**fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_book_date_published'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='search_document',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+        migrations.RunPython(backfill_search_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.0.2 on 2026-10-18 08:25
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef, Subquery
+
+
+def backfill_availability(apps, schema_editor):
+    Book = apps.get_model('api', 'Book')
+    Sale = apps.get_model('api', 'Sale')
+    Exchange = apps.get_model('api', 'Exchange')
+    sales = Sale.objects.filter(book=OuterRef('pk'), status__name='AVAILABLE')
+    exchanges = Exchange.objects.filter(book_offered=OuterRef('pk'), status__name='AVAILABLE')
+    Book.objects.update(
+        for_sale=Exists(sales),
+        for_exchange=Exists(exchanges),
+        current_price=Subquery(sales.values('price')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_book_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='current_price',
+            field=models.DecimalField(decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='for_exchange',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='for_sale',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(backfill_availability, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(('for_sale', True), ('for_exchange', True), _connector='OR'), fields=['date_published', 'id'], name='book_available_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='exchange',
+            index=models.Index(fields=['book_offered', 'status'], name='exchange_book_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(fields=['book', 'status'], name='sale_book_status_idx'),
+        ),
+    ]
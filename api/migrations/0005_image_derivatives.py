@@ -0,0 +1,28 @@
+# Generated by Django 4.0.2 on 2026-10-18 08:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_book_availability'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='avif',
+            field=models.ImageField(blank=True, editable=False, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='thumbnail',
+            field=models.ImageField(blank=True, editable=False, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='webp',
+            field=models.ImageField(blank=True, editable=False, upload_to=''),
+        ),
+    ]
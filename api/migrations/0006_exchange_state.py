@@ -0,0 +1,64 @@
+from django.db import migrations, models
+
+# Exchange.State by the name of the Status rows exchanges used to point to
+STATES = {
+    'AVAILABLE': 1,
+    'PENDING': 2,
+    'ACCEPTED': 3,
+    'DECLINED': 4,
+    'UNAVAILABLE': 5,
+}
+
+def statuses_to_states(apps, schema_editor):
+    Exchange = apps.get_model('api', 'Exchange')
+    Status = apps.get_model('api', 'Status')
+    for name, state in STATES.items():
+        Exchange.objects.filter(status__name=name).update(state=state)
+    # sales still refer to statuses by name, make sure the ones they use exist
+    for name in ('AVAILABLE', 'UNAVAILABLE'):
+        if not Status.objects.filter(name=name).exists():
+            Status.objects.create(name=name)
+
+def states_to_statuses(apps, schema_editor):
+    Exchange = apps.get_model('api', 'Exchange')
+    Status = apps.get_model('api', 'Status')
+    for name, state in STATES.items():
+        status = Status.objects.filter(name=name).first() or Status.objects.create(name=name)
+        Exchange.objects.filter(state=state).update(status=status)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchange',
+            name='state',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'AVAILABLE'), (2, 'PENDING'), (3, 'ACCEPTED'), (4, 'DECLINED'), (5, 'CLOSED')], default=1),
+        ),
+        migrations.AddField(
+            model_name='exchange',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='exchange',
+            name='status',
+            field=models.ForeignKey(null=True, on_delete=models.deletion.CASCADE, to='api.status'),
+        ),
+        migrations.RunPython(statuses_to_states, states_to_statuses),
+        migrations.RemoveIndex(
+            model_name='exchange',
+            name='exchange_book_status_idx',
+        ),
+        migrations.RemoveField(
+            model_name='exchange',
+            name='status',
+        ),
+        migrations.AddIndex(
+            model_name='exchange',
+            index=models.Index(fields=['book_offered', 'state'], name='exchange_book_state_idx'),
+        ),
+    ]
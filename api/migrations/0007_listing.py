@@ -0,0 +1,94 @@
+# Generated by Django 4.0.2 on 2026-10-18 08:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+def build_listings(apps, schema_editor):
+    '''
+    Lists every book that is available now, like api.listings.refresh_listings
+    '''
+    Book = apps.get_model('api', 'Book')
+    Image = apps.get_model('api', 'Image')
+    Listing = apps.get_model('api', 'Listing')
+    books = Book.objects.filter(models.Q(for_sale=True) | models.Q(for_exchange=True)).select_related(
+        'original_owner__django_user', 'original_owner__city', 'author', 'genre',
+    ).order_by('pk')
+    batch = []
+    for book in books.iterator(chunk_size=1000):
+        batch.append(book)
+        if len(batch) == 1000:
+            create_listings(Listing, Image, batch)
+            batch = []
+    create_listings(Listing, Image, batch)
+
+def create_listings(Listing, Image, books):
+    images = {}
+    for image in Image.objects.filter(book__in=books).order_by('pk'):
+        images.setdefault(image.book_id, []).append({
+            'id': image.id,
+            'image': image.image.name,
+            'thumbnail': image.thumbnail.name,
+            'webp': image.webp.name,
+            'avif': image.avif.name,
+            'book': image.book_id,
+        })
+    Listing.objects.bulk_create([
+        Listing(
+            book_id=book.id,
+            name=book.name,
+            owner_id=book.original_owner_id,
+            owner_first_name=book.original_owner.first_name,
+            owner_last_name=book.original_owner.last_name,
+            owner_email=book.original_owner.django_user.email,
+            owner_city=book.original_owner.city.name,
+            author_id=book.author_id,
+            author_first_name=book.author.first_name,
+            author_last_name=book.author.last_name,
+            genre=book.genre.name,
+            edition=book.edition,
+            preservation_level=book.preservation_level,
+            date_published=book.date_published,
+            for_sale=book.for_sale,
+            for_exchange=book.for_exchange,
+            price=book.current_price,
+            images=images.get(book.id, []),
+        )
+        for book in books
+    ])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_exchange_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Listing',
+            fields=[
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='listing', serialize=False, to='api.book')),
+                ('name', models.CharField(max_length=100)),
+                ('owner_id', models.BigIntegerField()),
+                ('owner_first_name', models.CharField(max_length=50)),
+                ('owner_last_name', models.CharField(max_length=50)),
+                ('owner_email', models.EmailField(blank=True, max_length=254)),
+                ('owner_city', models.CharField(max_length=50)),
+                ('author_id', models.BigIntegerField()),
+                ('author_first_name', models.CharField(max_length=50)),
+                ('author_last_name', models.CharField(max_length=50)),
+                ('genre', models.CharField(max_length=50)),
+                ('edition', models.CharField(max_length=4)),
+                ('preservation_level', models.IntegerField()),
+                ('date_published', models.DateTimeField()),
+                ('for_sale', models.BooleanField()),
+                ('for_exchange', models.BooleanField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('images', models.JSONField(default=list)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(fields=['date_published', 'book'], name='listing_published_idx'),
+        ),
+        migrations.RunPython(build_listings, migrations.RunPython.noop),
+    ]
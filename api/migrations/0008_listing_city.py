@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+def fill_cities(apps, schema_editor):
+    Listing = apps.get_model('api', 'Listing')
+    User = apps.get_model('api', 'User')
+    Listing.objects.update(
+        city_id=models.Subquery(User.objects.filter(pk=models.OuterRef('owner_id')).values('city_id')[:1]),
+    )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_listing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='city_id',
+            field=models.BigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_cities, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(fields=['city_id', 'date_published', 'book'], name='listing_city_published_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.0.2 on 2026-10-18 09:11
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_book_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ListingChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('book_id', models.BigIntegerField()),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'created'), (2, 'updated'), (3, 'sold'), (4, 'exchanged'), (5, 'unlisted'), (6, 'deleted')])),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='listingchange',
+            index=models.Index(fields=['book_id', 'id'], name='change_book_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listingchange',
+            index=models.Index(fields=['created_at'], name='change_created_idx'),
+        ),
+    ]
@@ -1,4 +1,12 @@
-from django.db import models
+import threading
+from contextlib import contextmanager
+
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.db.models import Exists, F, OuterRef, Q, Subquery
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
 import django.contrib.auth.models
 
 class City(models.Model):
@@ -42,6 +50,89 @@ class Author(models.Model):
     def __str__(self):
         return self.first_name + ' ' + self.last_name
 
+class BookQuerySet(models.QuerySet):
+    def with_expected_availability(self):
+        '''
+        Annotates books with their availability as computed from their sales and exchanges
+        '''
+        sales = Sale.objects.filter(book=OuterRef('pk'), status__name='AVAILABLE')
+        exchanges = Exchange.objects.filter(book_offered=OuterRef('pk'), state=Exchange.State.AVAILABLE)
+        return self.annotate(
+            expected_for_sale=Exists(sales),
+            expected_for_exchange=Exists(exchanges),
+            expected_price=Subquery(sales.values('price')[:1]),
+        )
+
+    def touch(self):
+        '''
+        Gives these books a new version, after something they are shown with changed
+        '''
+        return self.update(version=F('version') + 1)
+
+    def refresh_availability(self, removed=None):
+        '''
+        Recomputes for_sale, for_exchange and current_price of these books with a single UPDATE,
+        bumping their version, and rebuilds their listings. `removed` is the change recorded
+        for books that are no longer listed, see refresh_listings
+        '''
+        from .listings import refresh_listings
+
+        sales = Sale.objects.filter(book=OuterRef('pk'), status__name='AVAILABLE')
+        exchanges = Exchange.objects.filter(book_offered=OuterRef('pk'), state=Exchange.State.AVAILABLE)
+        with transaction.atomic(savepoint=False):
+            updated = self.update(
+                for_sale=Exists(sales),
+                for_exchange=Exists(exchanges),
+                current_price=Subquery(sales.values('price')[:1]),
+                version=F('version') + 1,
+            )
+            # the UPDATE above keeps the books locked until the listings are rebuilt
+            refresh_listings(self, removed)
+        return updated
+
+    def withdraw(self):
+        '''
+        Takes these books off the market once they changed hands, in the caller's transaction
+        with the books locked: closes their available sales and exchange listings, and declines
+        the pending offers for them and of them, letting the offerers know. Their availability
+        still has to be refreshed. Returns the number of declined offers
+        '''
+        from .reference import statuses
+
+        today = timezone.now().date()
+        with transaction.atomic(savepoint=False):
+            Sale.objects.filter(book__in=self, status=statuses.get(name='AVAILABLE')).update(
+                status=statuses.get(name='UNAVAILABLE'),
+            )
+            Exchange.objects.filter(book_offered__in=self).transition(Exchange.State.CLOSED, date_exchanged=today)
+            offers = list(Exchange.objects.filter(
+                Q(book_offered__in=self) | Q(book_returned__in=self), state=Exchange.State.PENDING,
+            ).values_list(*OFFER_VALUES))
+            if offers:
+                Exchange.objects.filter(pk__in=[offer[0] for offer in offers]).transition(
+                    Exchange.State.DECLINED, date_exchanged=today,
+                )
+                publish_replies(offers, 'declined')
+        return len(offers)
+
+    def delete(self):
+        with deleting_books.deleting(self.values_list('pk', flat=True)):
+            return super().delete()
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def availability_drift(self):
+        '''
+        Books whose stored availability doesn't match their sales and exchanges
+        '''
+        return self.with_expected_availability().filter(
+            ~Q(for_sale=F('expected_for_sale'))
+            | ~Q(for_exchange=F('expected_for_exchange'))
+            | Q(current_price__isnull=True, expected_price__isnull=False)
+            | Q(current_price__isnull=False, expected_price__isnull=True)
+            | Q(Q(current_price__isnull=False, expected_price__isnull=False) & ~Q(current_price=F('expected_price')))
+        )
+
 class Book(models.Model):
     '''
     This model holds information about a book instance that is either
@@ -54,10 +145,46 @@ class Book(models.Model):
     genre = models.ForeignKey(Genre, models.CASCADE)
     edition = models.CharField(max_length=4)
     preservation_level = models.IntegerField()
+    date_published = models.DateTimeField(default=timezone.now)
+    # derived from the book's sales and exchanges whenever one of them is saved or deleted
+    for_sale = models.BooleanField(default=False)
+    for_exchange = models.BooleanField(default=False)
+    current_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    # name, author and genre of the book, kept up to date by api.search
+    search_document = models.TextField(default='', editable=False)
+    search_vector = SearchVectorField(null=True, editable=False)
+    # bumped whenever anything shown with the book changes: the book itself, its sales and exchanges,
+    # its images, its owner, author or genre (see api.versions). BookDetails builds its ETag from it
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = BookQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # keyset pagination of listings, newest first
+            models.Index(fields=['date_published', 'id'], name='book_published_idx'),
+            models.Index(
+                fields=['date_published', 'id'],
+                name='book_available_idx',
+                condition=Q(for_sale=True) | Q(for_exchange=True),
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            # counted by the database, so concurrent saves never end up with the same version
+            self.version = F('version') + 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with deleting_books.deleting([self.pk]):
+            return super().delete(*args, **kwargs)
+
 class Image(models.Model):
     '''
     This model holds images related to the book model.
@@ -65,6 +192,10 @@ class Image(models.Model):
     '''
     image = models.ImageField()
     book = models.ForeignKey(Book, models.CASCADE)
+    # smaller versions of the image, generated in the background by api.images
+    thumbnail = models.ImageField(blank=True, editable=False)
+    webp = models.ImageField(blank=True, editable=False)
+    avif = models.ImageField(blank=True, editable=False)
 
     def __str__(self):
         return self.book.name + ' ' + str(self.id)
@@ -80,17 +211,137 @@ class Status(models.Model):
     def __str__(self):
         return self.name
 
+class ExchangeConflict(Exception):
+    pass
+
+class ExchangeQuerySet(models.QuerySet):
+    def transition(self, state, **fields):
+        '''
+        Moves the exchanges of this queryset that are allowed to go to `state` there with a single UPDATE,
+        bumping their version, and returns how many moved. Exchanges in any other state are left alone
+        '''
+        sources = [source for source, targets in Exchange.TRANSITIONS.items() if state in targets]
+        return self.filter(state__in=sources).update(state=state, version=F('version') + 1, **fields)
+
+    def offer(self, book_id, book_returned_id):
+        '''
+        Places a pending offer of book_returned for the book's open exchange listing.
+        Raises ExchangeConflict when the book isn't listed or the same book has already been offered
+        '''
+        with transaction.atomic():
+            # every change of a book's exchanges locks the book first, so an offer can't slip in
+            # while a competing one is being accepted
+            Book.objects.select_for_update().filter(pk=book_id).values_list('pk').first()
+            states = set(self.filter(
+                Q(state=Exchange.State.AVAILABLE) | Q(state=Exchange.State.PENDING, book_returned_id=book_returned_id),
+                book_offered_id=book_id,
+            ).values_list('state', flat=True))
+            if Exchange.State.AVAILABLE not in states:
+                raise ExchangeConflict('Chosen book is not available for exchange.')
+            if Exchange.State.PENDING in states:
+                raise ExchangeConflict('You have already offered this book.')
+            return self.create(book_offered_id=book_id, book_returned_id=book_returned_id, state=Exchange.State.PENDING)
+
+    def decline(self):
+        '''
+        Declines the pending offers of this queryset with one UPDATE, and lets their offerers know
+        '''
+        with transaction.atomic(savepoint=False):
+            offers = list(self.filter(state=Exchange.State.PENDING).select_for_update(of=('self',)).values_list(*OFFER_VALUES))
+            if not offers:
+                return 0
+            declined = Exchange.objects.filter(pk__in=[offer[0] for offer in offers]).transition(
+                Exchange.State.DECLINED, date_exchanged=timezone.now().date(),
+            )
+            publish_replies(offers, 'declined')
+            return declined
+
+    def accept(self):
+        '''
+        Accepts the pending offers of this queryset, at most one per book. In the same transaction the
+        offered and the returned books are taken off the market (see BookQuerySet.withdraw), which
+        declines every competing offer for them and every other offer of them, a few statements
+        in total however many offers are accepted. Returns the number of accepted offers
+        '''
+        with transaction.atomic(savepoint=False):
+            pending = self.filter(state=Exchange.State.PENDING)
+            book_ids = set()
+            for book_offered_id, book_returned_id in pending.values_list('book_offered_id', 'book_returned_id'):
+                book_ids.update((book_offered_id, book_returned_id))
+            # the lock a purchase of the books takes too, in the order of their ids so that
+            # concurrent replies don't deadlock
+            list(Book.objects.select_for_update().filter(pk__in=book_ids).order_by('pk').values_list('pk'))
+            # read again under the locks, the offers may have been answered or the books sold in the meantime
+            offers = list(pending.values_list(*OFFER_VALUES))
+            if len({offer[1] for offer in offers}) != len(offers):
+                raise ExchangeConflict('Only one offer per book can be accepted.')
+            if len({offer[2] for offer in offers}) != len(offers):
+                raise ExchangeConflict('A book can only be given in one exchange.')
+            if not offers:
+                return 0
+
+            Exchange.objects.filter(pk__in=[offer[0] for offer in offers]).transition(
+                Exchange.State.ACCEPTED, date_exchanged=timezone.now().date(),
+            )
+            books = Book.objects.filter(pk__in={book_id for offer in offers for book_id in offer[1:3]})
+            books.withdraw()
+            books.refresh_availability(removed=ListingChange.Kind.EXCHANGED)
+            publish_replies(offers, 'accepted')
+            return len(offers)
+
+# the values of offers their replies are published with, see publish_replies
+OFFER_VALUES = ('pk', 'book_offered_id', 'book_returned_id', 'book_returned__original_owner_id')
+
+def publish_replies(offers, name):
+    '''
+    Lets the users who made the offers (rows of OFFER_VALUES) know they were accepted or declined
+    '''
+    from .events import publish
+    for pk, book_id, book_returned_id, offerer_id in offers:
+        publish([offerer_id], name, exchange=pk, book=book_id, book_returned=book_returned_id)
+
 class Exchange(models.Model):
     '''
-    This model keeps track of all information about books that are available for exchange,
-    as well as all other exchanges that have already occured, using the 'status' field.
+    This model keeps track of books that are available for exchange, and of the offers made for them.
+    A book is listed with an AVAILABLE exchange, and every offer of another book for it is a PENDING
+    exchange with book_returned set. Accepting an offer closes the listing and declines the other offers.
     '''
+    class State(models.IntegerChoices):
+        AVAILABLE = 1, 'AVAILABLE'
+        PENDING = 2, 'PENDING'
+        ACCEPTED = 3, 'ACCEPTED'
+        DECLINED = 4, 'DECLINED'
+        CLOSED = 5, 'CLOSED'
+
+    # the states each state can move to, see ExchangeQuerySet.transition
+    TRANSITIONS = {
+        State.AVAILABLE: {State.CLOSED},
+        State.PENDING: {State.ACCEPTED, State.DECLINED},
+        State.ACCEPTED: set(),
+        State.DECLINED: set(),
+        State.CLOSED: set(),
+    }
+
     book_offered = models.ForeignKey(Book, models.CASCADE, related_name='book_offered')
     book_returned = models.ForeignKey(Book, models.SET_NULL, null=True, related_name='book_returned')
-    status = models.ForeignKey(Status, models.CASCADE)
+    state = models.PositiveSmallIntegerField(choices=State.choices, default=State.AVAILABLE)
+    # bumped by every transition, clients can send it back to only act on the version they have seen
+    version = models.PositiveIntegerField(default=0)
     date_published = models.DateField(auto_now=True)
     date_exchanged = models.DateField(auto_now=True, auto_now_add=False, null=True)
 
+    objects = ExchangeQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['book_offered', 'state'], name='exchange_book_state_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Book.objects.filter(pk=self.book_offered_id).refresh_availability()
+
 class Sale(models.Model):
     '''
     This model keeps track of all information about books that are available for sale,
@@ -101,4 +352,137 @@ class Sale(models.Model):
     status = models.ForeignKey(Status, models.CASCADE)
     date_published = models.DateField(auto_now=True)
     date_sold = models.DateField(auto_now=True, auto_now_add=False, null=True)
-    price = models.DecimalField(max_digits=10, decimal_places=2)
\ No newline at end of file
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['book', 'status'], name='sale_book_status_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Book.objects.filter(pk=self.book_id).refresh_availability()
+
+class Listing(models.Model):
+    '''
+    A flat copy of an available book with everything BookSerializer shows, so browsing
+    reads a single table without joins. There is one row per available book, kept up to date
+    by api.listings whenever the book, its sales, exchanges, images, owner, author or genre change.
+    '''
+    book = models.OneToOneField(Book, models.CASCADE, primary_key=True, related_name='listing')
+    name = models.CharField(max_length=100)
+    owner_id = models.BigIntegerField()
+    owner_first_name = models.CharField(max_length=50)
+    owner_last_name = models.CharField(max_length=50)
+    owner_email = models.EmailField(blank=True)
+    owner_city = models.CharField(max_length=50)
+    # the owner's city, listings are browsed one city at a time
+    city_id = models.BigIntegerField()
+    author_id = models.BigIntegerField()
+    author_first_name = models.CharField(max_length=50)
+    author_last_name = models.CharField(max_length=50)
+    genre = models.CharField(max_length=50)
+    edition = models.CharField(max_length=4)
+    preservation_level = models.IntegerField()
+    date_published = models.DateTimeField()
+    for_sale = models.BooleanField()
+    for_exchange = models.BooleanField()
+    price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    # the book's images by id, with the storage names of the image and its derivatives
+    images = models.JSONField(default=list)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['date_published', 'book'], name='listing_published_idx'),
+            models.Index(fields=['city_id', 'date_published', 'book'], name='listing_city_published_idx'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+class ListingChange(models.Model):
+    '''
+    An entry of the change feed of listings (/books/changes/): a book that got listed, changed,
+    was sold, exchanged, unlisted or deleted. Ids are the tokens of the feed, see api.changes.
+    The book is a plain id, so changes of deleted books are kept.
+    '''
+    class Kind(models.IntegerChoices):
+        CREATED = 1, 'created'
+        UPDATED = 2, 'updated'
+        SOLD = 3, 'sold'
+        EXCHANGED = 4, 'exchanged'
+        UNLISTED = 5, 'unlisted'
+        DELETED = 6, 'deleted'
+
+    book_id = models.BigIntegerField()
+    kind = models.PositiveSmallIntegerField(choices=Kind.choices)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # compaction keeps the latest change of each book, and drops old ones
+            models.Index(fields=['book_id', 'id'], name='change_book_idx'),
+            models.Index(fields=['created_at'], name='change_created_idx'),
+        ]
+
+class Job(models.Model):
+    '''
+    A unit of background work run by manage.py run_jobs, see api.jobs. A job is due from run_at on.
+    A worker claims it by moving run_at past its lease, so the jobs of workers that died are
+    picked up again once their lease runs out. Keys make enqueueing the same work twice a no-op
+    for as long as the job is kept.
+    '''
+    class State(models.IntegerChoices):
+        QUEUED = 1, 'queued'
+        RUNNING = 2, 'running'
+        DONE = 3, 'done'
+        FAILED = 4, 'failed'
+
+    task = models.CharField(max_length=200)
+    arguments = models.JSONField(default=dict)
+    key = models.CharField(max_length=200, null=True, unique=True)
+    state = models.PositiveSmallIntegerField(choices=State.choices, default=State.QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'run_at'], name='job_due_idx'),
+            models.Index(fields=['finished_at'], name='job_finished_idx'),
+        ]
+
+class DeletingBooks(threading.local):
+    '''
+    Ids of the books the current thread is deleting through Book.delete() or a queryset's delete().
+    Their sales, exchanges and images are deleted with them, and don't refresh the availability,
+    version or listing of a book that is going away
+    '''
+    def __init__(self):
+        self.ids = set()
+
+    @contextmanager
+    def deleting(self, book_ids):
+        # removed again however the delete ends, a rolled back one included
+        book_ids = set(book_ids) - self.ids
+        self.ids |= book_ids
+        try:
+            yield
+        finally:
+            self.ids -= book_ids
+
+deleting_books = DeletingBooks()
+
+@receiver(post_delete, sender=Sale)
+def sale_deleted(sender, instance, **kwargs):
+    if instance.book_id not in deleting_books.ids:
+        Book.objects.filter(pk=instance.book_id).refresh_availability()
+
+@receiver(post_delete, sender=Exchange)
+def exchange_deleted(sender, instance, **kwargs):
+    if instance.book_offered_id not in deleting_books.ids:
+        Book.objects.filter(pk=instance.book_offered_id).refresh_availability()
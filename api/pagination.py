@@ -0,0 +1,131 @@
+import base64
+import json
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+class KeysetPagination(BasePagination):
+    '''
+    Paginates a queryset by the values of its ordering fields instead of an offset.
+    The cursor holds the ordering values of the last item of the previous page,
+    so every page is a single indexed range scan, no matter how deep it is.
+    '''
+    ordering = ('-id',)
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        page_size = api_settings.PAGE_SIZE
+        if self.page_size_query_param in request.query_params:
+            try:
+                page_size = int(request.query_params[self.page_size_query_param])
+            except ValueError:
+                pass
+        return max(1, min(page_size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.model = queryset.model
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(request)
+        if position is not None:
+            queryset = queryset.filter(self.keyset_filter(position))
+
+        # one extra row tells whether there is a next page
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        results = results[:self.page_size]
+        self.next_position = self.get_position(results[-1]) if self.has_next else None
+        return results
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def field_names(self):
+        return [field.lstrip('-') for field in self.ordering]
+
+    def get_position(self, instance):
+        # rows of a values() queryset are dicts
+        if isinstance(instance, dict):
+            return [instance[name] for name in self.field_names()]
+        return [getattr(instance, name) for name in self.field_names()]
+
+    def keyset_filter(self, position):
+        '''
+        Rows that come after the given position, e.g. for ordering (-a, -b):
+        a < x OR (a = x AND b < y)
+        '''
+        condition = Q()
+        equal = Q()
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def encode_cursor(self, position):
+        # dates are kept as full precision strings, and parsed back by their model field
+        values = [value if isinstance(value, (int, float, str)) else str(value) for value in position]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            names = self.field_names()
+            if not isinstance(values, list) or len(values) != len(names):
+                raise ValueError
+            return [self.to_python(name, value) for name, value in zip(names, values)]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def to_python(self, name, value):
+        try:
+            return self.model._meta.get_field(name).to_python(value)
+        except FieldDoesNotExist:
+            # annotations, e.g. a search rank, are stored as plain json values
+            if not isinstance(value, (int, float, str)):
+                raise ValueError
+            return value
+
+class BookPagination(KeysetPagination):
+    '''
+    Newest listings first
+    '''
+    ordering = ('-date_published', '-id')
+
+class ListingPagination(KeysetPagination):
+    '''
+    Newest listings first, in the same order and with the same cursors as BookPagination
+    '''
+    ordering = ('-date_published', '-book_id')
+
+class UserPagination(KeysetPagination):
+    ordering = ('id',)
+
+class SearchPagination(KeysetPagination):
+    '''
+    Most relevant search results first
+    '''
+    ordering = ('-rank', '-id')
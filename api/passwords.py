@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.contrib.auth.hashers import (
+    PBKDF2PasswordHasher, ScryptPasswordHasher, check_password, get_hasher, identify_hasher, make_password,
+)
+
+logger = logging.getLogger(__name__)
+
+class TunedPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    '''
+    pbkdf2_sha256 with PASSWORD_PBKDF2_ITERATIONS, older hashes are rehashed on login
+    '''
+    iterations = settings.PASSWORD_PBKDF2_ITERATIONS
+
+class TunedScryptPasswordHasher(ScryptPasswordHasher):
+    '''
+    scrypt with PASSWORD_SCRYPT_WORK_FACTOR. Every hash in progress holds 128 * work_factor * 8 bytes
+    of memory, which PASSWORD_HASHING_WORKERS keeps bounded
+    '''
+    work_factor = settings.PASSWORD_SCRYPT_WORK_FACTOR
+
+class HashingBusy(Exception):
+    pass
+
+class HashingPool:
+    '''
+    A bounded pool of threads that hash passwords. hashlib releases the GIL while hashing,
+    so a uWSGI worker keeps serving its other threads, and at most PASSWORD_HASHING_WORKERS
+    cores per process are spent on it. When PASSWORD_HASHING_QUEUE_SIZE passwords are already
+    waiting, callers wait for a place. A caller whose password isn't hashed within
+    PASSWORD_HASHING_TIMEOUT seconds, waiting included, gets HashingBusy.
+    '''
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = None
+
+    def executor(self):
+        # created on first use, so every forked worker gets its own threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=settings.PASSWORD_HASHING_WORKERS, thread_name_prefix='password-hashing',
+                )
+                self._slots = threading.BoundedSemaphore(
+                    settings.PASSWORD_HASHING_WORKERS + settings.PASSWORD_HASHING_QUEUE_SIZE,
+                )
+            return self._executor
+
+    def run(self, fn, *args):
+        executor = self.executor()
+        deadline = time.monotonic() + settings.PASSWORD_HASHING_TIMEOUT
+        if not self._slots.acquire(timeout=settings.PASSWORD_HASHING_TIMEOUT):
+            logger.warning('password hashing queue is full')
+            raise HashingBusy()
+        try:
+            future = executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except TimeoutError:
+            # a hash that hasn't started is dropped, one that has frees its place when it's done
+            future.cancel()
+            logger.warning('password hashing took longer than %ss', settings.PASSWORD_HASHING_TIMEOUT)
+            raise HashingBusy()
+
+pool = HashingPool()
+
+def verify(password, encoded):
+    '''
+    Checks a password against its hash, and returns whether it matched and,
+    when the hash uses another hasher or other parameters than the preferred one, a new hash
+    '''
+    if not check_password(password, encoded):
+        return False, None
+    hasher = get_hasher()
+    current = identify_hasher(encoded)
+    if current.algorithm != hasher.algorithm or hasher.must_update(encoded):
+        return True, make_password(password, hasher=hasher)
+    return True, None
+
+def hash_password(password):
+    return pool.run(make_password, password)
+
+def verify_password(password, django_user):
+    '''
+    Checks the password of a Django user, and upgrades its hash when needed
+    '''
+    matches, upgraded = pool.run(verify, password, django_user.password)
+    if upgraded is not None:
+        django_user.password = upgraded
+        django_user.save(update_fields=['password'])
+    return matches
@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+from django.db.models.signals import post_save, post_delete
+
+from .models import Status, City, Genre, Author
+
+class ReferenceCache:
+    '''
+    Keeps rows of a rarely changing model in the memory of the current worker process,
+    so they can be looked up by any of the given fields without querying the database.
+    The cache is cleared whenever a row of the model is saved or deleted in this process,
+    and expires after REFERENCE_CACHE_TTL seconds so changes made by other workers are picked up.
+    The threads of a worker share the cache, a row loaded while it was cleared isn't kept.
+    Models whose rows keep growing pass a max_size, the least recently used rows are then dropped.
+    '''
+    def __init__(self, model, fields, max_size=None):
+        self.model = model
+        self.fields = fields
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._loaded_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _key(self, lookup):
+        (field, value), = lookup.items()
+        if field == 'pk':
+            field = 'id'
+        if field not in self.fields:
+            raise ValueError(f'{self.model.__name__} can not be looked up by {field}')
+        return field, self.model._meta.get_field(field).to_python(value)
+
+    def _store(self, rows, instance):
+        for field in self.fields:
+            rows[field, getattr(instance, field)] = instance
+        if self.max_size is not None:
+            while len(rows) > self.max_size:
+                rows.popitem(last=False)
+
+    def _expire(self):
+        if time.monotonic() - self._loaded_at > settings.REFERENCE_CACHE_TTL:
+            self.invalidate()
+
+    def get(self, **lookup):
+        '''
+        Returns the row matching a single lookup, e.g. get(name='AVAILABLE').
+        Raises the model's DoesNotExist just like the manager would.
+        '''
+        key = self._key(lookup)
+        self._expire()
+        with self._lock:
+            rows = self._rows
+            instance = rows.get(key)
+            if instance is not None:
+                rows.move_to_end(key)
+                self.hits += 1
+                return instance
+            self.misses += 1
+        field, value = key
+        instance = self.model.objects.get(**{field: value})
+        with self._lock:
+            # stored in the rows it was missing from, which are dropped if the cache was cleared meanwhile
+            self._store(rows, instance)
+        return instance
+
+    def exists(self, **lookup):
+        try:
+            self.get(**lookup)
+            return True
+        except self.model.DoesNotExist:
+            return False
+
+    def warm(self):
+        '''
+        Loads every row of the model with a single query, or the newest max_size rows
+        '''
+        current = self._rows
+        rows = OrderedDict()
+        instances = self.model.objects.order_by('pk')
+        if self.max_size is not None:
+            # the newest last, as the most recently used
+            instances = reversed(list(self.model.objects.order_by('-pk')[:self.max_size // len(self.fields)]))
+        for instance in instances:
+            self._store(rows, instance)
+        with self._lock:
+            # unless the cache was cleared while loading
+            if self._rows is current:
+                self._rows = rows
+                self._loaded_at = time.monotonic()
+
+    def invalidate(self, *args, **kwargs):
+        with self._lock:
+            self._rows = OrderedDict()
+            self._loaded_at = time.monotonic()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._rows),
+            'max_size': self.max_size,
+        }
+
+statuses = ReferenceCache(Status, ('id', 'name'))
+cities = ReferenceCache(City, ('id', 'name'))
+genres = ReferenceCache(Genre, ('id', 'name'))
+authors = ReferenceCache(Author, ('id',), max_size=settings.AUTHOR_CACHE_SIZE)
+
+reference_caches = [statuses, cities, genres, authors]
+
+def connect_signals():
+    '''
+    Clears a model's cache whenever one of its rows is saved or deleted,
+    whether through the API or the admin page
+    '''
+    for cache in reference_caches:
+        post_save.connect(cache.invalidate, sender=cache.model, weak=False)
+        post_delete.connect(cache.invalidate, sender=cache.model, weak=False)
+
+def warm_reference_caches():
+    '''
+    Fills every cache at startup. uWSGI loads the application in the master process
+    before forking, so the connection used here is closed to keep workers from sharing it.
+    '''
+    try:
+        for cache in reference_caches:
+            cache.warm()
+    except DatabaseError:
+        # e.g. before the first migration, the caches then fill lazily
+        pass
+    finally:
+        connections.close_all()
+
+def reference_cache_stats():
+    return {cache.model.__name__: cache.stats() for cache in reference_caches}
@@ -0,0 +1,26 @@
+import orjson
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+class FastJSONRenderer(JSONRenderer):
+    '''
+    JSONRenderer encoding with orjson. With DRF's default compact and unicode output it produces
+    the same bytes as JSONRenderer, several times faster on big lists. Dates, decimals and other
+    types orjson doesn't handle the same way go through DRF's encoder, and indented output,
+    which clients can ask for in the Accept header, is left to JSONRenderer.
+    '''
+    encoder = JSONEncoder()
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context) or not self.compact or self.ensure_ascii:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder.default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        except orjson.JSONEncodeError:
+            # e.g. integers over 64 bits or keys that aren't strings
+            return super().render(data, accepted_media_type, renderer_context)
+        # escaped like JSONRenderer does, so the output can be embedded in javascript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
@@ -0,0 +1,153 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# replication delay of a postgres standby in seconds, 0 while it has replayed everything it received,
+# so an idle primary doesn't make its replicas look late
+LAG_SQL = '''
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END
+'''
+
+class RoutingState:
+    '''
+    Where the reads of one request go. Reads use the chosen replica once the view allowed it,
+    until the request writes anything: from then on they see the primary, like every write does
+    '''
+    def __init__(self):
+        self.replica = None
+        self.wrote = False
+
+current = contextvars.ContextVar('database_routing', default=None)
+
+def start_request():
+    state = RoutingState()
+    return state, current.set(state)
+
+class ReplicaMonitor:
+    '''
+    Measures the replication lag of every replica at most every REPLICA_LAG_CHECK_INTERVAL seconds
+    per process. Replicas that are further behind than REPLICA_MAX_LAG, or can't be reached, get no reads
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lags = {}
+
+    def measure(self, alias):
+        try:
+            connection = connections[alias]
+            if connection.vendor != 'postgresql':
+                # e.g. a second SQLite file for local testing, which is never behind
+                return 0.0
+            with connection.cursor() as cursor:
+                cursor.execute(LAG_SQL)
+                return float(cursor.fetchone()[0])
+        except DatabaseError:
+            logger.warning('replica %s can not be reached', alias, exc_info=True)
+            return None
+
+    def lag(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            checked = self._lags.get(alias)
+            if checked is not None and now - checked[0] < settings.REPLICA_LAG_CHECK_INTERVAL:
+                return checked[1]
+            # other threads keep using the last measurement while this one is taken
+            self._lags[alias] = (now, checked[1] if checked else None)
+        lag = self.measure(alias)
+        with self._lock:
+            self._lags[alias] = (now, lag)
+        if lag is not None and lag > settings.REPLICA_MAX_LAG:
+            logger.warning('replica %s is %.1fs behind, reading from the primary', alias, lag)
+        return lag
+
+    def healthy(self):
+        replicas = []
+        for alias in settings.DATABASE_REPLICAS:
+            lag = self.lag(alias)
+            if lag is not None and lag <= settings.REPLICA_MAX_LAG:
+                replicas.append(alias)
+        return replicas
+
+monitor = ReplicaMonitor()
+
+def pin_key(django_user_id):
+    return f'replica:pinned:{django_user_id}'
+
+def pin(django_user_id):
+    '''
+    Sends the user's reads to the primary for REPLICA_PIN_SECONDS, so they see their own writes
+    even while the replicas are behind
+    '''
+    cache.set(pin_key(django_user_id), True, max(settings.REPLICA_PIN_SECONDS, settings.REPLICA_MAX_LAG))
+
+def is_pinned(django_user_id):
+    return cache.get(pin_key(django_user_id)) is not None
+
+def read_from_replicas(request):
+    '''
+    Lets the reads of the current request go to a replica, unless it isn't a safe request,
+    the user wrote within REPLICA_PIN_SECONDS, or no replica is healthy
+    '''
+    state = current.get()
+    if state is None or not settings.DATABASE_REPLICAS or request.method not in SAFE_METHODS:
+        return
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated and is_pinned(user.id):
+        return
+    replicas = monitor.healthy()
+    if replicas:
+        # one replica for the whole request, so its reads come from the same point in time
+        state.replica = random.choice(replicas)
+
+def replica_may_be_behind(changed_at):
+    '''
+    Whether the current request reads from a replica that might not have data changed
+    at the given time (a timestamp) yet. Such reads shouldn't be cached
+    '''
+    state = current.get()
+    if state is None or state.replica is None or state.wrote:
+        return False
+    return time.time() - changed_at < settings.REPLICA_MAX_LAG
+
+class ReplicaRouter:
+    '''
+    Writes always go to the primary ('default'). Reads go to a replica only when the view
+    allowed it for the current request, see ReplicaReadsMixin
+    '''
+    def db_for_read(self, model, **hints):
+        state = current.get()
+        if state is None or state.replica is None or state.wrote:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            # reads inside a transaction belong with it
+            return DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = current.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+class ReplicaReadsMixin:
+    '''
+    Serves safe requests of an APIView from a replica, once the user is authenticated
+    '''
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        read_from_replicas(request)
@@ -0,0 +1,106 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramWordSimilarity
+from django.db import connection
+from django.db.models import Case, CharField, F, FloatField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Cast, Concat, Greatest
+from django.db.models.signals import post_save
+
+from .models import Book, Author, Genre
+from .jobs import task, enqueue
+
+# book names are mostly in Serbian, which postgres has no stemmer for
+SEARCH_CONFIG = 'simple'
+
+def is_postgres():
+    return connection.vendor == 'postgresql'
+
+def refresh_search_documents(books):
+    '''
+    Rebuilds the searchable text of the given books from their name, author and genre
+    with a single UPDATE. On postgres the weighted tsvector is rebuilt as well.
+    '''
+    author = Subquery(
+        Author.objects.filter(pk=OuterRef('author')).values(
+            name=Concat('first_name', Value(' '), 'last_name', output_field=CharField())
+        )[:1],
+        output_field=CharField(),
+    )
+    genre = Subquery(Genre.objects.filter(pk=OuterRef('genre')).values('name')[:1], output_field=CharField())
+    fields = {
+        'search_document': Concat('name', Value(' '), author, Value(' '), genre, output_field=CharField()),
+    }
+    if is_postgres():
+        fields['search_vector'] = (
+            SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector(author, weight='B', config=SEARCH_CONFIG)
+            + SearchVector(genre, weight='C', config=SEARCH_CONFIG)
+        )
+    Book.objects.filter(pk__in=books.values('pk')).update(**fields)
+
+@task
+def refresh_search(book_id=None, author_id=None, genre_id=None):
+    '''
+    Rebuilds the search documents of a book, or of every book of an author or genre, in the job worker
+    '''
+    lookups = {'pk': book_id, 'author': author_id, 'genre': genre_id}
+    refresh_search_documents(Book.objects.filter(**{field: value for field, value in lookups.items() if value is not None}))
+
+# the documents are rebuilt by a job queued in the transaction that saved the book, author or genre,
+# so saving doesn't wait on the rebuild and an author's rename doesn't rewrite all their books inline
+
+def book_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not {'name', 'author', 'genre'} & set(update_fields):
+        return
+    enqueue(refresh_search, book_id=instance.pk)
+
+def author_saved(sender, instance, created, **kwargs):
+    if not created:
+        enqueue(refresh_search, author_id=instance.pk)
+
+def genre_saved(sender, instance, created, **kwargs):
+    if not created:
+        enqueue(refresh_search, genre_id=instance.pk)
+
+def connect_signals():
+    post_save.connect(book_saved, sender=Book)
+    post_save.connect(author_saved, sender=Author)
+    post_save.connect(genre_saved, sender=Genre)
+
+def search_books(queryset, q):
+    '''
+    Filters the given books down to the ones matching the query,
+    and annotates them with a relevance 'rank'
+    '''
+    if is_postgres():
+        return postgres_search(queryset, q)
+    return fallback_search(queryset, q)
+
+def postgres_search(queryset, q):
+    '''
+    Full text matches use the GIN index on search_vector,
+    while misspelled words are caught by the trigram index on search_document
+    '''
+    query = SearchQuery(q, config=SEARCH_CONFIG, search_type='websearch')
+    return queryset.filter(
+        Q(search_vector=query) | Q(search_document__trigram_word_similar=q)
+    ).annotate(
+        # ranks are single precision, casting them keeps the pagination cursor exact
+        rank=Cast(Greatest(
+            SearchRank(F('search_vector'), query),
+            TrigramWordSimilarity(q, 'search_document'),
+        ), FloatField())
+    )
+
+def fallback_search(queryset, q):
+    '''
+    Substring matching for databases without full text search (e.g. sqlite in development).
+    Every word has to appear somewhere, and words that appear in the book's name rank higher.
+    '''
+    rank = Value(0.0, output_field=FloatField())
+    for term in q.split():
+        queryset = queryset.filter(search_document__icontains=term)
+        rank = rank + Case(
+            When(name__icontains=term, then=Value(1.0)),
+            default=Value(0.5),
+            output_field=FloatField(),
+        )
+    return queryset.annotate(rank=rank)
@@ -0,0 +1,103 @@
+class InvalidSelection(ValueError):
+    pass
+
+class Shape:
+    '''
+    The fields of a serialized resource in their order, which of them are relations
+    that can be expanded, and the shapes of the nested resources
+    '''
+    def __init__(self, fields, expandable=(), nested=None):
+        self.fields = tuple(fields)
+        self.expandable = frozenset(expandable)
+        self.nested = nested or {}
+
+BOOK = Shape(
+    ('name', 'original_owner', 'author', 'genre', 'edition', 'preservation_level',
+     'image_set', 'images', 'id', 'for_sale', 'price', 'for_exchange'),
+    expandable=('original_owner', 'author'),
+)
+SALE = Shape(
+    ('book', 'buyer', 'status', 'date_published', 'date_sold', 'price'),
+    expandable=('book', 'buyer'),
+    nested={'book': BOOK},
+)
+EXCHANGE = Shape(
+    ('id', 'book_offered', 'book_returned', 'status', 'version', 'date_published', 'date_exchanged'),
+    expandable=('book_offered', 'book_returned'),
+    nested={'book_offered': BOOK, 'book_returned': BOOK},
+)
+
+def parse_names(value):
+    return frozenset(name.strip() for name in value.split(',') if name.strip())
+
+class Selection:
+    '''
+    The fields and expanded relations a client asked for with the 'fields' and 'expand' parameters,
+    e.g. ?fields=name,price,images&expand= on books, or ?fields=price,book.name,book.author&expand=book
+    on sales. Fields of nested resources are named with dots. Relations that aren't expanded are
+    shown as their id. Without 'fields' every field is shown, and without 'expand' every relation
+    is expanded, so responses keep their full shape unless a client asks for less
+    '''
+    def __init__(self, shape, fields=None, expand=None):
+        self.shape = shape
+        self.fields = fields
+        self.expand = expand
+
+    @classmethod
+    def from_request(cls, request, shape):
+        params = request.query_params
+        selection = cls(
+            shape,
+            parse_names(params['fields']) if 'fields' in params else None,
+            parse_names(params['expand']) if 'expand' in params else None,
+        )
+        selection.validate()
+        return selection
+
+    def validate(self):
+        for path in self.fields or ():
+            if not self.valid(path, self.shape, lambda shape, name: name in shape.fields):
+                raise InvalidSelection(f'Unknown field \'{path}\'.')
+        for path in self.expand or ():
+            if not self.valid(path, self.shape, lambda shape, name: name in shape.expandable):
+                raise InvalidSelection(f'The field \'{path}\' can not be expanded.')
+
+    def valid(self, path, shape, allowed):
+        name, _, rest = path.partition('.')
+        if not allowed(shape, name):
+            return False
+        if not rest:
+            return True
+        return name in shape.nested and self.valid(rest, shape.nested[name], allowed)
+
+    def includes(self, name):
+        if self.fields is None or name in self.fields:
+            return True
+        prefix = name + '.'
+        return any(path.startswith(prefix) for path in self.fields)
+
+    def expands(self, name):
+        return self.expand is None or name in self.expand
+
+    def included(self):
+        return [name for name in self.shape.fields if self.includes(name)]
+
+    def nested(self, name):
+        '''
+        The selection of the resource in the given field, e.g. 'book' of a sale
+        '''
+        prefix = name + '.'
+        def strip(paths):
+            return frozenset(path[len(prefix):] for path in paths if path.startswith(prefix))
+        fields = None if self.fields is None or name in self.fields else strip(self.fields)
+        expand = None if self.expand is None else strip(self.expand)
+        return Selection(self.shape.nested[name], fields, expand)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Selection) and
+            (self.shape, self.fields, self.expand) == (other.shape, other.fields, other.expand)
+        )
+
+    def __hash__(self):
+        return hash((id(self.shape), self.fields, self.expand))
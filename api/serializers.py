@@ -1,6 +1,7 @@
+from django.core.files.storage import default_storage
 from rest_framework import serializers
 
-from .models import City, User, Genre, Author, Book, Image, Status, Exchange, Sale
+from .models import City, User, Genre, Author, Book, Image, Status, Exchange, Sale, Listing
 
 class CitySerializer(serializers.ModelSerializer):
     class Meta:
@@ -9,7 +10,7 @@ class CitySerializer(serializers.ModelSerializer):
 
 class UserSerializer(serializers.ModelSerializer):
     city = serializers.SlugRelatedField(read_only=True, slug_field='name')
-    email = serializers.EmailField()
+    email = serializers.EmailField(source='django_user.email', read_only=True)
     class Meta:
         model = User
         fields = ("id", "first_name", "last_name", "email", "city")
@@ -24,43 +25,101 @@ class AuthorSerializer(serializers.ModelSerializer):
         model = Author
         fields = ("first_name", "last_name", 'id')
 
+class ImageSerializer(serializers.ModelSerializer):
+    # book = BookSerializer(many = True)
+    image = serializers.ImageField()
+    class Meta:
+        model = Image
+        fields = ("id", "image", "thumbnail", "webp", "avif", "book")
+
 class BookSerializer(serializers.ModelSerializer):
     # image_set = serializers.SlugRelatedField(read_only = True, many=True, slug_field='image')
     original_owner = UserSerializer()
     author = AuthorSerializer()
     genre = serializers.SlugRelatedField(read_only=True, slug_field='name')
     for_sale = serializers.BooleanField()
-    price = serializers.DecimalField(10, 2)
+    price = serializers.DecimalField(10, 2, source='current_price')
     for_exchange = serializers.BooleanField()
+    images = ImageSerializer(source='image_set', many=True, read_only=True)
     class Meta:
         model = Book
-        fields = ("name", "original_owner", "author", "genre", "edition", "preservation_level", "image_set", 'id', 'for_sale', 'price', 'for_exchange')
+        fields = ("name", "original_owner", "author", "genre", "edition", "preservation_level", "image_set", "images", 'id', 'for_sale', 'price', 'for_exchange')
 
-class ImageSerializer(serializers.ModelSerializer):
-    # book = BookSerializer(many = True)
-    image = serializers.ImageField()
+# ListingSerializer, ExchangeSerializer and SaleSerializer are no longer used by the views, which
+# serialize through api.fast_serializers. They are kept as the reference output the fast path
+# has to match byte for byte, see manage.py bench_serializers.
+
+class ListingSerializer(serializers.ModelSerializer):
+    '''
+    Serializes listings in the same shape as BookSerializer serializes their books
+    '''
+    original_owner = serializers.SerializerMethodField()
+    author = serializers.SerializerMethodField()
+    image_set = serializers.SerializerMethodField()
+    images = serializers.SerializerMethodField()
+    id = serializers.IntegerField(source='book_id')
     class Meta:
-        model = Image
-        fields = ("image", "book")
+        model = Listing
+        fields = ("name", "original_owner", "author", "genre", "edition", "preservation_level", "image_set", "images", 'id', 'for_sale', 'price', 'for_exchange')
+
+    def get_original_owner(self, listing):
+        return {
+            'id': listing.owner_id,
+            'first_name': listing.owner_first_name,
+            'last_name': listing.owner_last_name,
+            'email': listing.owner_email,
+            'city': listing.owner_city,
+        }
+
+    def get_author(self, listing):
+        return {'first_name': listing.author_first_name, 'last_name': listing.author_last_name, 'id': listing.author_id}
+
+    def get_image_set(self, listing):
+        return [image['id'] for image in listing.images]
+
+    def get_images(self, listing):
+        return [
+            {
+                'id': image['id'],
+                'image': self.file_url(image['image']),
+                'thumbnail': self.file_url(image['thumbnail']),
+                'webp': self.file_url(image['webp']),
+                'avif': self.file_url(image['avif']),
+                'book': image['book'],
+            }
+            for image in listing.images
+        ]
+
+    def file_url(self, name):
+        # the same as ImageSerializer's image fields
+        if not name:
+            return None
+        url = default_storage.url(name)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request is not None else url
 
 class StatusSerializer(serializers.ModelSerializer):
     class Meta:
         model = Status
-        fields = ("name")
+        fields = ("name",)
 
 class ExchangeSerializer(serializers.ModelSerializer):
-    book_offered = BookSerializer(many = True)
-    book_returned = BookSerializer(many = True)
-    status = StatusSerializer()
+    book_offered = BookSerializer()
+    book_returned = BookSerializer()
+    status = serializers.SerializerMethodField()
     class Meta:
         model = Exchange
-        fields = ("book_offered", "book_returned", "status", "date_published", "date_exchanged")
+        fields = ("id", "book_offered", "book_returned", "status", "version", "date_published", "date_exchanged")
+
+    def get_status(self, exchange):
+        # the same shape as the status of a sale
+        return {'name': exchange.get_state_display()}
 
 class SaleSerializer(serializers.ModelSerializer):
-    book = BookSerializer(many = True)
+    book = BookSerializer()
     status = StatusSerializer()
-    buyer = UserSerializer(many = True)
+    buyer = UserSerializer()
     class Meta:
         model = Sale
-        fields = ("book", "status", "date_published", "date_sold", "price")
+        fields = ("book", "buyer", "status", "date_published", "date_sold", "price")
 
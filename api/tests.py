@@ -1,3 +1,911 @@
-from django.test import TestCase
+import asyncio
+import io
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User as DjangoUser
+from django.core.cache import cache
+from django.db import DatabaseError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+
+from .authentication import tokens_for
+from .events import LocalBroker, event_stream, publish, redeem_ticket
+from .images import DerivativePool, render_image
+from .passwords import HashingBusy, HashingPool
+from .renderers import FastJSONRenderer
+from .serializers import BookSerializer, ExchangeSerializer, ListingSerializer, SaleSerializer
+from . import replicas
+from .jobs import backoff, claim, enqueue, run, task, task_name
+from .fast_serializers import book_values, listing_values, serialize_books, serialize_exchanges, serialize_listings, serialize_sales
+from .models import User, City, Author, Genre, Book, Image, Status, Sale, Exchange, Listing, ListingChange, Job, deleting_books
+from .reference import ReferenceCache, statuses, cities, genres, authors
+
+calls = []
+
+@task
+def record_call(value):
+    calls.append(value)
+
+@task
+def fail(value):
+    raise RuntimeError(value)
+
+def run_jobs():
+    '''
+    Runs the due jobs in the test's transaction, as a worker would once it committed
+    '''
+    while (job := claim()) is not None:
+        run(job)
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ApiTestCase(TestCase):
+    '''
+    Three users of the same city, and create_book to list books of theirs for sale or exchange
+    '''
+    def setUp(self):
+        cache.clear()
+        for reference in (statuses, cities, genres, authors):
+            reference.invalidate()
+        for name in ('AVAILABLE', 'PENDING', 'UNAVAILABLE'):
+            Status.objects.get_or_create(name=name)
+        self.city = City.objects.create(name='Beograd')
+        self.author = Author.objects.create(first_name='Ivo', last_name='Andric')
+        self.genre = Genre.objects.create(name='Drama')
+        self.users = [self.create_user(f'user{i}@example.com') for i in range(3)]
+
+    def create_user(self, email, city=None):
+        django_user = DjangoUser.objects.create(username=email, email=email)
+        return User.objects.create(first_name='Petar', last_name='Petrovic', django_user=django_user, city=city or self.city)
+
+    def create_book(self, owner, price=None, exchange=False, **fields):
+        fields = {'name': 'Na Drini cuprija', 'author': self.author, 'genre': self.genre, 'edition': '1', 'preservation_level': 3, **fields}
+        book = Book.objects.create(original_owner=owner, **fields)
+        if price is not None:
+            Sale.objects.create(book=book, status=statuses.get(name='AVAILABLE'), price=price)
+        if exchange:
+            Exchange.objects.create(book_offered=book)
+        return book
+
+    def client_for(self, user=None):
+        client = APIClient()
+        if user is not None:
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {tokens_for(user.django_user).access_token}')
+        return client
+
+class BookAvailabilityTests(ApiTestCase):
+    def post(self, **data):
+        data = {'name': 'Prokleta avlija', 'author': self.author.id, 'genre': self.genre.id, 'edition': '1', 'preservation_level': 4, **data}
+        return self.client_for(self.users[0]).post('/books/', data, format='json')
+
+    def test_post(self):
+        response = self.post(for_sale='true', price='120.50', for_exchange='true')
+        self.assertEqual(response.status_code, 201)
+        book = Book.objects.get(pk=response.json()['id'])
+        self.assertEqual((book.for_sale, book.for_exchange, str(book.current_price)), (True, True, '120.50'))
+        listing = Listing.objects.get(book=book)
+        self.assertEqual((listing.for_sale, listing.for_exchange, str(listing.price)), (True, True, '120.50'))
+        self.assertFalse(Book.objects.availability_drift().exists())
+
+    def test_invalid_post_creates_nothing(self):
+        for data in ({'for_sale': 'true', 'price': 'abc'}, {'author': 0}, {'preservation_level': 'x'}, {'name': None}):
+            self.assertEqual(self.post(**data).status_code, 400)
+        self.assertFalse(Book.objects.exists())
+        self.assertFalse(Sale.objects.exists())
+
+    def test_delete(self):
+        book = self.create_book(self.users[0], price=100, exchange=True)
+        self.assertEqual(self.client_for(self.users[0]).delete(f'/books/{book.id}/').status_code, 204)
+        self.assertFalse(Listing.objects.filter(book_id=book.id).exists())
+        self.assertFalse(Exchange.objects.filter(book_offered_id=book.id).exists())
+        self.assertEqual(deleting_books.ids, set())
+
+    def test_failed_delete_is_forgotten(self):
+        book = self.create_book(self.users[0], price=100)
+        with mock.patch('django.db.models.deletion.Collector.delete', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                book.delete()
+        self.assertEqual(deleting_books.ids, set())
+        # the book is still refreshed when its rows change
+        Sale.objects.filter(book=book).delete()
+        book.refresh_from_db()
+        self.assertFalse(book.for_sale)
+
+class BookBuyTests(ApiTestCase):
+    def buy(self, user, book):
+        return self.client_for(user).get(f'/books/{book.id}/buy/')
+
+    def offer(self, user, book, returned):
+        return self.client_for(user).post(f'/books/{book.id}/exchange/', {'book_id': returned.id}, format='json')
+
+    def test_buy(self):
+        book = self.create_book(self.users[0], price=100)
+        self.assertEqual(self.buy(self.users[1], book).status_code, 200)
+        sale = Sale.objects.get(book=book)
+        self.assertEqual(sale.buyer, self.users[1])
+        self.assertEqual(sale.status.name, 'UNAVAILABLE')
+        book.refresh_from_db()
+        self.assertFalse(book.for_sale)
+        self.assertFalse(Listing.objects.filter(book=book).exists())
+
+    def test_second_buyer_gets_a_conflict(self):
+        book = self.create_book(self.users[0], price=100)
+        self.assertEqual(self.buy(self.users[1], book).status_code, 200)
+        self.assertEqual(self.buy(self.users[2], book).status_code, 409)
+        self.assertEqual(Sale.objects.get(book=book).buyer, self.users[1])
+
+    def test_own_or_unlisted_book(self):
+        book = self.create_book(self.users[0], price=100)
+        self.assertEqual(self.buy(self.users[0], book).status_code, 400)
+        unlisted = self.create_book(self.users[0])
+        self.assertEqual(self.buy(self.users[1], unlisted).status_code, 400)
+        self.assertEqual(self.client_for(self.users[1]).get('/books/0/buy/').status_code, 404)
+        self.assertEqual(self.buy(None, book).status_code, 401)
+
+    def test_bought_book_is_no_longer_exchanged(self):
+        book = self.create_book(self.users[0], price=100, exchange=True)
+        offer = self.offer(self.users[2], book, self.create_book(self.users[2])).json()
+        self.assertEqual(self.buy(self.users[1], book).status_code, 200)
+
+        self.assertEqual(Exchange.objects.get(pk=offer['id']).state, Exchange.State.DECLINED)
+        self.assertEqual(Exchange.objects.get(book_offered=book, book_returned=None).state, Exchange.State.CLOSED)
+        response = self.client_for(self.users[0]).post(
+            f'/books/{book.id}/exchange-reply/', {'reply': 'accept', 'exchange_id': offer['id']}, format='json',
+        )
+        self.assertEqual(response.status_code, 409)
+        book.refresh_from_db()
+        self.assertFalse(book.for_exchange)
+
+    def test_exchanged_book_is_no_longer_sold(self):
+        book = self.create_book(self.users[0], price=100, exchange=True)
+        offer = self.offer(self.users[2], book, self.create_book(self.users[2])).json()
+        response = self.client_for(self.users[0]).post(
+            f'/books/{book.id}/exchange-reply/', {'reply': 'accept', 'exchange_id': offer['id']}, format='json',
+        )
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.buy(self.users[1], book).status_code, 409)
+        sale = Sale.objects.get(book=book)
+        self.assertEqual((sale.status.name, sale.buyer), ('UNAVAILABLE', None))
+        book.refresh_from_db()
+        self.assertFalse(book.for_sale)
+
+class ExchangeTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.book = self.create_book(self.users[0], exchange=True)
+        self.offered = [self.create_book(self.users[1]), self.create_book(self.users[2])]
+
+    def offer(self, user, book, target=None):
+        target = target or self.book
+        return self.client_for(user).post(f'/books/{target.id}/exchange/', {'book_id': book.id}, format='json')
+
+    def reply(self, **data):
+        return self.client_for(self.users[0]).post(f'/books/{self.book.id}/exchange-reply/', data, format='json')
+
+    def test_offers(self):
+        response = self.offer(self.users[1], self.offered[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['version'], 0)
+        self.assertEqual(Exchange.objects.get(pk=response.json()['id']).state, Exchange.State.PENDING)
+        # the same book again, and a book of someone else
+        self.assertEqual(self.offer(self.users[1], self.offered[0]).status_code, 409)
+        self.assertEqual(self.offer(self.users[1], self.offered[1]).status_code, 403)
+        self.assertEqual(self.offer(self.users[2], self.offered[1]).status_code, 200)
+
+    def test_accept_declines_competing_offers(self):
+        chosen = self.offer(self.users[1], self.offered[0]).json()
+        other = self.offer(self.users[2], self.offered[1]).json()
+        # several offers are pending, one has to be chosen
+        self.assertEqual(self.reply(reply='accept').status_code, 400)
+
+        response = self.reply(reply='accept', exchange_id=chosen['id'], version=chosen['version'])
+        self.assertEqual(response.status_code, 200)
+        states = dict(Exchange.objects.filter(book_offered=self.book).values_list('pk', 'state'))
+        listing = Exchange.objects.get(book_offered=self.book, book_returned=None)
+        self.assertEqual(states, {
+            listing.pk: Exchange.State.CLOSED,
+            chosen['id']: Exchange.State.ACCEPTED,
+            other['id']: Exchange.State.DECLINED,
+        })
+        self.assertEqual(Exchange.objects.get(pk=chosen['id']).version, 1)
+        self.book.refresh_from_db()
+        self.assertFalse(self.book.for_exchange)
+        # no longer listed
+        self.assertEqual(self.offer(self.users[2], self.offered[1]).status_code, 409)
+        self.assertEqual(self.reply(reply='decline', exchange_id=chosen['id']).status_code, 409)
+
+    def test_returned_book_is_taken_off_the_market(self):
+        returned = self.create_book(self.users[1], price=50, exchange=True)
+        elsewhere = self.create_book(self.users[2], exchange=True)
+        offer_elsewhere = self.offer(self.users[1], returned, target=elsewhere).json()
+        offer_for_returned = self.offer(self.users[2], self.offered[1], target=returned).json()
+        chosen = self.offer(self.users[1], returned).json()
+
+        self.assertEqual(self.reply(reply='accept', exchange_id=chosen['id']).status_code, 200)
+        self.assertEqual(Exchange.objects.get(pk=offer_elsewhere['id']).state, Exchange.State.DECLINED)
+        self.assertEqual(Exchange.objects.get(pk=offer_for_returned['id']).state, Exchange.State.DECLINED)
+        self.assertEqual(Exchange.objects.get(book_offered=returned, book_returned=None).state, Exchange.State.CLOSED)
+        self.assertEqual(Sale.objects.get(book=returned).status.name, 'UNAVAILABLE')
+        returned.refresh_from_db()
+        self.assertEqual((returned.for_sale, returned.for_exchange), (False, False))
+        self.assertFalse(Listing.objects.filter(book=returned).exists())
+        # it can neither be given in another exchange nor bought
+        response = self.client_for(self.users[2]).post(
+            f'/books/{elsewhere.id}/exchange-reply/', {'reply': 'accept', 'exchange_id': offer_elsewhere['id']}, format='json',
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client_for(self.users[2]).get(f'/books/{returned.id}/buy/').status_code, 409)
+
+    def test_stale_version(self):
+        offer = self.offer(self.users[1], self.offered[0]).json()
+        response = self.reply(reply='accept', exchange_id=offer['id'], version=offer['version'] + 1)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Exchange.objects.get(pk=offer['id']).state, Exchange.State.PENDING)
+        self.assertEqual(self.reply(reply='decline', exchange_id=offer['id'], version=offer['version']).status_code, 200)
+        self.assertEqual(Exchange.objects.get(pk=offer['id']).state, Exchange.State.DECLINED)
+
+    def test_transitions(self):
+        offer = Exchange.objects.offer(self.book.id, self.offered[0].id)
+        offers = Exchange.objects.filter(pk=offer.pk)
+        self.assertEqual(offers.transition(Exchange.State.CLOSED), 0)
+        self.assertEqual(offers.transition(Exchange.State.DECLINED), 1)
+        self.assertEqual(offers.transition(Exchange.State.ACCEPTED), 0)
+        self.assertEqual(offers.get().version, 1)
+
+    def test_batch_reply(self):
+        offers = [self.offer(self.users[1], self.offered[0]).json()['id'], self.offer(self.users[2], self.offered[1]).json()['id']]
+        client = self.client_for(self.users[0])
+        # at most one offer per book
+        response = client.post('/exchanges/reply/', {'accept': offers}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(set(Exchange.objects.filter(pk__in=offers).values_list('state', flat=True)), {Exchange.State.PENDING})
+
+        response = client.post('/exchanges/reply/', {'accept': offers[:1], 'decline': offers[1:]}, format='json')
+        self.assertEqual(response.json(), {'accepted': 1, 'declined': 0})
+
+    def test_batch_reply_gives_a_book_once(self):
+        other = self.create_book(self.users[0], exchange=True)
+        offers = [self.offer(self.users[1], self.offered[0]).json()['id'], self.offer(self.users[1], self.offered[0], target=other).json()['id']]
+        response = self.client_for(self.users[0]).post('/exchanges/reply/', {'accept': offers}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(set(Exchange.objects.filter(pk__in=offers).values_list('state', flat=True)), {Exchange.State.PENDING})
+
+class ReferenceResponseTests(ApiTestCase):
+    def test_conditional_requests(self):
+        client = self.client_for()
+        response = client.get('/cities/')
+        etag = response['ETag']
+        self.assertEqual(client.get('/cities/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(client.get('/cities/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            City.objects.create(name='Novi Sad')
+        response = client.get('/cities/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), ['Beograd', 'Novi Sad'])
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_change_is_dropped_once_committed(self):
+        client = self.client_for()
+        client.get('/genres/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Genre.objects.create(name='Poezija')
+            # cached again before the change commits, dropped once it does
+            client.get('/genres/')
+        self.assertEqual([genre['name'] for genre in client.get('/genres/').json()], ['Drama', 'Poezija'])
+
+    def test_one_entry_per_format(self):
+        client = self.client_for()
+        etags = {client.get('/cities/', HTTP_ACCEPT=accept)['ETag'] for accept in ('application/json', '*/*', 'application/json; q=0.5, text/plain')}
+        self.assertEqual(len(etags), 1)
+        # the browsable api isn't stored
+        for url in ('/cities/?format=api', '/cities/'):
+            response = client.get(url, HTTP_ACCEPT='text/html')
+            self.assertEqual(response['Content-Type'], 'text/html; charset=utf-8')
+            self.assertNotIn('ETag', response)
+        self.assertEqual(client.get('/cities/', HTTP_ACCEPT='image/png').status_code, 406)
+
+def png_bytes(size=(40, 30)):
+    from PIL import Image as PILImage
+    buffer = io.BytesIO()
+    PILImage.new('RGB', size, (200, 120, 40)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ImageUploadTests(ApiTestCase):
+    def upload(self, body, user=None, content_type='image/png'):
+        book = self.create_book(self.users[0])
+        client = self.client_for(user or self.users[0])
+        return client.post(f'/books/{book.id}/images/', body, content_type=content_type)
+
+    def test_upload(self):
+        response = self.upload(png_bytes())
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Image.objects.get(pk=response.json()['id']).image.name.endswith('.png'))
+
+    def test_rejected_uploads(self):
+        png = png_bytes()
+        with override_settings(IMAGE_UPLOAD_MAX_SIZE=len(png) - 1):
+            self.assertEqual(self.upload(png).status_code, 413)
+        self.assertEqual(self.upload(b'GIF89a, but not really', content_type='image/gif').status_code, 415)
+        self.assertEqual(self.upload(b'%PDF-1.4', content_type='image/png').status_code, 415)
+        # a PNG signature followed by garbage
+        self.assertEqual(self.upload(png[:16] + b'x' * 100).status_code, 415)
+        self.assertEqual(self.upload(png, user=self.users[1]).status_code, 403)
+        self.assertFalse(Image.objects.exists())
+
+def publish_events(events):
+    # outside of a transaction, events are sent right away
+    try:
+        events()
+    finally:
+        connection.close()
+
+class EventStreamTests(ApiTestCase):
+    def open_stream(self, query, events):
+        '''
+        Runs /events/?<query> until it sent the events the given function publishes, and
+        returns the messages it sent
+        '''
+        sent = []
+        broker = LocalBroker()
+
+        async def scenario():
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+            scope = {'type': 'http', 'method': 'GET', 'path': '/events/', 'headers': [], 'query_string': query.encode()}
+            stream = asyncio.ensure_future(event_stream(scope, receive, send))
+            while not sent and not stream.done():
+                await asyncio.sleep(0.01)
+            # from another thread, like the views publishing them
+            await asyncio.get_running_loop().run_in_executor(None, publish_events, events)
+            await asyncio.sleep(0.05)
+            disconnected.set()
+            await asyncio.wait_for(stream, 5)
+
+        with mock.patch('api.events.get_broker', return_value=broker):
+            asyncio.run(scenario())
+        return sent
+
+    def ticket(self, user):
+        response = self.client_for(user).post('/events/ticket/')
+        self.assertEqual(response.status_code, 201)
+        return response.json()['ticket']
+
+    def test_tickets_are_single_use(self):
+        ticket = self.ticket(self.users[0])
+        user_id, expires = redeem_ticket(ticket)
+        self.assertEqual(user_id, self.users[0].id)
+        self.assertIsNone(redeem_ticket(ticket))
+        self.assertEqual(self.client_for().post('/events/ticket/').status_code, 401)
+
+    def test_published_events_reach_the_users_stream(self):
+        def events():
+            publish([self.users[0].id], 'sold', book=7)
+            publish([self.users[1].id], 'offer', book=8)
+        sent = self.open_stream(f'ticket={self.ticket(self.users[0])}', events)
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertEqual(dict(sent[0]['headers'])[b'content-type'], b'text/event-stream')
+        bodies = [message['body'] for message in sent[1:]]
+        self.assertIn(b'event: sold\ndata: {"book": 7}\n\n', bodies)
+        self.assertNotIn(b'event: offer', b''.join(bodies))
+
+    def test_stream_needs_a_valid_ticket(self):
+        ticket = self.ticket(self.users[0])
+        redeem_ticket(ticket)
+        for query in (f'ticket={ticket}', f'token={tokens_for(self.users[0].django_user).access_token}', ''):
+            sent = self.open_stream(query, lambda: None)
+            self.assertEqual(sent[0]['status'], 401)
+
+class ClaimsAuthenticationTests(ApiTestCase):
+    def test_requests_dont_load_the_user(self):
+        client = self.client_for(self.users[0])
+        client.get('/books/my/')
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(client.get('/books/my/').status_code, 200)
+        self.assertFalse([query for query in captured if 'FROM "auth_user"' in query['sql']])
+
+    def test_deactivated_user_is_rejected(self):
+        client = self.client_for(self.users[0])
+        self.assertEqual(client.get('/books/my/').status_code, 200)
+        django_user = self.users[0].django_user
+        django_user.is_active = False
+        django_user.save()
+        self.assertEqual(client.get('/books/my/').status_code, 401)
+
+    def test_demoted_admin_loses_access(self):
+        django_user = self.users[0].django_user
+        client = self.client_for(self.users[0])
+        self.assertEqual(client.get('/stats/reference-cache/').status_code, 403)
+        django_user.is_staff = True
+        django_user.save()
+        self.assertEqual(client.get('/stats/reference-cache/').status_code, 200)
+        django_user.is_staff = False
+        django_user.save()
+        self.assertEqual(client.get('/stats/reference-cache/').status_code, 403)
+
+@override_settings(JOB_MAX_ATTEMPTS=3, JOB_RETRY_DELAY_SECONDS=10, JOB_RETRY_MAX_DELAY_SECONDS=25, JOB_LEASE_SECONDS=600)
+class JobTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+
+    def test_claim_and_run(self):
+        enqueue(record_call, value=1)
+        enqueue(record_call, value=2, delay=60)
+        job = claim()
+        self.assertEqual((job.arguments, job.attempts), ({'value': 1}, 1))
+        # the other job isn't due yet, and this one is leased
+        self.assertIsNone(claim())
+        self.assertTrue(run(job))
+        self.assertEqual(calls, [1])
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.State.DONE)
+
+    def test_keys(self):
+        enqueue(record_call, key='once', value=1)
+        enqueue(record_call, key='once', value=2)
+        self.assertEqual(list(Job.objects.values_list('arguments', flat=True)), [{'value': 1}])
+        with self.assertRaises(ValueError):
+            enqueue(lambda: None)
+
+    def test_expired_lease(self):
+        enqueue(record_call, value=1)
+        job = claim()
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        again = claim()
+        self.assertEqual((again.pk, again.attempts), (job.pk, 2))
+        # the first run's result is dropped
+        run(job)
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.State.RUNNING)
+        run(again)
+        self.assertEqual(Job.objects.get(pk=job.pk).state, Job.State.DONE)
+
+    def test_backoff(self):
+        self.assertEqual([backoff(attempts) for attempts in range(1, 5)], [10, 20, 25, 25])
+
+        enqueue(fail, value='boom')
+        for attempt in range(1, 4):
+            job = claim()
+            self.assertEqual(job.attempts, attempt)
+            before = timezone.now()
+            self.assertFalse(run(job))
+            job = Job.objects.get(pk=job.pk)
+            if attempt < 3:
+                self.assertEqual(job.state, Job.State.QUEUED)
+                self.assertGreaterEqual(job.run_at, before + timedelta(seconds=backoff(attempt)))
+                self.assertIn('RuntimeError: boom', job.error)
+                Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        self.assertEqual(job.state, Job.State.FAILED)
+        self.assertIsNone(claim())
+
+    def test_search_documents_are_rebuilt_by_a_job(self):
+        data = {'name': 'Prokleta avlija', 'author': self.author.id, 'genre': self.genre.id, 'edition': '1', 'preservation_level': 4}
+        response = self.client_for(self.users[0]).post('/books/', data, format='json')
+        document = lambda: Book.objects.values_list('search_document', flat=True).get(pk=response.json()['id'])
+        self.assertEqual(document(), '')
+        run_jobs()
+        self.assertEqual(document(), 'Prokleta avlija Ivo Andric Drama')
+
+        self.author.last_name = 'Andrić'
+        self.author.save()
+        run_jobs()
+        self.assertEqual(document(), 'Prokleta avlija Ivo Andrić Drama')
+
+class DerivativePoolTests(ApiTestCase):
+    def image(self):
+        image = mock.Mock(pk=1, book_id=1)
+        image.image.name = 'cover.png'
+        image.image.path = '/nonexistent/cover.png'
+        return image
+
+    @override_settings(IMAGE_DERIVATIVE_QUEUE_SIZE=1)
+    def test_failed_submit_frees_its_slot(self):
+        pool = DerivativePool()
+        with mock.patch.object(ProcessPoolExecutor, 'submit', side_effect=BrokenProcessPool), \
+                self.assertLogs('api.images') as logs:
+            for _ in range(2):
+                self.assertIsNone(pool.submit(self.image()))
+        self.assertFalse([line for line in logs.output if 'queue is full' in line])
+        # both images are left to a job, the broken executor is replaced
+        self.assertEqual(list(Job.objects.values_list('task', flat=True)), [task_name(render_image)])
+        self.assertIsNone(pool._executor)
+
+    def test_forked_worker_starts_its_own_processes(self):
+        pool = DerivativePool()
+        executor, _ = pool.executor()
+        self.assertIs(pool.executor()[0], executor)
+        with mock.patch('os.getpid', return_value=pool._pid + 1):
+            self.assertIsNot(pool.executor()[0], executor)
+        executor.shutdown()
+        pool.executor()[0].shutdown()
+
+@override_settings(PASSWORD_HASHING_WORKERS=1, PASSWORD_HASHING_QUEUE_SIZE=0, PASSWORD_HASHING_TIMEOUT=0.2)
+class PasswordHashingTests(ApiTestCase):
+    def test_slow_and_full_pool(self):
+        pool = HashingPool()
+        release = threading.Event()
+        with self.assertLogs('api.passwords', 'WARNING') as logs:
+            # the hash outlives its caller's timeout, and keeps its place until it's done
+            with self.assertRaises(HashingBusy):
+                pool.run(release.wait)
+            with self.assertRaises(HashingBusy):
+                pool.run(str, 'password')
+        self.assertIn('took longer than', logs.output[0])
+        self.assertIn('queue is full', logs.output[1])
+        release.set()
+        self.assertEqual(pool.run(str, 'password'), 'password')
+
+    def test_busy_login(self):
+        with mock.patch('api.views.verify_password', side_effect=HashingBusy):
+            response = self.client_for().post('/login/', {'email': 'user0@example.com', 'password': 'secret'}, format='json')
+        self.assertEqual((response.status_code, response['Retry-After']), (503, '1'))
+
+class ReferenceCacheTests(ApiTestCase):
+    def test_hits_misses_and_invalidation(self):
+        before = genres.stats()
+        with self.assertNumQueries(1):
+            for _ in range(3):
+                self.assertEqual(genres.get(name='Drama'), self.genre)
+        after = genres.stats()
+        self.assertEqual((after['hits'] - before['hits'], after['misses'] - before['misses']), (2, 1))
+        self.assertEqual((after['size'], after['max_size']), (2, None))
+        self.genre.name = 'Tragedija'
+        self.genre.save()
+        self.assertEqual(genres.stats()['size'], 0)
+        self.assertEqual(genres.get(id=self.genre.id).name, 'Tragedija')
+        with self.assertRaises(Genre.DoesNotExist):
+            genres.get(name='Drama')
+
+    def test_least_recently_used_rows_are_dropped(self):
+        cache = ReferenceCache(Author, ('id',), max_size=2)
+        others = [Author.objects.create(first_name='Mesa', last_name=f'Selimovic {i}') for i in range(2)]
+        cache.get(id=self.author.id)
+        cache.get(id=others[0].id)
+        cache.get(id=self.author.id)
+        cache.get(id=others[1].id)
+        self.assertEqual(cache.stats()['size'], 2)
+        with self.assertNumQueries(0):
+            cache.get(id=self.author.id)
+        with self.assertNumQueries(1):
+            cache.get(id=others[0].id)
+
+        cache.warm()
+        self.assertEqual(list(cache._rows), [('id', others[0].id), ('id', others[1].id)])
+
+    def test_stats_are_for_staff(self):
+        self.assertEqual(self.client_for(self.users[0]).get('/stats/reference-cache/').status_code, 403)
+        self.users[0].django_user.is_staff = True
+        self.users[0].django_user.save()
+        misses = authors.stats()['misses']
+        authors.get(id=self.author.id)
+        response = self.client_for(self.users[0]).get('/stats/reference-cache/')
+        self.assertEqual(response.json()['caches']['Author']['misses'], misses + 1)
+
+class BookPaginationTests(ApiTestCase):
+    def test_cursors_walk_every_book_once(self):
+        published = timezone.now()
+        books = [self.create_book(self.users[i % 2], price=100, date_published=published - timedelta(days=i // 2)) for i in range(7)]
+        expected = [book.id for book in sorted(books, key=lambda book: (book.date_published, book.id), reverse=True)]
+
+        seen = []
+        url = '/books/?page_size=2'
+        client = self.client_for()
+        while url:
+            page = client.get(url).json()
+            self.assertLessEqual(len(page['results']), 2)
+            seen += [book['id'] for book in page['results']]
+            url = page['next']
+        self.assertEqual(seen, expected)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client_for().get('/books/?cursor=abc').status_code, 404)
+        self.assertEqual(self.client_for().get('/users/?cursor=WzEsMl0=').status_code, 404)
+
+@mock.patch('api.search.is_postgres', return_value=False)
+class BookSearchTests(ApiTestCase):
+    def search(self, q):
+        response = self.client_for().get('/books/search/', {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return [book['name'] for book in response.json()['results']]
+
+    def test_fallback_search(self, is_postgres):
+        self.create_book(self.users[0], price=100, name='Prokleta avlija')
+        self.create_book(self.users[1], exchange=True, name='Andricev venac')
+        # not listed
+        self.create_book(self.users[1], name='Andric i Drina')
+        run_jobs()
+        # words in the name rank above the author's and genre's
+        self.assertEqual(self.search('andric'), ['Andricev venac', 'Prokleta avlija'])
+        self.assertEqual(self.search('avlija DRAMA'), ['Prokleta avlija'])
+        self.assertEqual(self.search('selimovic'), [])
+        self.assertEqual(self.client_for().get('/books/search/', {'q': ' '}).status_code, 400)
+
+@override_settings(BOOK_IMPORT_BATCH_SIZE=2)
+class BookImportTests(ApiTestCase):
+    def test_json_import(self):
+        rows = [
+            {'name': 'Prokleta avlija', 'author': self.author.id, 'genre': 'Roman', 'edition': '1', 'preservation_level': 4,
+             'for_sale': True, 'price': '100'},
+            {'name': 'Dervis i smrt', 'author': 'Mesa Selimovic', 'genre': self.genre.id, 'edition': '2', 'preservation_level': 3,
+             'for_sale': 'yes', 'price': 'x'},
+            {'name': 'Tvrdjava', 'author': 'Mesa Selimovic', 'genre': 'Roman', 'edition': '1', 'preservation_level': '3',
+             'for_exchange': 'true'},
+            {'name': 'Tisine', 'author': ' Mesa  Selimovic', 'genre': 'roman', 'edition': '1', 'preservation_level': 3, 'for_exchange': 1},
+            {'name': 'Nepoznata', 'author': 0, 'genre': self.genre.id, 'edition': '1', 'preservation_level': 3},
+            'Na Drini cuprija',
+        ]
+        response = self.client_for(self.users[0]).post('/books/import/', rows, format='json')
+        self.assertEqual(response.status_code, 201)
+        result = response.json()
+        self.assertEqual(result['created'], 3)
+        self.assertEqual([(error['row'], list(error['errors'])) for error in result['errors']], [(1, ['price']), (4, ['author']), (5, ['row'])])
+
+        books = Book.objects.filter(pk__in=result['ids']).order_by('pk')
+        self.assertEqual([book.name for book in books], ['Prokleta avlija', 'Tvrdjava', 'Tisine'])
+        self.assertEqual(Author.objects.filter(first_name='Mesa', last_name='Selimovic').count(), 1)
+        self.assertEqual(sorted(Genre.objects.values_list('name', flat=True)), ['Drama', 'Roman', 'roman'])
+        self.assertEqual(list(Listing.objects.filter(book__in=books).values_list('for_sale', 'for_exchange')), [(True, False), (False, True), (False, True)])
+        self.assertFalse(Book.objects.availability_drift().exists())
+
+    def test_csv_import(self):
+        lines = [
+            'name,author,genre,edition,preservation_level,for_sale,price,for_exchange',
+            f'Prokleta avlija,{self.author.id},Drama,1,4,true,120.5,false',
+            'Tvrdjava,Mesa Selimovic,,1,3,false,,true',
+        ]
+        response = self.client_for(self.users[0]).post('/books/import/', '\n'.join(lines), content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.json()['created'], response.json()['errors']), (1, [{'row': 1, 'errors': {'genre': 'Provide the id or the name of a genre.'}}]))
+        self.assertEqual(str(Book.objects.get(name='Prokleta avlija').current_price), '120.50')
+
+    @override_settings(BOOK_IMPORT_MAX_ROWS=2)
+    def test_rejected_imports(self):
+        client = self.client_for(self.users[0])
+        row = {'name': 'Prokleta avlija', 'author': self.author.id, 'genre': self.genre.id, 'edition': '1', 'preservation_level': 4}
+        self.assertEqual(client.post('/books/import/', [row] * 3, format='json').status_code, 413)
+        self.assertEqual(client.post('/books/import/', [{**row, 'edition': ''}], format='json').status_code, 400)
+        self.assertEqual(client.post('/books/import/', row, format='json').status_code, 400)
+        self.assertEqual(self.client_for().post('/books/import/', [row], format='json').status_code, 401)
+        self.assertFalse(Book.objects.exists())
+
+class CityListingTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.novi_sad = City.objects.create(name='Novi Sad')
+        self.reader = self.create_user('reader@example.com', city=self.novi_sad)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.belgrade_book = self.create_book(self.users[0], price=100)
+            self.novi_sad_book = self.create_book(self.reader, exchange=True)
+
+    def listed(self, client, query=''):
+        response = client.get(f'/books/{query}')
+        self.assertEqual(response.status_code, 200)
+        return [book['id'] for book in response.json()['results']]
+
+    def test_city_filter(self):
+        anonymous, reader = self.client_for(), self.client_for(self.reader)
+        self.assertEqual(sorted(self.listed(anonymous)), [self.belgrade_book.id, self.novi_sad_book.id])
+        self.assertEqual(self.listed(anonymous, '?city=Beograd'), [self.belgrade_book.id])
+        # the caller's city, unless another or every city is asked for
+        self.assertEqual(self.listed(reader), [self.novi_sad_book.id])
+        self.assertEqual(self.listed(reader, '?city=Beograd'), [self.belgrade_book.id])
+        self.assertEqual(len(self.listed(reader, '?city=')), 2)
+        self.assertEqual(anonymous.get('/books/?city=Nis').status_code, 400)
+
+    def test_writes_only_drop_their_city(self):
+        client = self.client_for()
+        self.listed(client, '?city=Novi Sad')
+        self.listed(client, '?city=Beograd')
+        self.listed(client)
+        with self.captureOnCommitCallbacks(execute=True):
+            book = self.create_book(self.users[1], price=50)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.listed(client, '?city=Novi Sad'), [self.novi_sad_book.id])
+        self.assertIn(book.id, self.listed(client, '?city=Beograd'))
+        self.assertIn(book.id, self.listed(client))
+
+@override_settings(DATABASE_REPLICAS=['replica_1'], REPLICA_MAX_LAG=2, REPLICA_LAG_CHECK_INTERVAL=5)
+class ReplicaRoutingTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        # every replica is healthy, and choosing one tells that the request may read from it
+        healthy = mock.patch.object(replicas.monitor, 'healthy', return_value=['replica_1'])
+        choice = mock.patch('api.replicas.random.choice', side_effect=lambda aliases: aliases[0])
+        healthy.start()
+        self.choice = choice.start()
+        self.addCleanup(mock.patch.stopall)
+
+    def reads_from_replica(self, user):
+        self.choice.reset_mock()
+        self.assertEqual(self.client_for(user).get('/books/').status_code, 200)
+        return self.choice.called
+
+    def test_writers_are_pinned_to_the_primary(self):
+        self.assertTrue(self.reads_from_replica(self.users[0]))
+        data = {'name': 'Prokleta avlija', 'author': self.author.id, 'genre': self.genre.id, 'edition': '1', 'preservation_level': 4}
+        self.assertEqual(self.client_for(self.users[0]).post('/books/', data, format='json').status_code, 201)
+        self.assertFalse(self.reads_from_replica(self.users[0]))
+        self.assertTrue(self.reads_from_replica(self.users[1]))
+        # a failed write pins nobody
+        self.assertEqual(self.client_for(self.users[1]).post('/books/', {**data, 'author': 0}, format='json').status_code, 400)
+        self.assertTrue(self.reads_from_replica(self.users[1]))
+
+    def test_router(self):
+        router = replicas.ReplicaRouter()
+        state, token = replicas.start_request()
+        self.addCleanup(replicas.current.reset, token)
+        state.replica = 'replica_1'
+        # the test runs in a transaction, whose reads stay on the primary
+        self.assertEqual(router.db_for_read(Book), 'default')
+        with mock.patch.object(connection, 'in_atomic_block', False):
+            self.assertEqual(router.db_for_read(Book), 'replica_1')
+            self.assertTrue(replicas.replica_may_be_behind(time.time()))
+            self.assertFalse(replicas.replica_may_be_behind(time.time() - 60))
+            self.assertEqual(router.db_for_write(Book), 'default')
+            # the rest of the request reads its own writes
+            self.assertEqual(router.db_for_read(Book), 'default')
+            self.assertFalse(replicas.replica_may_be_behind(time.time()))
+
+    def test_lagging_replicas_get_no_reads(self):
+        monitor = replicas.ReplicaMonitor()
+        with mock.patch.object(monitor, 'measure', return_value=0.5) as measure:
+            self.assertEqual(monitor.healthy(), ['replica_1'])
+            self.assertEqual(monitor.healthy(), ['replica_1'])
+        # measured once per interval
+        self.assertEqual(measure.call_count, 1)
+        for lag in (10.0, None):
+            monitor = replicas.ReplicaMonitor()
+            with mock.patch.object(monitor, 'measure', return_value=lag):
+                self.assertEqual(monitor.healthy(), [])
+
+class FastSerializerTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.books = [
+            self.create_book(self.users[0], price=100, exchange=True, name='Prokleta avlija \u2028'),
+            self.create_book(self.users[1], price='12.50'),
+            self.create_book(self.users[2], exchange=True),
+        ]
+        Image.objects.create(book=self.books[0], image='cover.png', thumbnail='derivatives/cover_thumb.webp')
+        Image.objects.create(book=self.books[0], image='back.png')
+        Exchange.objects.create(book_offered=self.books[0], book_returned=self.books[2], state=Exchange.State.PENDING)
+        Sale.objects.filter(book=self.books[1]).update(buyer=self.users[2], date_sold=timezone.now().date())
+        self.request = APIRequestFactory().get('/')
+
+    def assertSameOutput(self, fast, reference):
+        self.assertEqual(fast, reference)
+        self.assertEqual(FastJSONRenderer().render(fast), JSONRenderer().render(reference))
+
+    def test_books_and_listings(self):
+        books = Book.objects.order_by('pk')
+        self.assertSameOutput(
+            serialize_books(list(book_values(books)), self.request),
+            BookSerializer(books, many=True, context={'request': self.request}).data,
+        )
+        listings = Listing.objects.order_by('book_id')
+        self.assertEqual([len(listing.images) for listing in listings], [2, 0, 0])
+        self.assertSameOutput(
+            serialize_listings(list(listing_values(listings)), self.request),
+            ListingSerializer(listings, many=True, context={'request': self.request}).data,
+        )
+
+    def test_sales_and_exchanges(self):
+        sales = Sale.objects.order_by('pk')
+        self.assertSameOutput(serialize_sales(sales), SaleSerializer(sales, many=True).data)
+        exchanges = Exchange.objects.order_by('pk')
+        self.assertSameOutput(serialize_exchanges(exchanges), ExchangeSerializer(exchanges, many=True).data)
+
+class FieldSelectionTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.book = self.create_book(self.users[0], price=100, exchange=True)
+        Image.objects.create(book=self.book, image='cover.png')
+        self.client = self.client_for(self.users[0])
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_fields_and_expand(self):
+        book, = self.get('/books/?fields=price,name&expand=')['results']
+        # in the order of the full response
+        self.assertEqual(book, {'name': 'Na Drini cuprija', 'price': '100.00'})
+        book = self.get(f'/books/{self.book.id}/?fields=author,original_owner&expand=author')
+        self.assertEqual(book, {
+            'original_owner': self.users[0].id,
+            'author': {'first_name': 'Ivo', 'last_name': 'Andric', 'id': self.author.id},
+        })
+        self.assertEqual(len(self.get('/books/my/')['results'][0]), 12)
+
+        sale, = self.get('/sales/my/?fields=price,book.name,book.author&expand=book')
+        self.assertEqual(sale, {'book': {'name': 'Na Drini cuprija', 'author': self.author.id}, 'price': '100.00'})
+        exchange, = self.get('/exchanges/my/?fields=id,book_offered&expand=')
+        self.assertEqual(exchange['book_offered'], self.book.id)
+
+    def test_fewer_fields_fewer_queries(self):
+        with self.assertNumQueries(3):
+            self.get('/sales/my/')
+        with self.assertNumQueries(1):
+            self.get('/sales/my/?fields=price,book&expand=')
+        with CaptureQueriesContext(connection) as captured:
+            self.get('/books/my/?fields=id,name')
+        self.assertFalse([query for query in captured if 'api_image' in query['sql']])
+
+    def test_invalid_selection(self):
+        for query in ('fields=title', 'fields=name.first_name', 'expand=genre', 'fields=book.name'):
+            response = self.client.get(f'/books/my/?{query}')
+            self.assertEqual(response.status_code, 400, query)
+        self.assertEqual(self.client.get('/sales/my/?expand=status').status_code, 400)
+
+class BookVersionTests(ApiTestCase):
+    def test_etags_follow_the_version(self):
+        book = self.create_book(self.users[0], price=100)
+        client = self.client_for(self.users[0])
+        response = client.get(f'/books/{book.id}/')
+        etag = response['ETag']
+        # the version alone answers conditional requests, and finds the rendered response
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get(f'/books/{book.id}/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get(f'/books/{book.id}/').content, response.content)
+        # other fields are another response
+        self.assertEqual(client.get(f'/books/{book.id}/?fields=name', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        client.put(f'/books/{book.id}/', {'name': 'Prokleta avlija'}, format='json')
+        response = client.get(f'/books/{book.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['name'], 'Prokleta avlija')
+        self.assertNotEqual(response['ETag'], etag)
+
+        # so does a change of its availability
+        etag = response['ETag']
+        self.client_for(self.users[1]).get(f'/books/{book.id}/buy/')
+        response = client.get(f'/books/{book.id}/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.json()['for_sale']), (200, False))
+
+class BookChangesTests(ApiTestCase):
+    def changes(self, since):
+        return self.client_for().get(f'/books/changes/?since={since}').json()
+
+    @override_settings(CHANGE_FEED_SETTLE_SECONDS=0)
+    def test_changes_since_a_token(self):
+        book = self.create_book(self.users[0], price=100)
+        token = self.client_for().get('/books/changes/').json()['next']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client_for(self.users[1]).get(f'/books/{book.id}/buy/')
+        feed = self.changes(token)
+        self.assertEqual(feed['changes'], [{'book': book.id, 'change': 'sold', 'listing': None}])
+        self.assertGreater(feed['next'], token)
+        self.assertEqual(self.changes(feed['next'])['changes'], [])
+
+    @override_settings(CHANGE_FEED_SETTLE_SECONDS=60)
+    def test_unsettled_changes_are_held_back(self):
+        settled = ListingChange.objects.create(book_id=1, kind=ListingChange.Kind.UPDATED, created_at=timezone.now() - timedelta(minutes=5))
+        ListingChange.objects.create(book_id=2, kind=ListingChange.Kind.UPDATED)
+        self.assertEqual(self.client_for().get('/books/changes/').json()['next'], settled.id)
+        feed = self.changes(settled.id - 1)
+        self.assertEqual([change['book'] for change in feed['changes']], [1])
+        self.assertEqual(feed['next'], settled.id)
+        self.assertFalse(feed['more'])
+
+    def test_compacted_token(self):
+        ListingChange.objects.create(book_id=1, kind=ListingChange.Kind.UPDATED)
+        oldest = ListingChange.objects.create(book_id=2, kind=ListingChange.Kind.UPDATED)
+        ListingChange.objects.filter(pk__lt=oldest.pk).delete()
+        self.assertEqual(self.client_for().get(f'/books/changes/?since={oldest.pk - 2}').status_code, 410)
@@ -0,0 +1,29 @@
+from datetime import date
+
+from django.db import transaction
+
+from .models import Book, Sale, ListingChange
+from .reference import statuses
+
+# A purchase changes the sale with a single UPDATE that only matches it while it is still available.
+# Of many concurrent buyers exactly one updates the row, the others update nothing and get a conflict,
+# without retries. The book is locked first, like ExchangeQuerySet.accept does, so a book listed for
+# sale and for exchange is either bought or exchanged, never both.
+
+def buy_book(book_id, buyer):
+    '''
+    Sells the book's available sale to the buyer, closing its exchange listing and declining
+    the offers for it. Returns whether this request got the book
+    '''
+    with transaction.atomic():
+        Book.objects.select_for_update().filter(pk=book_id).values_list('pk').first()
+        sold = Sale.objects.filter(book_id=book_id, status=statuses.get(name='AVAILABLE')).update(
+            buyer=buyer,
+            status=statuses.get(name='UNAVAILABLE'),
+            date_sold=date.today(),
+        )
+        if sold:
+            books = Book.objects.filter(pk=book_id)
+            books.withdraw()
+            books.refresh_availability(removed=ListingChange.Kind.SOLD)
+    return bool(sold)
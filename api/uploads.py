@@ -0,0 +1,84 @@
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from rest_framework import status
+
+# leading bytes of the image formats that can be uploaded
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpg', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+    (b'GIF87a', 'gif', 'image/gif'),
+    (b'GIF89a', 'gif', 'image/gif'),
+]
+
+class UploadRejected(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+def sniff_format(head):
+    '''
+    Returns the extension and content type of an image from its first bytes
+    '''
+    for signature, extension, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return extension, content_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp', 'image/webp'
+    return None
+
+def receive_image(stream, content_length):
+    '''
+    Copies an image request body to a temporary file one chunk at a time, so memory use
+    doesn't depend on the size of the upload. Oversized and non-image bodies are rejected
+    from the Content-Length header or their first chunk, before the rest is read.
+    '''
+    max_size = settings.IMAGE_UPLOAD_MAX_SIZE
+    chunk_size = settings.IMAGE_UPLOAD_CHUNK_SIZE
+    if content_length is None:
+        raise UploadRejected('Content-Length is required.', status.HTTP_411_LENGTH_REQUIRED)
+    if content_length > max_size:
+        raise UploadRejected(f'Images can be at most {max_size} bytes.', status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+    head = stream.read(min(chunk_size, content_length))
+    detected = sniff_format(head)
+    if detected is None:
+        raise UploadRejected('Only JPEG, PNG, GIF and WebP images can be uploaded.', status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+    extension, content_type = detected
+
+    upload = TemporaryUploadedFile(f'{uuid.uuid4().hex}.{extension}', content_type, content_length, None)
+    try:
+        size = 0
+        chunk = head
+        while chunk:
+            size += len(chunk)
+            if size > content_length:
+                raise UploadRejected('The body is longer than its Content-Length.', status.HTTP_400_BAD_REQUEST)
+            upload.write(chunk)
+            chunk = stream.read(min(chunk_size, content_length - size))
+        if size < content_length:
+            raise UploadRejected('The upload was interrupted.', status.HTTP_400_BAD_REQUEST)
+        upload.size = size
+        verify_image(upload)
+        upload.seek(0)
+        return upload
+    except BaseException:
+        upload.close()
+        raise
+
+def verify_image(upload):
+    '''
+    Checks that the whole file parses as an image, without decoding its pixels
+    '''
+    from PIL import Image as PILImage
+
+    upload.seek(0)
+    try:
+        with PILImage.open(upload) as image:
+            image.verify()
+    except (PILImage.DecompressionBombError, PILImage.DecompressionBombWarning):
+        raise UploadRejected('The image has too many pixels.', status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    except Exception:
+        raise UploadRejected('The file is not a valid image.', status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
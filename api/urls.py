@@ -1,6 +1,6 @@
 from django.urls import path
 from rest_framework_simplejwt.views import TokenRefreshView
-from .views import Users, UserDetails, Login, Cities, Authors, Genres, Books, MyBooks, BookDetails, BookBuy, BookExchange, ExchangeReply
+from .views import Users, UserDetails, Login, Cities, Authors, Genres, Books, BookSearch, BookChanges, BookImport, MyBooks, BookDetails, BookImages, BookBuy, BookExchange, ExchangeReply, ExchangeBatchReply, UserSales, UserExchanges, EventTicket, ReferenceCacheStats, JobStats
 
 urlpatterns = [
     path('users/', Users.as_view()),
@@ -11,9 +11,19 @@ urlpatterns = [
     path('authors/', Authors.as_view()),
     path('genres/', Genres.as_view()),
     path('books/', Books.as_view()),
+    path('books/search/', BookSearch.as_view()),
+    path('books/changes/', BookChanges.as_view()),
     path('books/my/', MyBooks.as_view()),
+    path('books/import/', BookImport.as_view()),
     path('books/<int:pk>/', BookDetails.as_view()),
+    path('books/<int:pk>/images/', BookImages.as_view()),
     path('books/<int:pk>/buy/', BookBuy.as_view()),
     path('books/<int:pk>/exchange/', BookExchange.as_view()),
     path('books/<int:pk>/exchange-reply/', ExchangeReply.as_view()),
+    path('sales/my/', UserSales.as_view()),
+    path('exchanges/my/', UserExchanges.as_view()),
+    path('exchanges/reply/', ExchangeBatchReply.as_view()),
+    path('events/ticket/', EventTicket.as_view()),
+    path('stats/reference-cache/', ReferenceCacheStats.as_view()),
+    path('stats/jobs/', JobStats.as_view()),
 ]
\ No newline at end of file
@@ -0,0 +1,42 @@
+from django.contrib.auth.models import User as DjangoUser
+from django.db.models.signals import post_save, post_delete
+
+from .models import Book, Image, User, City, Author, Genre, deleting_books
+
+# Book.version changes with everything BookDetails shows. Saving a book and refreshing its
+# availability bump it on their own, the handlers below cover the rows a book is shown with.
+# Renames of owners, cities, authors and genres are rare, so they touch all of their books.
+
+def image_changed(sender, instance, **kwargs):
+    if instance.book_id not in deleting_books.ids:
+        Book.objects.filter(pk=instance.book_id).touch()
+
+def profile_saved(sender, instance, created, **kwargs):
+    if not created:
+        Book.objects.filter(original_owner=instance).touch()
+
+def django_user_saved(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and 'email' not in update_fields):
+        return
+    Book.objects.filter(original_owner__django_user=instance).touch()
+
+def city_saved(sender, instance, created, **kwargs):
+    if not created:
+        Book.objects.filter(original_owner__city=instance).touch()
+
+def author_saved(sender, instance, created, **kwargs):
+    if not created:
+        Book.objects.filter(author=instance).touch()
+
+def genre_saved(sender, instance, created, **kwargs):
+    if not created:
+        Book.objects.filter(genre=instance).touch()
+
+def connect_signals():
+    post_save.connect(image_changed, sender=Image)
+    post_delete.connect(image_changed, sender=Image)
+    post_save.connect(profile_saved, sender=User)
+    post_save.connect(django_user_saved, sender=DjangoUser)
+    post_save.connect(city_saved, sender=City)
+    post_save.connect(author_saved, sender=Author)
+    post_save.connect(genre_saved, sender=Genre)
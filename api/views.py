@@ -1,37 +1,59 @@
-from django.shortcuts import render
-from django.contrib.auth.hashers import make_password, check_password
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.db import DataError, IntegrityError, transaction
 from django.http import Http404
 from rest_framework import status, generics, permissions
 from rest_framework.views import APIView
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
-from rest_framework_simplejwt.tokens import RefreshToken, AccessToken
 from datetime import date
+import csv
+import math
+import os
 
 from django.contrib.auth.models import User as DjangoUser
-from .models import User, City, Book, Image, Author, Genre, Status, Sale, Exchange
-from .serializers import UserSerializer, CitySerializer, AuthorSerializer, GenreSerializer, BookSerializer, ExchangeSerializer, SaleSerializer
+from .models import User, City, Book, Image, Author, Genre, Sale, Exchange, ExchangeConflict, Listing, ListingChange
+from .serializers import UserSerializer, AuthorSerializer, GenreSerializer, BookSerializer, ImageSerializer
+from .listings import book_listing, available_books, listing_page_key, user_city_id
+from .pagination import BookPagination, ListingPagination, UserPagination, SearchPagination
+from .reference import statuses, cities, genres, authors, reference_cache_stats
+from .search import search_books
+from .caching import CachedResponseMixin, VersionedResponseMixin
+from .uploads import receive_image, UploadRejected
+from .passwords import hash_password, verify_password, HashingBusy
+from .authentication import tokens_for
+from .imports import import_books, read_csv, ImportTooLarge
+from .transitions import buy_book
+from .replicas import ReplicaReadsMixin, replica_may_be_behind
+from .fast_serializers import book_values, serialize_books, listing_values, serialize_listings, serialize_sales, serialize_exchanges
+from .selection import Selection, InvalidSelection, BOOK, SALE, EXCHANGE
+from .changes import changes_since, latest_token, ChangesCompacted
+from .events import publish, issue_ticket
+from .jobs import job_stats
 
 def check_availability(book):
     '''
-    Checks whether the given book is available for sale or exchange
+    Reloads the given book through the listing queryset,
+    so it knows whether it is available for sale or exchange
     '''
-    available = Status.objects.get(name='AVAILABLE')
-    if Sale.objects.filter(book=book, status=available).exists():
-        book.for_sale = True
-        book.price = Sale.objects.get(book=book).price
-    else:
-        book.for_sale = False
-        book.price = None
-    if Exchange.objects.filter(book_offered=book, status=available).exists():
-        book.for_exchange = True
-    else:
-        book.for_exchange = False
-    return book
+    return book_listing().get(pk=book.pk)
 
-class Cities(APIView):
+def busy_response():
+    '''
+    Answer for requests that hash a password while the hashing pool is full
+    '''
+    response = Response({'Error': 'The server is busy, try again in a few seconds.'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response['Retry-After'] = str(math.ceil(settings.PASSWORD_HASHING_TIMEOUT))
+    return response
+
+class Cities(CachedResponseMixin, ReplicaReadsMixin, APIView):
     '''
     List all possible city options
     '''
+    cache_name = 'cities'
+
     def get(self, request, format=None):
         city_objects = City.objects.all()
         cities = []
@@ -39,7 +61,7 @@ class Cities(APIView):
             cities.append(city.name)
         return Response(cities, status=status.HTTP_200_OK)
 
-class Users(APIView):
+class Users(ReplicaReadsMixin, APIView):
     '''
     List or create users
     '''
@@ -47,11 +69,10 @@ class Users(APIView):
         '''
         List all users
         '''
-        users = User.objects.all()
-        for user in users:
-            user.email = user.django_user.email
+        paginator = UserPagination()
+        users = paginator.paginate_queryset(User.objects.select_related('django_user', 'city'), request, view=self)
         serializer = UserSerializer(users, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return paginator.get_paginated_response(serializer.data)
 
     def post(self, request, format=None):
         '''
@@ -65,17 +86,19 @@ class Users(APIView):
         
         if DjangoUser.objects.filter(email=data['email']).exists():
             return Response({'Error': 'User with given email already exists'}, status=status.HTTP_400_BAD_REQUEST)
-        if not City.objects.filter(name=data['city']).exists():
+        if not cities.exists(name=data['city']):
             return Response({'Error': f'There is no city named {data["city"]} in the database.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        print(data['password'])
-        print(make_password(data['password']))
+        try:
+            password = hash_password(data['password'])
+        except HashingBusy:
+            return busy_response()
         django_user = DjangoUser.objects.create(
             username=data['email'],
-            password=make_password(data['password']),
+            password=password,
             email=data['email']
         )
-        city = City.objects.get(name=data['city'])
+        city = cities.get(name=data['city'])
         user = User.objects.create(
             first_name=data['first_name'],
             last_name=data['last_name'],
@@ -92,9 +115,7 @@ class UserDetails(APIView):
     '''
     def get_user(self, pk):
         try:
-            user = User.objects.get(pk=pk)
-            user.email = user.django_user.email
-            return user
+            return User.objects.select_related('django_user', 'city').get(pk=pk)
         except User.DoesNotExist:
             raise Http404
 
@@ -119,10 +140,13 @@ class UserDetails(APIView):
         if 'last_name' in data:
             user.last_name = data['last_name']
         if 'password' in data:
-            user.django_user.password = make_password(data['password'])
+            try:
+                user.django_user.password = hash_password(data['password'])
+            except HashingBusy:
+                return busy_response()
             user.django_user.save()
         if 'city' in data:
-            city = City.objects.get(name=data['city'])
+            city = cities.get(name=data['city'])
             user.city = city
         user.save()
         serializer = UserSerializer(user)
@@ -147,60 +171,81 @@ class Login(APIView):
         data = request.data
         if 'email' not in data.keys() or 'password' not in data.keys():
             return Response({'Error': 'You have to supply an email and a password.'}, status=status.HTTP_400_BAD_REQUEST)
-        django_user = DjangoUser.objects.get(email=data['email'])
-        if django_user == DjangoUser.objects.none():
+        django_user = DjangoUser.objects.select_related('user').filter(email=data['email']).first()
+        if django_user is None:
             return Response({'Error': 'Invalid email.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not check_password(data['password'], django_user.password):
+        try:
+            matches = verify_password(data['password'], django_user)
+        except HashingBusy:
+            return busy_response()
+        if not matches:
             return Response({'Error': 'Wrong password.'}, status=status.HTTP_404_NOT_FOUND)
-        access = AccessToken.for_user(django_user)
-        refresh = RefreshToken.for_user(django_user)
+        refresh = tokens_for(django_user)
+        access = refresh.access_token
         return Response({
             'access': str(access),
             'refresh': str(refresh),
             'user_id': str(django_user.user.id)
         })
 
-class Authors(generics.ListCreateAPIView):
+class Authors(CachedResponseMixin, ReplicaReadsMixin, generics.ListCreateAPIView):
     '''
     List all available authors, or add a new one
     '''
+    cache_name = 'authors'
     queryset = Author.objects.all()
     serializer_class = AuthorSerializer
     permission_classes = [ permissions.IsAuthenticatedOrReadOnly ]
+    pagination_class = None
 
-class Genres(generics.ListCreateAPIView):
+class Genres(CachedResponseMixin, ReplicaReadsMixin, generics.ListCreateAPIView):
     '''
     List all available genres, or add a new one
     '''
+    cache_name = 'genres'
     queryset = Genre.objects.all()
     serializer_class = GenreSerializer
     permission_classes = [ permissions.IsAuthenticatedOrReadOnly ]
+    pagination_class = None
 
-class Books(APIView):
+class Books(ReplicaReadsMixin, APIView):
     '''
     List all books or post a new one.
     '''
     def get(self, request, format=None):
         '''
-        List all books.
-        '''
-        books = []
-        sales = Sale.objects.all()
-        for sale in sales:
-            if sale.status == Status.objects.get(name='AVAILABLE'):
-                books.append(sale.book)
-        exchanges = Exchange.objects.all()
-        for exchange in exchanges:
-            if exchange.status == Status.objects.get(name='AVAILABLE'):
-                books.append(exchange.book_offered)
-        for book in books:
-            book.original_owner.email = book.original_owner.django_user.email
-            book = check_availability(book)
-            # if book.for_sale == False and book.for_exchange == False:
-            #     books.remove(book)
-        serializer = BookSerializer(books, many = True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        List available books of the city given by name in the 'city' parameter, read from their listings.
+        Defaults to the city of the logged in user, an empty 'city' lists books of every city.
+        Pages are cached per city. 'fields' and 'expand' narrow down the books, see api.selection
+        '''
+        try:
+            selection = Selection.from_request(request, BOOK)
+        except InvalidSelection as e:
+            return Response({'Error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if 'city' in request.query_params:
+            name = request.query_params['city'].strip()
+            try:
+                city_id = cities.get(name=name).id if name else None
+            except City.DoesNotExist:
+                return Response({'Error': 'There is no city with that name.'}, status=status.HTTP_400_BAD_REQUEST)
+        elif request.user.is_authenticated:
+            city_id = user_city_id(request.user.user)
+        else:
+            city_id = None
+
+        key, changed_at = listing_page_key(request, city_id)
+        data = cache.get(key)
+        if data is None:
+            listings = Listing.objects.all()
+            if city_id is not None:
+                listings = listings.filter(city_id=city_id)
+            paginator = ListingPagination()
+            rows = paginator.paginate_queryset(listing_values(listings, selection), request, view=self)
+            data = paginator.get_paginated_response(serialize_listings(rows, selection=selection)).data
+            if not replica_may_be_behind(changed_at):
+                cache.set(key, data, settings.RESPONSE_CACHE_TIMEOUT)
+        return Response(data)
 
     def post(self, request, format=None):
         '''
@@ -211,46 +256,127 @@ class Books(APIView):
             return Response({'Error': 'You have to be logged in to post a book.'}, status=status.HTTP_401_UNAUTHORIZED)
 
         try:
-            author = Author.objects.get(id=data['author'])
-            genre = Genre.objects.get(id=data['genre'])
-            request.user.user.email = request.user.email
-            book = Book(
-                name=data['name'],
-                original_owner=request.user.user,
-                author=author,
-                genre=genre,
-                edition=data['edition'],
-                preservation_level=data['preservation_level'],
-            )
-            book.save()
-
-            book_status = Status.objects.get(name='AVAILABLE')
-            if data.get('for_sale') == 'true' and 'price' in data.keys():
-                sale = Sale(
-                    book=book,
-                    buyer=None,
-                    status=book_status,
-                    date_published=date.today(),
-                    date_sold=None,
-                    price=request.data['price']
+            with transaction.atomic():
+                book = Book.objects.create(
+                    name=data['name'],
+                    original_owner=request.user.user,
+                    author=authors.get(id=data['author']),
+                    genre=genres.get(id=data['genre']),
+                    edition=data['edition'],
+                    preservation_level=data['preservation_level'],
                 )
-                sale.save()
-            if data.get('for_exchange') == 'true':
-                exchange = Exchange(
-                    book_offered=book,
-                    book_returned=None,
-                    status=book_status,
-                    date_published=date.today(),
-                    date_exchanged=None,
-                )
-                exchange.save()
-            
-            book.original_owner.email = book.original_owner.django_user.email
-            book = check_availability(book)
-            return Response(BookSerializer(book).data, status=status.HTTP_201_CREATED)
-        except:
+                # created without their save(), the book's availability and listing are refreshed once below
+                if data.get('for_sale') == 'true' and 'price' in data.keys():
+                    Sale.objects.bulk_create([Sale(
+                        book=book,
+                        status=statuses.get(name='AVAILABLE'),
+                        date_published=date.today(),
+                        price=data['price'],
+                    )])
+                if data.get('for_exchange') == 'true':
+                    Exchange.objects.bulk_create([Exchange(book_offered=book, date_published=date.today())])
+                Book.objects.filter(pk=book.pk).refresh_availability()
+        except (KeyError, TypeError, ValueError, ValidationError, DataError, IntegrityError, Author.DoesNotExist, Genre.DoesNotExist):
             return Response({'Error': 'Invalid data.'}, status=status.HTTP_400_BAD_REQUEST)
 
+        book = check_availability(book)
+        return Response(BookSerializer(book).data, status=status.HTTP_201_CREATED)
+
+class BookImport(APIView):
+    '''
+    Import many books of the user at once
+    '''
+    parser_classes = [JSONParser]
+
+    def post(self, request, format=None):
+        '''
+        Import books sent as a JSON array of objects, or as CSV (Content-Type: text/csv) with the columns
+        name, author, genre, edition, preservation_level, for_sale, price, for_exchange.
+        Authors and genres can be given by id or by name, and are created when they don't exist yet.
+        Invalid rows are skipped and returned with their errors
+        '''
+        if not request.user.is_authenticated:
+            return Response({'Error': 'You have to be logged in to import books.'}, status=status.HTTP_401_UNAUTHORIZED)
+
+        if request.content_type.startswith('text/csv'):
+            # read line by line, so a big upload isn't held in memory twice
+            rows = read_csv(line.decode('utf-8-sig') for line in request.stream or [])
+        else:
+            rows = request.data
+            if not isinstance(rows, list):
+                return Response({'Error': 'Send a JSON array of books, or CSV.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            books, errors = import_books(rows, request.user.user)
+        except ImportTooLarge as e:
+            return Response({'Error': str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except (csv.Error, UnicodeDecodeError):
+            return Response({'Error': 'The CSV could not be read.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            {'created': len(books), 'ids': [book.id for book in books], 'errors': errors},
+            status=status.HTTP_201_CREATED if books or not errors else status.HTTP_400_BAD_REQUEST,
+        )
+
+class BookSearch(APIView):
+    '''
+    Search available books by their name, author or genre
+    '''
+    def get(self, request, format=None):
+        '''
+        List available books matching the 'q' parameter, most relevant first
+        '''
+        q = request.query_params.get('q', '').strip()
+        if not q:
+            return Response({'Error': 'You have to provide a search query.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            selection = Selection.from_request(request, BOOK)
+        except InvalidSelection as e:
+            return Response({'Error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        paginator = SearchPagination()
+        books = search_books(available_books(Book.objects.all()), q)
+        rows = paginator.paginate_queryset(book_values(books, selection, 'rank'), request, view=self)
+        return paginator.get_paginated_response(serialize_books(rows, selection=selection))
+
+class BookChanges(ReplicaReadsMixin, APIView):
+    '''
+    Changes of the listed books, for clients that keep a copy of the books list
+    '''
+    def get(self, request, format=None):
+        '''
+        Books listed, changed, sold, exchanged, unlisted or deleted after the 'since' token: the latest
+        change of each book with its listing, which is null once the book isn't listed anymore.
+        'fields' and 'expand' narrow down the listings. Without 'since' only the current token is returned,
+        clients get it before downloading the list, and then pass the 'next' token of every response on
+        '''
+        try:
+            selection = Selection.from_request(request, BOOK)
+        except InvalidSelection as e:
+            return Response({'Error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if 'since' not in request.query_params:
+            return Response({'next': latest_token(), 'more': False, 'changes': []})
+        try:
+            since = int(request.query_params['since'])
+        except ValueError:
+            return Response({'Error': 'since has to be a token returned by this endpoint.'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            changes, next_token, more = changes_since(since)
+        except ChangesCompacted:
+            return Response({'Error': 'These changes are no longer kept, download the books again.'}, status=status.HTTP_410_GONE)
+
+        listings = {}
+        if changes:
+            rows = list(listing_values(Listing.objects.filter(book_id__in=[book_id for book_id, kind in changes]), selection))
+            listings = {row['book_id']: listing for row, listing in zip(rows, serialize_listings(rows, selection=selection))}
+        return Response({
+            'next': next_token,
+            'more': more,
+            'changes': [
+                {'book': book_id, 'change': ListingChange.Kind(kind).label, 'listing': listings.get(book_id)}
+                for book_id, kind in changes
+            ],
+        })
+
 class MyBooks(APIView):
     '''
     List all books of the logged in user.
@@ -261,33 +387,45 @@ class MyBooks(APIView):
         '''
         if not request.user.is_authenticated:
             return Response({'Error': 'You aren\'t logged in'}, status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            selection = Selection.from_request(request, BOOK)
+        except InvalidSelection as e:
+            return Response({'Error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        books = Book.objects.filter(original_owner=request.user.user)
-        for book in books:
-            book.original_owner.email = book.original_owner.django_user.email
-            book = check_availability(book)
-        serializer = BookSerializer(books, many = True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        paginator = BookPagination()
+        books = book_values(Book.objects.filter(original_owner=request.user.user), selection)
+        rows = paginator.paginate_queryset(books, request, view=self)
+        return paginator.get_paginated_response(serialize_books(rows, selection=selection))
 
-class BookDetails(APIView):
+class BookDetails(VersionedResponseMixin, ReplicaReadsMixin, APIView):
     '''
     Retrieve, update or delete book info
     '''
-    def get_book(self, pk):
+    versioned_model = Book
+
+    def get_book(self, pk, queryset=None):
+        if queryset is None:
+            queryset = Book.objects.all()
         try:
-            return Book.objects.get(pk=pk)
+            return queryset.get(pk=pk)
         except Book.DoesNotExist:
             raise Http404
     
     def get(self, request, pk, format=None):
         '''
-        Retrieve information about a single book
+        Retrieve information about a single book, narrowed down by 'fields' and 'expand'.
+        Responses carry the book's version as their ETag and are cached per version
         '''
-        book = self.get_book(pk)
-        book.original_owner.email = book.original_owner.django_user.email
-        book = check_availability(book)
-        serializer = BookSerializer(book)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        try:
+            selection = Selection.from_request(request, BOOK)
+        except InvalidSelection as e:
+            return Response({'Error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        rows = list(book_values(Book.objects.filter(pk=pk), selection, 'version'))
+        if not rows:
+            raise Http404
+        response = Response(serialize_books(rows, selection=selection)[0], status=status.HTTP_200_OK)
+        response.object_version = rows[0]['version']
+        return response
 
     def put(self, request, pk, format=None):
         '''
@@ -298,7 +436,7 @@ class BookDetails(APIView):
         data = request.data
         book = self.get_book(pk)
 
-        if not request.user.is_authenticated or request.user.user != book.original_owner:
+        if not request.user.is_authenticated or request.user.user.id != book.original_owner_id:
             return Response({'Error': 'You are unauthorized to edit this book.'}, status=status.HTTP_401_UNAUTHORIZED)
 
         if 'name' in data:
@@ -309,18 +447,17 @@ class BookDetails(APIView):
             book.preservation_level = data['preservation_level']
         if 'author' in data:
             try:
-                book.author = Author.objects.get(id=data['author'])
+                book.author = authors.get(id=data['author'])
             except Author.DoesNotExist:
                 return Response({'Error': 'You provided an invalid author id.'}, status=status.HTTP_400_BAD_REQUEST)
         if 'genre' in data:
             try:
-                book.genre = Genre.objects.get(name=data['genre'])
+                book.genre = genres.get(name=data['genre'])
             except Genre.DoesNotExist:
                 return Response({'Error': 'You provided an invalid genre.'}, status=status.HTTP_400_BAD_REQUEST)
         
         book.save()
 
-        book.original_owner.email = book.original_owner.django_user.email
         book = check_availability(book)
         serializer = BookSerializer(book)
         return Response(serializer.data)
@@ -333,78 +470,161 @@ class BookDetails(APIView):
         book.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+class BookImages(APIView):
+    '''
+    Upload an image of a book
+    '''
+    # the body is streamed to disk instead of being parsed
+    parser_classes = []
+
+    def post(self, request, pk, format=None):
+        '''
+        Attach an image, sent as the raw request body (e.g. Content-Type: image/jpeg), to the user's book
+        '''
+        if not request.user.is_authenticated:
+            return Response({'Error': 'You have to be logged in to upload an image.'}, status=status.HTTP_401_UNAUTHORIZED)
+        owner_id = Book.objects.filter(pk=pk).values_list('original_owner_id', flat=True).first()
+        if owner_id is None:
+            raise Http404
+        if owner_id != request.user.user.id:
+            return Response({'Error': 'You can only upload images of your books.'}, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or '')
+        except ValueError:
+            content_length = None
+        try:
+            upload = receive_image(request.stream, content_length)
+        except UploadRejected as e:
+            return Response({'Error': e.message}, status=e.status_code)
+
+        try:
+            name = default_storage.save(f'books/{upload.name}', upload)
+        finally:
+            upload.close()
+        image = Image.objects.create(book_id=pk, image=name)
+        return Response(ImageSerializer(image).data, status=status.HTTP_201_CREATED)
+
 class BookBuy(APIView):
     '''
     Mark a book as bought
     '''
     def get(self, request, pk, format=None):
-        book = Book.objects.get(pk=pk)
-
         if not request.user.is_authenticated:
             return Response({'Error': 'You have to log in to buy a book.'}, status=status.HTTP_401_UNAUTHORIZED)
-        if not Sale.objects.filter(book=book).exists():
-            return Response({'Error': 'Chosen book is not available for sale.'}, status=status.HTTP_400_BAD_REQUEST)
-        if book.original_owner == request.user.user:
+        owner_id = Book.objects.filter(pk=pk).values_list('original_owner_id', flat=True).first()
+        if owner_id is None:
+            raise Http404
+        if owner_id == request.user.user.id:
             return Response({'Error': 'You can\'t buy your own book!'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        sale = Sale.objects.get(book=book)
-        if sale.status != Status.objects.get(name='AVAILABLE'):
-            return Response({'Error': 'Invalid book for sale.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        sale.buyer = request.user.user
-        sale.status = Status.objects.get(name='UNAVAILABLE')
-        sale.date_sold = date.today()
-
-        sale.save()
-        return Response(status=status.HTTP_200_OK)
+        if buy_book(pk, request.user.user):
+            publish([owner_id], 'sold', book=pk)
+            return Response(status=status.HTTP_200_OK)
+        if not Sale.objects.filter(book_id=pk).exists():
+            return Response({'Error': 'Chosen book is not available for sale.'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'Error': 'The book has already been sold or exchanged.'}, status=status.HTTP_409_CONFLICT)
 
 class BookExchange(APIView):
     '''
     Ask for book exchange
     '''
     def post(self, request, pk, format=None):
-        book_offered = Book.objects.get(pk=pk)
+        '''
+        Offer one of the user's books (book_id) in exchange. Several users can make offers for the same book,
+        until its owner accepts one of them
+        '''
         if not request.user.is_authenticated:
             return Response({'Error': 'You have to log in to exchange for a book.'}, status=status.HTTP_401_UNAUTHORIZED)
-        if not Exchange.objects.filter(book_offered=book_offered).exists():
-            return Response({'Error': 'Chosen book is not available for exchange.'}, status=status.HTTP_400_BAD_REQUEST)
-        if book_offered.original_owner == request.user.user:
+        try:
+            book_returned_id = int(request.data['book_id'])
+        except (KeyError, TypeError, ValueError):
+            return Response({'Error': 'You offered an invalid book in return.'}, status=status.HTTP_400_BAD_REQUEST)
+        owners = dict(Book.objects.filter(pk__in=[pk, book_returned_id]).values_list('id', 'original_owner_id'))
+        if pk not in owners:
+            raise Http404
+        if owners[pk] == request.user.user.id:
             return Response({'Error': 'You can\'t exchange with your own book!'}, status=status.HTTP_400_BAD_REQUEST)
-        
-        exchange = Exchange.objects.get(book_offered=book_offered)
-        if exchange.status != Status.objects.get(name='AVAILABLE'):
-            return Response({'Error': 'Invalid book for exchange.'}, status=status.HTTP_400_BAD_REQUEST)
+        if book_returned_id not in owners:
+            return Response({'Error': 'You offered an invalid book in return.'}, status=status.HTTP_400_BAD_REQUEST)
+        if owners[book_returned_id] != request.user.user.id:
+            return Response({'Error': 'You have to provide your book.'}, status=status.HTTP_403_FORBIDDEN)
 
         try:
-            book_returned = Book.objects.get(id=request.data['book_id'])
-            if book_returned.original_owner != request.user.user:
-                return Response({'Error': 'You have to provide your book.'}, status=status.HTTP_403_FORBIDDEN)
-
-            exchange.book_returned = book_returned
-            exchange.status = Status.objects.get(name='PENDING')
-            exchange.date_exchanged = date.today()
-
-            exchange.save()
-            return Response(status=status.HTTP_200_OK)
-
-        except:
-            return Response({'Error': 'You offered an invalid book in return.'}, status=status.HTTP_400_BAD_REQUEST)
+            offer = Exchange.objects.offer(pk, book_returned_id)
+        except ExchangeConflict as e:
+            return Response({'Error': str(e)}, status=status.HTTP_409_CONFLICT)
+        publish([owners[pk]], 'offer', exchange=offer.id, book=pk, book_returned=book_returned_id)
+        return Response({'id': offer.id, 'version': offer.version}, status=status.HTTP_200_OK)
 
 class ExchangeReply(APIView):
     '''
     Accept or decline an exchange for the user's book
     '''
     def post(self, request, pk, format=None):
-        data = request.data
-        book_offered = Book.objects.get(pk=pk)
-        if book_offered.original_owner != request.user.user:
+        '''
+        Reply (accept or decline) to an offer for the book. When several offers are pending, exchange_id
+        chooses one, and an optional version makes the reply fail if the offer has changed since.
+        Accepting an offer declines all the others
+        '''
+        if not request.user.is_authenticated:
+            return Response({'Error': 'You have to log in to reply to an exchange.'}, status=status.HTTP_401_UNAUTHORIZED)
+        owner_id = Book.objects.filter(pk=pk).values_list('original_owner_id', flat=True).first()
+        if owner_id is None:
+            raise Http404
+        if owner_id != request.user.user.id:
             return Response({'Error': 'You can only accept exchanges for your books.'}, status=status.HTTP_403_FORBIDDEN)
-        exchange = Exchange.objects.get(book_offered=book_offered)
-        if exchange.status == Status.objects.get(name='PENDING'):
-            if data.get('reply')  == 'accept':
-                exchange.status = Status.objects.get(name='ACCEPTED')
-            elif data.get('reply') == 'decline':
-                exchange.status = Status.objects.get(name='DECLINED')
+        reply = request.data.get('reply')
+        if reply not in ('accept', 'decline'):
+            return Response({'Error': 'Reply with either accept or decline.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        offers = Exchange.objects.filter(book_offered_id=pk, state=Exchange.State.PENDING)
+        try:
+            if 'exchange_id' in request.data:
+                offers = offers.filter(pk=int(request.data['exchange_id']))
+            if 'version' in request.data:
+                offers = offers.filter(version=int(request.data['version']))
+        except (TypeError, ValueError):
+            return Response({'Error': 'exchange_id and version have to be numbers.'}, status=status.HTTP_400_BAD_REQUEST)
+        if 'exchange_id' not in request.data:
+            pending = list(offers.values_list('pk', flat=True)[:2])
+            if len(pending) > 1:
+                return Response({'Error': 'Several offers are pending, choose one with exchange_id.'}, status=status.HTTP_400_BAD_REQUEST)
+            offers = Exchange.objects.filter(pk__in=pending)
+
+        if reply == 'accept':
+            replied = offers.accept()
+        else:
+            replied = offers.decline()
+        if replied:
+            return Response(status=status.HTTP_200_OK)
+        return Response({'Error': 'There is no such pending exchange for this book.'}, status=status.HTTP_409_CONFLICT)
+
+class ExchangeBatchReply(APIView):
+    '''
+    Accept and decline many exchange offers at once
+    '''
+    def post(self, request, format=None):
+        '''
+        Accept the offers listed in 'accept' (at most one per book) and decline the ones in 'decline',
+        for books of the user. Offers that are no longer pending are skipped
+        '''
+        if not request.user.is_authenticated:
+            return Response({'Error': 'You have to log in to reply to exchanges.'}, status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            accept = [int(pk) for pk in request.data.get('accept', [])]
+            decline = [int(pk) for pk in request.data.get('decline', [])]
+        except (TypeError, ValueError):
+            return Response({'Error': 'accept and decline have to be lists of exchange ids.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        offers = Exchange.objects.filter(book_offered__original_owner=request.user.user)
+        try:
+            with transaction.atomic():
+                accepted = offers.filter(pk__in=accept).accept() if accept else 0
+                declined = offers.filter(pk__in=decline).decline() if decline else 0
+        except ExchangeConflict as e:
+            return Response({'Error': str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response({'accepted': accepted, 'declined': declined}, status=status.HTTP_200_OK)
 
 class UserExchanges(APIView):
     '''
@@ -413,13 +633,12 @@ class UserExchanges(APIView):
     def get(self, request, format=None):
         if not request.user.is_authenticated:
             return Response({'Error': 'You have to be logged in.'}, status=status.HTTP_401_UNAUTHORIZED)
-        exchanges = Exchange.objects.filter(book_offered__original_owner=request.user.user)
-        for exchange in exchanges:
-            exchange.book_offered.original_owner.email = exchange.book_offered.original_owner.django_user.email
-            exchange.book_offered = check_availability(exchange.book_offered)
-            exchange.book_returned = check_availability(exchange.book_returned)
-        serializer = ExchangeSerializer(exchanges, many=True)
-        return Response(serializer.data, status=HTTP_200_OK)
+        try:
+            selection = Selection.from_request(request, EXCHANGE)
+        except InvalidSelection as e:
+            return Response({'Error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        exchanges = Exchange.objects.filter(book_offered__original_owner=request.user.user).order_by('id')
+        return Response(serialize_exchanges(exchanges, selection=selection), status=status.HTTP_200_OK)
 
 class UserSales(APIView):
     '''
@@ -428,10 +647,38 @@ class UserSales(APIView):
     def get(self, request, format=None):
         if not request.user.is_authenticated:
             return Response({'Error': 'You have to be logged in.'}, status=status.HTTP_401_UNAUTHORIZED)
-        sales = Sale.objects.filter(book__original_owner=request.user.user)
-        for sale in sales:
-            sale.book.original_owner.email = sale.book.original_owner.django_user.email
-            sale.book = check_availability(sale.book)
-            sale.book = check_availability(sale.book)
-        serializer = SaleSerializer(sales, many=True)
-        return Response(serializer.data, status=HTTP_200_OK)
\ No newline at end of file
+        try:
+            selection = Selection.from_request(request, SALE)
+        except InvalidSelection as e:
+            return Response({'Error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        sales = Sale.objects.filter(book__original_owner=request.user.user).order_by('id')
+        return Response(serialize_sales(sales, selection=selection), status=status.HTTP_200_OK)
+
+class EventTicket(APIView):
+    '''
+    A single use ticket for opening the user's event stream at /events/?ticket=, for browsers'
+    EventSource, which can't send the access token in a header
+    '''
+    def post(self, request, format=None):
+        if not request.user.is_authenticated:
+            return Response({'Error': 'You have to be logged in.'}, status=status.HTTP_401_UNAUTHORIZED)
+        ticket = issue_ticket(request.user.user.id, request.auth['exp'])
+        return Response({'ticket': ticket, 'expires_in': settings.EVENTS_TICKET_SECONDS}, status=status.HTTP_201_CREATED)
+
+class ReferenceCacheStats(APIView):
+    '''
+    Show hit and miss counters of the reference data cache in the worker that handles the request
+    '''
+    permission_classes = [ permissions.IsAdminUser ]
+
+    def get(self, request, format=None):
+        return Response({'pid': os.getpid(), 'caches': reference_cache_stats()}, status=status.HTTP_200_OK)
+
+class JobStats(APIView):
+    '''
+    Show the depth of the background job queue, and the latency and failures of recent jobs, by task
+    '''
+    permission_classes = [ permissions.IsAdminUser ]
+
+    def get(self, request, format=None):
+        return Response(job_stats(), status=status.HTTP_200_OK)
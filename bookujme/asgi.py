@@ -13,4 +13,22 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bookujme.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+import threading
+from api import events
+from api.reference import warm_reference_caches
+
+events.serving_streams = True
+
+async def application(scope, receive, send):
+    '''
+    Event streams (see api.events) are served directly, so an open stream holds no thread
+    or request of Django's. Everything else goes to Django
+    '''
+    if scope['type'] == 'http' and scope['path'] == '/events/':
+        return await events.event_stream(scope, receive, send)
+    return await django_application(scope, receive, send)
+
+# ASGI servers may import the application from inside their event loop, where the ORM can't run
+threading.Thread(target=warm_reference_caches, daemon=True).start()
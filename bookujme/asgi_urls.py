@@ -0,0 +1,20 @@
+"""
+URL configuration used by the ASGI application (see bookujme.middleware.ASGIRoutesMiddleware).
+
+The read-only endpoints are wrapped so they run concurrently on a thread pool,
+everything else is served by the regular URL configuration.
+"""
+from django.urls import path, include
+
+from api.async_views import threaded_view
+from api.views import Cities, Authors, Genres, Books, BookDetails
+
+urlpatterns = [
+    path('cities/', threaded_view(Cities.as_view())),
+    path('authors/', threaded_view(Authors.as_view())),
+    path('genres/', threaded_view(Genres.as_view())),
+    path('books/', threaded_view(Books.as_view())),
+    path('books/<int:pk>/', threaded_view(BookDetails.as_view())),
+
+    path('', include('bookujme.urls')),
+]
@@ -1,13 +1,101 @@
-class CORSMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
+import asyncio
+import time
 
-    def __call__(self, request):
-        response = self.get_response(request)
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.utils.deprecation import MiddlewareMixin
+
+from api import instrumentation, replicas
+
+
+class CORSMiddleware(MiddlewareMixin):
+    # MiddlewareMixin makes this usable from both the WSGI and the ASGI handler,
+    # without forcing every ASGI request through a thread
+    def process_response(self, request, response):
         response['Access-Control-Allow-Origin'] = '*'
         response['Access-Control-Allow-Methods'] = '*'
         response[
             'Access-Control-Allow-Headers'] = 'Content-Type, Access-Control-Allow-Headers, Authorization, ' \
                                               'X-Requested-With'
 
-        return response
\ No newline at end of file
+        return response
+
+
+class ASGIRoutesMiddleware(MiddlewareMixin):
+    '''
+    Routes requests that come through bookujme.asgi to ASGI_ROOT_URLCONF,
+    which serves the read-only endpoints off the event loop's thread pool
+    '''
+    def process_request(self, request):
+        if isinstance(request, ASGIRequest):
+            request.urlconf = settings.ASGI_ROOT_URLCONF
+
+
+class InstrumentationMiddleware(MiddlewareMixin):
+    '''
+    Measures every request: SQL query count, database time, serialization (rendering) time and total time.
+    They are sent in a Server-Timing header, and sampled or over budget requests are logged
+    as JSON lines to logs/requests.log, see INSTRUMENTATION_* in settings
+    '''
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        metrics, token = instrumentation.start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            instrumentation.current.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics, token = instrumentation.start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            instrumentation.current.reset(token)
+        return self.finish(request, response, metrics)
+
+    def process_template_response(self, request, response):
+        metrics = instrumentation.current.get()
+        if metrics is not None:
+            metrics.start_render()
+            response.add_post_render_callback(lambda response: metrics.end_render())
+        return response
+
+    def finish(self, request, response, metrics):
+        total = time.perf_counter() - metrics.started
+        if settings.INSTRUMENTATION_SERVER_TIMING:
+            response['Server-Timing'] = instrumentation.server_timing(metrics, total)
+            response['Timing-Allow-Origin'] = '*'
+        instrumentation.log_request(request, response, metrics, total)
+        return response
+
+
+class ReplicaRoutingMiddleware(MiddlewareMixin):
+    '''
+    Keeps the database routing state of each request (see api.replicas), and pins a user
+    who wrote something to the primary for REPLICA_PIN_SECONDS
+    '''
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        state, token = replicas.start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            replicas.current.reset(token)
+        return self.finish(request, response, state)
+
+    async def __acall__(self, request):
+        state, token = replicas.start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            replicas.current.reset(token)
+        return self.finish(request, response, state)
+
+    def finish(self, request, response, state):
+        user = getattr(request, 'user', None)
+        if state.wrote and response.status_code < 400 and user is not None and user.is_authenticated:
+            replicas.pin(user.id)
+        return response
@@ -50,6 +50,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'rest_framework',
     'rest_framework_simplejwt',
@@ -63,11 +64,20 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.AllowAny'
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        'api.authentication.ClaimsJWTAuthentication',
+    ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.KeysetPagination',
+    # default number of items per page, clients can ask for up to 100 with ?page_size=
+    'PAGE_SIZE': 50,
 }
 
 MIDDLEWARE = [
+    'bookujme.middleware.InstrumentationMiddleware',
+    'bookujme.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,9 +86,13 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'bookujme.middleware.CORSMiddleware',
+    'bookujme.middleware.ASGIRoutesMiddleware',
 ]
 
 ROOT_URLCONF = 'bookujme.urls'
+ASGI_ROOT_URLCONF = 'bookujme.asgi_urls'
+# threads per ASGI worker process that run read-only views concurrently
+ASGI_READ_THREADS = 16
 
 TEMPLATES = [
     {
@@ -113,6 +127,143 @@ DATABASES = {
     }
 }
 
+# Read replicas of the default database, e.g. DB_REPLICAS=10.0.0.5,10.0.0.6:5433
+# Safe requests of the browsing views read from them, see api.replicas.
+# To try it locally, point this at a second postgres on the same machine (e.g. localhost:5433)
+# or give DATABASES a second SQLite alias and list it in DATABASE_REPLICAS.
+DATABASE_REPLICAS = []
+for number, address in enumerate(env.list('DB_REPLICAS', default=[]), 1):
+    host, _, port = address.partition(':')
+    alias = f'replica_{number}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port,
+        # tests only use the primary
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+
+# Seconds a user's reads stay on the primary after they wrote something,
+# longer than the replicas are usually behind
+REPLICA_PIN_SECONDS = 5
+# Replicas further behind than this many seconds get no reads until they catch up
+REPLICA_MAX_LAG = 2
+# Seconds between measurements of a replica's lag, per process
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+# Cache shared by all uWSGI workers, e.g. CACHE_URL=memcache://127.0.0.1:11211
+# Defaults to files under cache/, so invalidation still reaches every worker
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default=f'filecache://{BASE_DIR / "cache"}'),
+}
+
+# Seconds a rendered response of cities, authors or genres, or a page of listings, is kept.
+# Writes invalidate it right away, this only bounds how long a racing write can go unnoticed
+RESPONSE_CACHE_TIMEOUT = 60 * 60
+
+# Changes of listings younger than this many seconds aren't served by /books/changes/ yet,
+# so changes committed at the same time can't get their tokens out of order
+CHANGE_FEED_SETTLE_SECONDS = 1
+# Most changes returned by one request of /books/changes/
+CHANGE_FEED_LIMIT = 500
+# Days changes of listings are kept by manage.py compact_changes, clients that synced
+# longer ago have to download /books/ again
+CHANGE_FEED_RETENTION_DAYS = 30
+
+# How events for /events/ of the ASGI application reach the streams. api.events.LocalBroker only
+# delivers within one process, api.events.PostgresBroker across processes and nodes through LISTEN/NOTIFY.
+# By default PostgresBroker when the database is postgres, so writes served by uwsgi reach the streams
+EVENTS_BROKER = env('EVENTS_BROKER', default=None)
+# Seconds between comments sent on idle event streams, so proxies don't close them
+EVENTS_HEARTBEAT_SECONDS = 25
+# Events waiting to be sent to one stream, a client that falls further behind is disconnected
+EVENTS_QUEUE_SIZE = 100
+# Seconds a ticket from /events/ticket/ can be used to open an event stream, once
+EVENTS_TICKET_SECONDS = 30
+
+# Background jobs (api/jobs.py), run by manage.py run_jobs.
+# Worker threads per run_jobs process, and seconds an idle worker waits before looking for jobs again
+JOB_WORKER_CONCURRENCY = 4
+JOB_POLL_SECONDS = 1
+# A failed job is retried after JOB_RETRY_DELAY_SECONDS, twice as long after every further failure
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY_SECONDS = 10
+JOB_RETRY_MAX_DELAY_SECONDS = 3600
+# Seconds a worker may run a job before it counts as dead and another worker runs the job again
+JOB_LEASE_SECONDS = 600
+# Days finished jobs, and so their keys, are kept
+JOB_RETENTION_DAYS = 7
+# Seconds of finished jobs shown by /stats/jobs/
+JOB_STATS_WINDOW_SECONDS = 3600
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {
+            'format': '%(message)s',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+        # reopened when logrotate moves it, safe to share between uWSGI workers
+        'requests': {
+            'class': 'logging.handlers.WatchedFileHandler',
+            'filename': BASE_DIR / 'logs' / 'requests.log',
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'api': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'api.requests': {
+            'handlers': ['requests'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
+# Per request instrumentation (bookujme.middleware.InstrumentationMiddleware).
+# Every response gets a Server-Timing header, a share of the requests is logged with their slowest
+# and repeated SQL, and requests over a budget are always logged, as warnings
+INSTRUMENTATION_SERVER_TIMING = True
+INSTRUMENTATION_SAMPLE_RATE = 0.01
+INSTRUMENTATION_QUERY_BUDGET = 20
+# milliseconds
+INSTRUMENTATION_LATENCY_BUDGET = 500
+
+# Password hashing
+# https://docs.djangoproject.com/en/4.0/topics/auth/passwords/
+# New passwords are hashed with the first hasher. A hash made with another one, or with other
+# parameters, is replaced on the next successful login. To move to scrypt, put it first.
+
+PASSWORD_HASHERS = [
+    'api.passwords.TunedPBKDF2PasswordHasher',
+    'api.passwords.TunedScryptPasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+PASSWORD_PBKDF2_ITERATIONS = 390000
+PASSWORD_SCRYPT_WORK_FACTOR = 2 ** 14
+
+# Hashing runs on this many threads per process (see api/passwords.py), this many more
+# requests may wait for them, and a request whose password isn't hashed within the timeout
+# (seconds) gets a 503. Together the first two stay below the threads of a process (uwsgi.ini),
+# so the others keep serving requests and see the queue full
+PASSWORD_HASHING_WORKERS = 2
+PASSWORD_HASHING_QUEUE_SIZE = 1
+PASSWORD_HASHING_TIMEOUT = 5
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -131,11 +282,22 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Seconds before the in-process cache of statuses, cities, genres and authors
+# is reloaded, so changes made through other workers are picked up
+REFERENCE_CACHE_TTL = 300
+# Authors keep growing with imports, so each worker only keeps this many of them,
+# the least recently used ones are dropped
+AUTHOR_CACHE_SIZE = 2000
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=15),
     'REFRESH_TOKEN_LIFETIME': timedelta(minutes=60)
 }
 
+# Access tokens carry the ids the views need (api/authentication.py), so requests don't load
+# the user. Whether the user is still active, staff or superuser is cached for this many seconds
+AUTH_STATUS_CACHE_TTL = 60
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.0/topics/i18n/
 
@@ -154,6 +316,25 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR / 'static/'
 
+# Uploaded book images and their derivatives
+
+MEDIA_URL = 'media/'
+MEDIA_ROOT = BASE_DIR / 'media/'
+
+# uploads to books/<id>/images/ are streamed to disk in chunks and refused above this size
+IMAGE_UPLOAD_MAX_SIZE = 20 * 1024 * 1024
+IMAGE_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+IMAGE_THUMBNAIL_SIZE = (320, 320)
+IMAGE_DERIVATIVE_QUALITY = 80
+# processes rendering derivatives in each uWSGI worker, and how many images may wait for them
+IMAGE_DERIVATIVE_WORKERS = 1
+IMAGE_DERIVATIVE_QUEUE_SIZE = 32
+
+# books/import/ and the import_books command: rows per request, and rows per INSERT
+BOOK_IMPORT_MAX_ROWS = 20000
+BOOK_IMPORT_BATCH_SIZE = 1000
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -14,3 +14,6 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bookujme.settings')
 
 application = get_wsgi_application()
+
+from api.reference import warm_reference_caches
+warm_reference_caches()
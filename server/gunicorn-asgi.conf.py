@@ -0,0 +1,29 @@
+# ASGI deployment profile, an alternative to uwsgi.ini
+#
+# Serves bookujme.asgi with uvicorn workers managed by gunicorn. Read-only endpoints
+# (cities, authors, genres, books, book details) run concurrently on ASGI_READ_THREADS
+# threads per worker, so slow clients and slow queries don't hold a whole process.
+#
+#   gunicorn -c server/gunicorn-asgi.conf.py
+#
+# nginx can keep the same server block, with the uwsgi lines replaced by:
+#   proxy_pass http://unix:/var/www/bookuj.me/.venv/var/run/asgi.sock;
+#   proxy_set_header Host $host;
+#   proxy_http_version 1.1;
+#
+# The /events/ streams (api.events) are only served by these workers. Events of writes served
+# by other workers or by uwsgi reach them through postgres (api.events.PostgresBroker, the default
+# EVENTS_BROKER on postgres).
+
+chdir = '/var/www/bookuj.me/'
+wsgi_app = 'bookujme.asgi:application'
+worker_class = 'uvicorn.workers.UvicornWorker'
+# fewer processes than uwsgi.ini, each one handles many connections at once
+workers = 4
+bind = 'unix:/var/www/bookuj.me/.venv/var/run/asgi.sock'
+umask = 0o111
+timeout = 3600
+graceful_timeout = 30
+keepalive = 5
+accesslog = '/var/www/bookuj.me/logs/asgi-access.log'
+errorlog = '/var/www/bookuj.me/logs/asgi.log'